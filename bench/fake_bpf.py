@@ -0,0 +1,235 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+In-memory stand-in for a loaded finelame_ebpf.c program: the subset of the bcc BPF
+object and tables the agent uses, with maps stored as NumPy arrays so they can be
+filled with millions of synthetic requests. Tables have no map_fd, so they are
+harvested through the same chunked iteration as kernels without batch map operations.
+'''
+
+import ctypes as ct
+import numpy as np
+
+from engine.harvest import ctypes_dtype, APP_SHIFT
+from engine.ebpf_rewriter import DATAPOINT_FIELDS, datapoint_layout
+
+CTYPES = dict(u64=ct.c_uint64, size_t=ct.c_size_t, u32=ct.c_uint32, int=ct.c_int)
+
+def datapoint_type(layout):
+    ''' struct datapoint, as the rewriter generates it for layout (see datapoint_layout) '''
+    class Datapoint(ct.Structure):
+        _fields_ = [(name, CTYPES[ctype]) for name, ctype, _, _ in DATAPOINT_FIELDS
+                    if name in layout['fields']]
+    return Datapoint
+
+def outlier_score_type(k):
+    class OutlierScore(ct.Structure):
+        _fields_ = [("distances", ct.c_longlong * k),
+                    ("model_version", ct.c_uint64),
+                    ("is_outlier", ct.c_uint8),
+                    ("detection_ts", ct.c_uint64),
+                    ("last_ts", ct.c_uint64),
+                    ("detection_cputime", ct.c_uint64)]
+    return OutlierScore
+
+class Flagged(ct.Structure):
+    _fields_ = [("detection_ts", ct.c_uint64),
+                ("score", ct.c_longlong),
+                ("saddr", ct.c_uint32),
+                ("pad", ct.c_uint32)]
+
+class Verdict(ct.Structure):
+    _fields_ = [("ts", ct.c_uint64),
+                ("score", ct.c_longlong),
+                ("verdict", ct.c_uint32),
+                ("pad", ct.c_uint32)]
+
+class Norm(ct.Structure):
+    _fields_ = [("mult", ct.c_uint64),
+                ("shift", ct.c_uint64)]
+
+def model_type(k, n_features):
+    # A model always has room for one feature, as in the rewritten program
+    n_features = max(n_features, 1)
+    class Model(ct.Structure):
+        _fields_ = [("version", ct.c_uint64),
+                    ("centroid_offset", ct.c_longlong),
+                    ("centroid_l1s", ct.c_longlong * k),
+                    ("cluster_thresholds", ct.c_uint64 * k),
+                    ("norm", Norm * n_features),
+                    ("train_set_params", ct.c_uint64 * (n_features * 2))]
+    return Model
+
+class FakeHash():
+    ''' A hash map backed by a key array and a structured value array '''
+    def __init__(self, key_type, leaf_type):
+        self.Key = key_type
+        self.Leaf = leaf_type
+        self.keys = np.empty(0, dtype=ctypes_dtype(key_type))
+        self.values = np.empty(0, dtype=ctypes_dtype(leaf_type))
+        self.alive = np.empty(0, dtype=bool)
+        self.index = None
+
+    def fill(self, keys, values):
+        self.keys = np.ascontiguousarray(keys, dtype=self.keys.dtype)
+        self.values = np.ascontiguousarray(values, dtype=self.values.dtype)
+        self.alive = np.ones(len(keys), dtype=bool)
+        self.index = None
+
+    def _index(self):
+        if self.index is None:
+            self.index = {k: i for i, k in enumerate(self.keys.tolist())}
+        return self.index
+
+    def items(self):
+        key_size, leaf_size = self.keys.dtype.itemsize, self.values.dtype.itemsize
+        for i in np.flatnonzero(self.alive):
+            yield (self.Key.from_buffer(self.keys, int(i) * key_size),
+                   self.Leaf.from_buffer(self.values, int(i) * leaf_size))
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def __getitem__(self, key):
+        i = self._index().get(key.value)
+        if i is None or not self.alive[i]:
+            raise KeyError(key.value)
+        return self.Leaf.from_buffer(self.values, i * self.values.dtype.itemsize)
+
+    def __setitem__(self, key, leaf):
+        i = self._index().get(key.value)
+        value = np.frombuffer(ct.string_at(ct.addressof(leaf), ct.sizeof(leaf)),
+                              dtype=self.values.dtype)
+        if i is None:
+            self.index[key.value] = len(self.keys)
+            self.keys = np.append(self.keys, np.array([key.value], dtype=self.keys.dtype))
+            self.values = np.append(self.values, value)
+            self.alive = np.append(self.alive, True)
+        else:
+            self.values[i] = value[0]
+            self.alive[i] = True
+
+    def __delitem__(self, key):
+        i = self._index().get(key.value)
+        if i is None or not self.alive[i]:
+            raise KeyError(key.value)
+        self.alive[i] = False
+
+    def clear(self):
+        self.fill(self.keys[:0], self.values[:0])
+
+class FakeArray():
+    ''' An array map: every index exists and starts zeroed '''
+    def __init__(self, leaf_type, size):
+        self.Leaf = leaf_type
+        self.entries = [leaf_type() for _ in range(size)]
+
+    def __getitem__(self, idx):
+        return self.entries[int(getattr(idx, 'value', idx))]
+
+    def __setitem__(self, idx, leaf):
+        self.entries[int(getattr(idx, 'value', idx))] = leaf
+
+    def __len__(self):
+        return len(self.entries)
+
+class FakePerCpuArray(FakeArray):
+    ''' A per-CPU array of counters, as seen from a single CPU '''
+    def __init__(self, size):
+        FakeArray.__init__(self, ct.c_uint64, size)
+
+    def sum(self, idx):
+        return ct.c_uint64(self[idx].value)
+
+class FakeBPF():
+    '''
+    The maps of finelame_ebpf.c, for n_apps applications and k clusters. layout (see
+    datapoint_layout, all fields by default) sets struct datapoint and the model's features.
+    '''
+    def __init__(self, k, n_apps=1, layout=None):
+        self.k = k
+        self.layout = layout or datapoint_layout()
+        self.tables = dict(
+            datapoints = FakeHash(ct.c_uint64, datapoint_type(self.layout)),
+            outlier_scores_m = FakeHash(ct.c_uint64, outlier_score_type(k)),
+            tid_to_rid = FakeHash(ct.c_uint32, ct.c_uint64),
+            start = FakeHash(ct.c_uint32, ct.c_uint64),
+            assoc_to_rid = FakeHash(ct.c_ulong, ct.c_uint64),
+            models = FakeArray(model_type(k, len(self.layout['features'])), 2 * n_apps),
+            active_model = FakeArray(ct.c_uint32, n_apps),
+            max_rid = FakeArray(ct.c_uint64, n_apps),
+            fl_stats = FakePerCpuArray(4),
+            outlier_counts = FakePerCpuArray(n_apps),
+            flagged = FakeHash(ct.c_uint64, Flagged),
+            blocklist = FakeHash(ct.c_uint32, ct.c_uint64),
+            verdicts = FakeHash(ct.c_uint64, Verdict),
+        )
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def fill_requests(self, n, app=0, seed=0):
+        '''
+        Populate datapoints and outlier_scores_m with n synthetic requests. Resource usage
+        follows heavy-tailed distributions with a few percent of much heavier requests.
+        '''
+        rng = np.random.default_rng(seed)
+        keys = (np.uint64(app) << np.uint64(APP_SHIFT)) | np.arange(1, n + 1, dtype=np.uint64)
+        heavy = rng.random(n) < 0.02
+
+        dps = np.zeros(n, dtype=self['datapoints'].values.dtype)
+        dps['first_ts'] = rng.integers(1e9, 2e9, n)
+        cputime = rng.lognormal(12, 1, n) * np.where(heavy, 50, 1)
+        dps['latest_ts_update'] = dps['first_ts'] + cputime.astype(np.uint64)
+        dps['last_unmap_ts'] = dps['latest_ts_update']
+        fields = dict(cputime = lambda: cputime,
+                      n_cputime_updates = lambda: rng.integers(1, 10, n),
+                      pgfaults = lambda: rng.poisson(20, n) * np.where(heavy, 10, 1),
+                      mem_malloc = lambda: rng.lognormal(10, 1.5, n),
+                      saddr = lambda: rng.integers(1, 2**32, n))
+        for name, _, _, offset in DATAPOINT_FIELDS:
+            if name not in dps.dtype.names:
+                continue
+            if name in fields:
+                dps[name] = fields[name]()
+            elif offset is not None:
+                # Other counters the model may use: heavy-tailed too
+                dps[name] = rng.lognormal(6, 1, n) * np.where(heavy, 10, 1)
+        self['datapoints'].fill(keys, dps)
+
+        scores = np.zeros(n, dtype=self['outlier_scores_m'].values.dtype)
+        scores['distances'] = rng.integers(-10**12, 10**12, (n, self.k))
+        scores['model_version'] = 1
+        scores['is_outlier'] = heavy
+        scores['last_ts'] = dps['latest_ts_update']
+        scores['detection_ts'] = np.where(heavy, dps['latest_ts_update'], 0)
+        scores['detection_cputime'] = np.where(heavy, dps['cputime'], 0)
+        self['outlier_scores_m'].fill(keys, scores)
+
+        flagged = np.zeros(int(heavy.sum()), dtype=self['flagged'].values.dtype)
+        flagged['detection_ts'] = scores['detection_ts'][heavy]
+        flagged['score'] = scores['distances'][heavy, 0]
+        flagged['saddr'] = rng.integers(1, 2**32, len(flagged))
+        self['flagged'].fill(keys[heavy], flagged)
+
+        # Insertion counters of the metrics (FL_STAT_DP_INSERTS, FL_STAT_SCORE_INSERTS)
+        for idx in (0, 2):
+            self['fl_stats'][idx] = ct.c_uint64(self['fl_stats'][idx].value + n)
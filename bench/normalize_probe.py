@@ -0,0 +1,153 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Probe cost of the two in-kernel normalizations: division by the scaled std (former) and
+multiply-shift by a precomputed reciprocal (current).
+
+Usage (as root, from the repository root):
+    python3 -m bench.normalize_probe --calls 2000000
+
+Each variant is attached in turn to the getppid() syscall tracepoint and normalizes all
+features of a model on every call; their average run times come from the kernel's BPF
+program statistics. Results are printed as one JSON object.
+'''
+
+import argparse
+import json
+import os
+
+from bcc import BPF
+
+from engine.bcc_monitor import BPF_STATS, prog_fd_stats
+from engine.fixed_point import scale_factors, norm_factors, reciprocals
+
+N_FEATURES = 6
+TRACEPOINT = 'syscalls:sys_enter_getppid'
+
+PROG = r'''
+#define N_FEATURES %(n_features)d
+
+struct bench_model {
+    u64 mult[N_FEATURES];
+    u64 shift[N_FEATURES];
+    u64 std[N_FEATURES];
+};
+
+BPF_ARRAY(model, struct bench_model, 1);
+BPF_PERCPU_ARRAY(sink, u64, 1);
+
+static inline __attribute__((always_inline))
+u64 mul_shift(u64 x, u64 mult, u64 shift) {
+    u64 lo = ((x & 0xffffffff) * mult) >> shift;
+    u64 hi = (x >> 32) * mult;
+    if (shift >= 32) {
+        hi >>= shift - 32;
+    } else {
+        hi <<= 32 - shift;
+    }
+    return hi + lo;
+}
+
+int norm_div(void *ctx) {
+    int idx = 0;
+    struct bench_model *m = model.lookup(&idx);
+    u64 *out = sink.lookup(&idx);
+    if (!m || !out) {
+        return 0;
+    }
+    long long x = bpf_ktime_get_ns() & 0xffffff;
+    long long total = 0;
+#pragma unroll
+    for (int i = 0; i < N_FEATURES; i++) {
+        long long scaled = x * %(m_scale)d;
+        u64 std = m->std[i];
+        if (std == 0) {
+            std = 10000;
+        }
+        total += scaled / std;
+    }
+    *out += total;
+    return 0;
+}
+
+int norm_recip(void *ctx) {
+    int idx = 0;
+    struct bench_model *m = model.lookup(&idx);
+    u64 *out = sink.lookup(&idx);
+    if (!m || !out) {
+        return 0;
+    }
+    long long x = bpf_ktime_get_ns() & 0xffffff;
+    long long total = 0;
+#pragma unroll
+    for (int i = 0; i < N_FEATURES; i++) {
+        total += mul_shift(x, m->mult[i], m->shift[i] & 63);
+    }
+    *out += total;
+    return 0;
+}
+'''
+
+def measure(bpf, fn_name, calls):
+    bpf.attach_tracepoint(tp=TRACEPOINT, fn_name=fn_name)
+    fd = bpf.load_func(fn_name, BPF.TRACEPOINT).fd
+    before = prog_fd_stats(fd)
+    for _ in range(calls):
+        os.getppid()
+    after = prog_fd_stats(fd)
+    bpf.detach_tracepoint(tp=TRACEPOINT)
+    runs = after['run_cnt'] - before['run_cnt']
+    return dict(runs = runs,
+                avg_ns = (after['run_time_ns'] - before['run_time_ns']) / runs if runs else None)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark in-kernel normalization variants')
+    parser.add_argument('--calls', default=2000000, type=int, help='Probe firings per variant')
+    parser.add_argument('--scale-method', default='exponent')
+    parser.add_argument('--m-scale', default=10, type=int)
+    parser.add_argument('--s-scale', default=6, type=int)
+    args = parser.parse_args()
+
+    m_scale, s_scale = scale_factors(args.scale_method, args.m_scale, args.s_scale)
+    bpf = BPF(text=PROG % dict(n_features=N_FEATURES, m_scale=m_scale))
+
+    # Standard deviations spanning the usual feature ranges (ns, bytes, counts)
+    stds = [1e5, 3e4, 2e3, 1e6, 5e2, 20.]
+    mult, shift = reciprocals(norm_factors(stds, m_scale, s_scale))
+    model = bpf['model'].Leaf()
+    for i in range(N_FEATURES):
+        model.mult[i] = int(mult[i])
+        model.shift[i] = int(shift[i])
+        model.std[i] = int(stds[i] * s_scale)
+    bpf['model'][0] = model
+
+    with open(BPF_STATS) as f:
+        stats_enabled = f.read().strip()
+    with open(BPF_STATS, 'w') as f:
+        f.write('1')
+    try:
+        result = dict(scale_method = args.scale_method,
+                      division = measure(bpf, 'norm_div', args.calls),
+                      reciprocal = measure(bpf, 'norm_recip', args.calls))
+    finally:
+        with open(BPF_STATS, 'w') as f:
+            f.write(stats_enabled)
+    print(json.dumps(result))
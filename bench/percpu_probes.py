@@ -0,0 +1,140 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Probe cost of the shared and per-CPU datapoints layouts as the number of busy cores grows.
+
+Usage (as root, from the repository root):
+    python3 -m bench.percpu_probes --cpus 1,2,4,8,16 --duration 5
+
+One worker process per core takes user page faults in a loop, all of them mapped to the
+same request (the worst case for the shared layout) unless --distinct is given. The page
+fault probe's average run time comes from the kernel's BPF program statistics
+(kernel.bpf_stats_enabled). One JSON object is printed per (layout, cores) pair.
+'''
+
+import argparse
+import ctypes as ct
+import json
+import mmap
+import multiprocessing as mp
+import os
+import sys
+import time
+
+from bcc import BPF
+
+from engine.bcc_monitor import BCCMonitor, BPF_STATS, prog_fd_stats
+from engine.ebpf_rewriter import rewrite_ebpf
+
+PAGE_SIZE = mmap.PAGESIZE
+REGION_SIZE = 64 * 1024 * 1024
+
+PGFAULT_MONITOR = dict(event='exceptions:page_fault_user', in_fn_name='handle_pg_fault',
+                       type='t', side='k')
+# A placeholder application: the benchmark maps its workers to requests itself
+BENCH_APP = dict(exec_path=sys.executable, monitors=[])
+
+def fault_worker(cpu, start, stop, results):
+    os.sched_setaffinity(0, {cpu})
+    start.wait()
+    faults = 0
+    while not stop.is_set():
+        region = mmap.mmap(-1, REGION_SIZE)
+        for offset in range(0, REGION_SIZE, PAGE_SIZE):
+            region[offset] = 1
+        region.close()
+        faults += REGION_SIZE // PAGE_SIZE
+    results.put(faults)
+
+def load_trivial_model(bm):
+    ''' A model with no usable cluster: probes go through scoring without ever flagging '''
+    n_features = len(bm.ebpf['models'].Leaf().train_set_params) // 2
+    bm.load_model(dict(centroid_offset=0, centroid_l1s=[0], cluster_thresholds=[0],
+                       norm_mult=[1] * n_features, norm_shift=[0] * n_features,
+                       train_set_params=[0, 1] * n_features))
+
+def run(bm, fd, cpus, duration, distinct):
+    ctx = mp.get_context('fork')
+    start, stop, results = ctx.Event(), ctx.Event(), ctx.Queue()
+    workers = [ctx.Process(target=fault_worker, args=(cpu, start, stop, results))
+               for cpu in cpus]
+    for worker in workers:
+        worker.start()
+
+    tid_to_rid = bm.ebpf['tid_to_rid']
+    for i, worker in enumerate(workers):
+        rid = (i if distinct else 0) + 1
+        tid_to_rid[ct.c_uint32(worker.pid)] = ct.c_uint64(rid)
+
+    before = prog_fd_stats(fd)
+    start.set()
+    time.sleep(duration)
+    stop.set()
+    faults = sum(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    after = prog_fd_stats(fd)
+    tid_to_rid.clear()
+    bm.ebpf['datapoints'].clear()
+    bm.ebpf['outlier_scores_m'].clear()
+
+    run_cnt = after['run_cnt'] - before['run_cnt']
+    run_time = after['run_time_ns'] - before['run_time_ns']
+    return dict(cores = len(cpus),
+                faults_per_s = faults / duration,
+                probe_runs = run_cnt,
+                probe_avg_ns = run_time / run_cnt if run_cnt else None)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark shared vs per-CPU datapoints')
+    parser.add_argument('--cpus', default='1,2,4,8', help='Comma-separated numbers of busy cores')
+    parser.add_argument('--duration', default=5, type=float, help='Seconds per measurement')
+    parser.add_argument('--distinct', action='store_true', default=False,
+                        help='Map each worker to its own request')
+    parser.add_argument('--score', action='store_true', default=False,
+                        help='Load a model so probes also update outlier scores')
+    parser.add_argument('--ebpf-prog', default='engine/ebpf_progs/finelame_ebpf.c')
+    args = parser.parse_args()
+
+    available = sorted(os.sched_getaffinity(0))
+    core_counts = [n for n in map(int, args.cpus.split(',')) if n <= len(available)]
+
+    with open(BPF_STATS) as f:
+        stats_enabled = f.read().strip()
+    with open(BPF_STATS, 'w') as f:
+        f.write('1')
+    try:
+        for layout in ('shared', 'percpu'):
+            prog, _ = rewrite_ebpf(args.ebpf_prog, [BENCH_APP], False, percpu=layout == 'percpu')
+            bm = BCCMonitor(prog, {}, percpu=layout == 'percpu')
+            bm.attach_resource_monitor(PGFAULT_MONITOR)
+            if args.score:
+                load_trivial_model(bm)
+            fd = bm.ebpf.load_func('handle_pg_fault', BPF.TRACEPOINT).fd
+            for n in core_counts:
+                result = run(bm, fd, available[:n], args.duration, args.distinct)
+                result.update(layout=layout, distinct=args.distinct, score=args.score)
+                print(json.dumps(result), flush=True)
+            bm.detach_all_monitors()
+            bm.ebpf.cleanup()
+    finally:
+        with open(BPF_STATS, 'w') as f:
+            f.write(stats_enabled)
@@ -0,0 +1,144 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Per-event cost of the scheduler and page fault probes with and without the process filter.
+
+Usage (as root, from the repository root):
+    python3 -m bench.proc_filter --unrelated 8 --tracked 1 --duration 5
+
+Unrelated worker processes take user page faults and sleep briefly in a loop, like the
+other tasks of a busy host; tracked workers do the same while mapped to a request, and
+are the only processes published in the filter. The probes' average run time comes from
+the kernel's BPF program statistics (kernel.bpf_stats_enabled). One JSON object is printed
+per (filter, probe) pair.
+'''
+
+import argparse
+import ctypes as ct
+import json
+import mmap
+import multiprocessing as mp
+import os
+import time
+
+from bcc import BPF
+
+from engine.bcc_monitor import BCCMonitor, BPF_STATS, prog_fd_stats
+from engine.ebpf_rewriter import rewrite_ebpf
+from engine.proc_filter import proc_filter_config
+from bench.percpu_probes import PGFAULT_MONITOR, BENCH_APP, load_trivial_model
+
+PAGE_SIZE = mmap.PAGESIZE
+REGION_SIZE = 4 * 1024 * 1024
+# Pages touched between two sleeps: each sleep is a pair of context switches
+SWITCH_EVERY = 64
+
+SCHED_MONITOR = dict(event='finish_task_switch', in_fn_name='sched_switch', type='p', side='k')
+
+PROBES = (('handle_pg_fault', BPF.TRACEPOINT), ('sched_switch', BPF.KPROBE))
+
+def worker(start, stop, results):
+    start.wait()
+    faults = 0
+    while not stop.is_set():
+        region = mmap.mmap(-1, REGION_SIZE)
+        for i, offset in enumerate(range(0, REGION_SIZE, PAGE_SIZE)):
+            region[offset] = 1
+            if i % SWITCH_EVERY == 0:
+                time.sleep(1e-5)
+        region.close()
+        faults += REGION_SIZE // PAGE_SIZE
+    results.put(faults)
+
+def run(bm, fds, n_unrelated, n_tracked, duration, slots):
+    ctx = mp.get_context('fork')
+    start, stop, results = ctx.Event(), ctx.Event(), ctx.Queue()
+    workers = [ctx.Process(target=worker, args=(start, stop, results))
+               for _ in range(n_unrelated + n_tracked)]
+    for w in workers:
+        w.start()
+
+    tracked = workers[:n_tracked]
+    tid_to_rid = bm.ebpf['tid_to_rid']
+    for i, w in enumerate(tracked):
+        tid_to_rid[ct.c_uint32(w.pid)] = ct.c_uint64(i + 1)
+    if slots is not None:
+        bm.set_proc_filter(sorted(w.pid for w in tracked), slots)
+
+    before = {name: prog_fd_stats(fd) for name, fd in fds.items()}
+    start.set()
+    time.sleep(duration)
+    stop.set()
+    faults = sum(results.get() for _ in workers)
+    for w in workers:
+        w.join()
+    after = {name: prog_fd_stats(fd) for name, fd in fds.items()}
+    tid_to_rid.clear()
+    bm.ebpf['datapoints'].clear()
+    bm.ebpf['outlier_scores_m'].clear()
+
+    rows = list()
+    for name in fds:
+        run_cnt = after[name]['run_cnt'] - before[name]['run_cnt']
+        run_time = after[name]['run_time_ns'] - before[name]['run_time_ns']
+        rows.append(dict(probe = name,
+                         unrelated = n_unrelated,
+                         tracked = n_tracked,
+                         faults_per_s = faults / duration,
+                         probe_runs = run_cnt,
+                         probe_avg_ns = run_time / run_cnt if run_cnt else None,
+                         probe_cpu_s = run_time / 1e9))
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark system-wide probes with and without the process filter')
+    parser.add_argument('--unrelated', default=8, type=int, help='Worker processes the agent does not track')
+    parser.add_argument('--tracked', default=1, type=int, help='Worker processes mapped to requests')
+    parser.add_argument('--duration', default=5, type=float, help='Seconds per measurement')
+    parser.add_argument('--slots', default=32, type=int, help='Slots of the process filter')
+    parser.add_argument('--score', action='store_true', default=False,
+                        help='Load a model so probes also update outlier scores')
+    parser.add_argument('--ebpf-prog', default='engine/ebpf_progs/finelame_ebpf.c')
+    args = parser.parse_args()
+
+    with open(BPF_STATS) as f:
+        stats_enabled = f.read().strip()
+    with open(BPF_STATS, 'w') as f:
+        f.write('1')
+    try:
+        for filtered in (False, True):
+            proc_filter = proc_filter_config(dict(slots=args.slots)) if filtered else None
+            prog, _ = rewrite_ebpf(args.ebpf_prog, [BENCH_APP], False, proc_filter=proc_filter)
+            bm = BCCMonitor(prog, {})
+            bm.attach_resource_monitor(PGFAULT_MONITOR)
+            bm.attach_resource_monitor(SCHED_MONITOR)
+            if args.score:
+                load_trivial_model(bm)
+            fds = {name: bm.ebpf.load_func(name, prog_type).fd for name, prog_type in PROBES}
+            for row in run(bm, fds, args.unrelated, args.tracked, args.duration,
+                           args.slots if filtered else None):
+                row.update(filter=filtered, score=args.score)
+                print(json.dumps(row), flush=True)
+            bm.detach_all_monitors()
+            bm.ebpf.cleanup()
+    finally:
+        with open(BPF_STATS, 'w') as f:
+            f.write(stats_enabled)
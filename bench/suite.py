@@ -0,0 +1,216 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Agent benchmarks on synthetic request populations, without root nor a kernel.
+
+Usage (from the repository root):
+    python3 -m bench.suite --output results.json
+    python3 -m bench.suite --cases harvest,train --sizes 1000,100000 --baseline results.json
+
+Cases:
+    harvest  BCCMonitor.get_request_stats
+    train    FinelameDetector.set_train_data, then train_model on the standardized features
+    share    Finelame._train_and_share_model (scaler, k-means, kernel parameters, model swap)
+    dump     Finelame._shutdown in detection mode (test data, scores and model files)
+
+Every (case, size) pair runs in its own process, on an in-memory stand-in for the eBPF
+maps (bench/fake_bpf.py), so that its peak RSS can be reported. Results are written as
+a JSON document. With --baseline, timings are compared with an earlier document and the
+suite exits with status 1 if a case got slower than --tolerance allows.
+'''
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+import numpy as np
+
+from logger import *
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000, 4000000]
+CASES = ['harvest', 'train', 'share', 'dump']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EBPF_PROG = os.path.join(ROOT, 'engine', 'ebpf_progs', 'finelame_ebpf.c')
+
+MODEL_PARAMS = dict(k=3, features=['REQ_CPUTIME', 'REQ_MEM_MALLOC', 'REQ_PGFLT'])
+REQUEST_STATS = dict(REQ_CPUTIME=dict(datapoint='cputime'),
+                     REQ_PGFLT=dict(datapoint='pgfaults'),
+                     REQ_MEM_MALLOC=dict(datapoint='mem_malloc'))
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def make_finelame(workdir, ebpf):
+    from engine.finelame import Finelame
+    cfg = dict(model_params=MODEL_PARAMS,
+               request_stats=REQUEST_STATS,
+               applications=[dict(exec_path=sys.executable, monitors=[])],
+               ebpf_prog=EBPF_PROG,
+               ebpf_cache=dict(cache_dir=os.path.join(workdir, 'cache')),
+               output=dict(format='auto'),
+               train_time=0)
+    cfg_file = os.path.join(workdir, 'fl_cfg.yml')
+    with open(cfg_file, 'w') as f:
+        yaml.safe_dump(cfg, f)
+    return Finelame(cfg_file, 'bench', os.path.join(workdir, 'out'), ano_detect=True, ebpf=ebpf)
+
+def run_case(case, size, workdir):
+    ''' Set the case up, then time it. Returns a dict of results. '''
+    from engine.bcc_monitor import BCCMonitor
+    from engine.finelame import FinelameDetector
+    from engine.ebpf_rewriter import config_layout
+    from bench.fake_bpf import FakeBPF
+    from sklearn.preprocessing import StandardScaler
+
+    # The maps hold the datapoint fields and model features the agent's program would
+    ebpf = FakeBPF(MODEL_PARAMS['k'],
+                   layout=config_layout(dict(request_stats=REQUEST_STATS), MODEL_PARAMS['features']))
+    ebpf.fill_requests(size)
+    phases = dict()
+
+    if case == 'harvest':
+        bm = BCCMonitor(None, REQUEST_STATS, ebpf=ebpf)
+        setup_rss = peak_rss_mb()
+        start = time.time()
+        bm.get_request_stats()
+        phases['get_request_stats'] = time.time() - start
+
+    elif case == 'train':
+        bm = BCCMonitor(None, REQUEST_STATS, ebpf=ebpf)
+        x_train = bm.get_request_stats()
+        FD = FinelameDetector(dict(MODEL_PARAMS))
+        setup_rss = peak_rss_mb()
+        start = time.time()
+        FD.set_train_data(x_train)
+        phases['set_train_data'] = time.time() - start
+        start = time.time()
+        FD.train_model(x_train=StandardScaler().fit_transform(FD.X_train[FD.features]))
+        phases['train_model'] = time.time() - start
+
+    elif case == 'share':
+        FL = make_finelame(workdir, ebpf)
+        FL.FDs[0].set_train_data(FL.BM.get_request_stats())
+        setup_rss = peak_rss_mb()
+        start = time.time()
+        FL._train_and_share_model(0)
+        phases['train_and_share_model'] = time.time() - start
+
+    elif case == 'dump':
+        FL = make_finelame(workdir, ebpf)
+        # A model trained on a small sample: only the dump is measured
+        FL.FDs[0].set_train_data(FL.BM.get_request_stats().head(1000))
+        FL._train_and_share_model(0)
+        FL.mode = 'detection'
+        setup_rss = peak_rss_mb()
+        start = time.time()
+        FL._shutdown()
+        phases['shutdown'] = time.time() - start
+
+    else:
+        raise Exception('Unknown case: %s' % case)
+
+    return dict(case = case,
+                size = size,
+                seconds = sum(phases.values()),
+                phases = phases,
+                setup_peak_rss_mb = setup_rss,
+                peak_rss_mb = peak_rss_mb())
+
+def run_child(case, size):
+    ''' Run a case in a fresh interpreter, so it gets its own peak RSS '''
+    cmd = [sys.executable, '-m', 'bench.suite', '--child', case, str(size)]
+    proc = subprocess.run(cmd, cwd=ROOT, stdout=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        return dict(case=case, size=size, error='exit status {}'.format(proc.returncode))
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    ''' Cases at least (1 + tolerance) times slower than in the baseline '''
+    before = {(r['case'], r['size']): r for r in baseline['results'] if 'seconds' in r}
+    regressions = list()
+    for result in results:
+        ref = before.get((result['case'], result['size']))
+        if ref is None or 'seconds' not in result or ref['seconds'] == 0:
+            continue
+        ratio = result['seconds'] / ref['seconds']
+        if ratio > 1 + tolerance:
+            regressions.append(dict(case=result['case'], size=result['size'],
+                                    seconds=result['seconds'], baseline=ref['seconds'],
+                                    ratio=ratio))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the agent on synthetic requests')
+    parser.add_argument('--cases', default=','.join(CASES), help='Comma-separated cases to run')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='Comma-separated numbers of requests')
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file')
+    parser.add_argument('--baseline', default=None, help='JSON results to compare with')
+    parser.add_argument('--tolerance', default=0.2, type=float,
+                        help='Allowed slowdown relative to the baseline')
+    parser.add_argument('--child', nargs=2, metavar=('CASE', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        with tempfile.TemporaryDirectory() as workdir:
+            result = run_case(args.child[0], int(args.child[1]), workdir)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    results = list()
+    for case in args.cases.split(','):
+        for size in map(int, args.sizes.split(',')):
+            result = run_child(case, size)
+            log_info('%s', json.dumps(result))
+            results.append(result)
+
+    report = dict(revision = git_revision(),
+                  timestamp = time.time(),
+                  python = platform.python_version(),
+                  numpy = np.__version__,
+                  results = results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            log_warn('Regression: %s', json.dumps(regression))
+        if regressions:
+            sys.exit(1)
@@ -21,14 +21,23 @@ END OF LICENSE STUB
 #!/usr/bin/python
 
 from __future__ import print_function
-from bcc import BPF, PerfType, PerfHWConfig
-from bcc import DEBUG_SOURCE, DEBUG_PREPROCESSOR, DEBUG_LLVM_IR, DEBUG_BPF_REGISTER_STATE, DEBUG_BPF
+try:
+    from bcc import BPF, PerfType, PerfHWConfig
+    from bcc import DEBUG_SOURCE, DEBUG_PREPROCESSOR, DEBUG_LLVM_IR, DEBUG_BPF_REGISTER_STATE, DEBUG_BPF
+except ImportError:
+    # Only an already loaded program (see BCCMonitor) can be used without bcc
+    BPF = None
 from time import sleep, strftime
 import argparse
 from logger import *
 import time
 import pandas as pd
-from ctypes import c_uint8, c_uint32
+import numpy as np
+import ctypes as ct
+from ctypes import c_uint8, c_uint32, c_uint64
+from .harvest import MapHarvester, split_keys, reduce_percpu, ctypes_dtype
+from .ebpf_rewriter import app_fn_name
+from .metrics import METRICS
 
 class FLMonitorException(Exception):
     pass
@@ -126,18 +135,76 @@ class Monitor(object):
                                ev_config=eval('PerfHWConfig.'+self.event))
         log_info('Detached hardware monitor ({})'.format('PerfHWConfig.'+self.event))
 
+BPF_STATS = '/proc/sys/kernel/bpf_stats_enabled'
+
+def prog_fd_stats(fd):
+    '''
+    run_time_ns and run_cnt of a loaded program, from its fdinfo. Both stay at 0 unless
+    kernel.bpf_stats_enabled is set.
+    '''
+    stats = dict(run_time_ns=0, run_cnt=0)
+    with open('/proc/self/fdinfo/{}'.format(fd)) as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in stats:
+                stats[name] = int(value)
+    return stats
+
+# Sample rates are fractions of FL_SAMPLE_SCALE in the eBPF program
+SAMPLE_SCALE = 1 << 16
+
+# Indexes of the fl_stats counters of the eBPF program
+FL_STAT_DP_INSERTS = 0
+FL_STAT_DP_FULL = 1
+FL_STAT_SCORE_INSERTS = 2
+FL_STAT_SCORE_FULL = 3
+
+# How per-CPU copies of a datapoint are combined: counters are summed, timestamps are not
+PERCPU_MAX_FIELDS = ('latest_ts_update', 'last_tcp_rcv_ts', 'last_unmap_ts', 'saddr')
+PERCPU_MIN_FIELDS = ('first_ts',)
+
 class BCCMonitor():
-    def __init__(self, ebpf_prog, request_stats, max_stats=1024):
+    def __init__(self, ebpf_prog, request_stats, max_stats=1024, percpu=False, ebpf=None, maps=None):
+        '''
+        Compile and load ebpf_prog, unless an object with the BPF interface is given as
+        ebpf, in which case it is used as is (e.g. an in-memory stand-in for benchmarks).
+        maps is the tracking map configuration the program was built with (see map_config).
+        '''
         self.max_stats = max_stats
+        self.percpu = percpu
+        self.maps = maps or dict()
         self.monitors = []
         self.hw_monitors = []
         self.request_stats = request_stats
-        try:
-            self.ebpf = BPF(src_file=ebpf_prog, cflags=['-Wall'])
-            #self.ebpf = BPF(src_file=ebpf_prog, cflags=['-Wall'], debug=DEBUG_BPF)#, '-Wsign-conversion'])#, '-ftrapv'])
-        except Exception as e:
-            log_info("ERROR WHEN PARSING EBPF PROG {}".format(ebpf_prog))
-            raise
+        self.harvester = MapHarvester()
+        self.n_deleted = dict(datapoints = 0, outlier_scores_m = 0)
+        self.n_evicted = dict(datapoints = 0, outlier_scores_m = 0)
+        # Entries of the thread maps, as of their last sweep
+        self.n_threads = dict()
+        self.bpf_stats_enabled = None
+        if ebpf is not None:
+            self.ebpf = ebpf
+        else:
+            if BPF is None:
+                raise FLMonitorException("bcc is needed to load eBPF programs")
+            try:
+                self.ebpf = BPF(src_file=ebpf_prog, cflags=['-Wall'])
+                #self.ebpf = BPF(src_file=ebpf_prog, cflags=['-Wall'], debug=DEBUG_BPF)#, '-Wsign-conversion'])#, '-ftrapv'])
+            except Exception as e:
+                log_info("ERROR WHEN PARSING EBPF PROG {}".format(ebpf_prog))
+                raise
+        self._check_layout()
+
+    def _check_layout(self):
+        '''
+        Datapoints are decoded with the layout the loaded program declares (bcc builds
+        the map's Leaf type from it): request_stats may only read fields it holds.
+        '''
+        fields = [name for name, _ in self.ebpf['datapoints'].Leaf._fields_]
+        for req_stat_name, req_stat in self.request_stats.items():
+            if req_stat['datapoint'] not in fields:
+                raise FLMonitorException('{} reads datapoint field {}, which the eBPF program does not hold'
+                                         .format(req_stat_name, req_stat['datapoint']))
 
     def attach_hardware_monitor(self, cfg):
         log_info("Attaching a hardware monitor%s", cfg)
@@ -161,37 +228,353 @@ class BCCMonitor():
             monitor.attach(self.ebpf)
             self.monitors.append(monitor)
 
-    def attach_application_monitor(self, exec_path, cfg):
+    def attach_application_monitor(self, exec_path, cfg, app_id=0):
+        ''' Attach the copy of a request mapper generated for application app_id '''
         if 'in_fn_name' in cfg:
-            monitor = Monitor(cfg['event'], cfg['in_fn_name'], False, exec_path=exec_path)
+            monitor = Monitor(cfg['event'], app_fn_name(cfg['in_fn_name'], app_id), False,
+                              exec_path=exec_path)
             monitor.attach(self.ebpf)
             self.monitors.append(monitor)
         if 'ret_fn_name' in cfg:
-            monitor = Monitor(cfg['event'], cfg['ret_fn_name'], True, exec_path=exec_path)
+            monitor = Monitor(cfg['event'], app_fn_name(cfg['ret_fn_name'], app_id), True,
+                              exec_path=exec_path)
             monitor.attach(self.ebpf)
             self.monitors.append(monitor)
 
+    def attached_probes(self):
+        ''' Program function names of the attached resource and hardware monitors '''
+        return [monitor.fn_name for monitor in self.monitors + self.hw_monitors]
+
+    def detach_monitors(self, fn_names):
+        ''' Detach the monitors running any of fn_names, returning how many were '''
+        detached = 0
+        for monitor in [m for m in self.monitors if m.fn_name in fn_names]:
+            monitor.detach(self.ebpf)
+            self.monitors.remove(monitor)
+            detached += 1
+        for monitor in [m for m in self.hw_monitors if m.fn_name in fn_names]:
+            monitor.detach_hw(self.ebpf)
+            self.hw_monitors.remove(monitor)
+            detached += 1
+        return detached
+
     def detach_all_monitors(self):
         for monitor in self.monitors:
             monitor.detach(self.ebpf)
         for monitor in self.hw_monitors:
             monitor.detach_hw(self.ebpf)
 
-    def get_request_stats(self):
-        record_start = time.time()
+    def datapoints_frame(self, keys, values):
+        apps, rids = split_keys(keys)
+        columns = dict(app = apps, req_id = rids)
+        for req_stat_name, req_stat in self.request_stats.items():
+            columns[req_stat_name] = values[req_stat['datapoint']]
+        return pd.DataFrame(columns)
+
+    def _is_lru(self, name):
+        return self.maps.get(name, {}).get('type') == 'lru'
 
-        datapoints = self.ebpf['datapoints']
+    def _n_inserted(self, name):
+        idx = FL_STAT_DP_INSERTS if name == 'datapoints' else FL_STAT_SCORE_INSERTS
+        return self.ebpf['fl_stats'].sum(idx).value
 
-        buffer = []
-        for dp_k, dp_v in datapoints.items():
-            datapoint = dict(req_id = dp_k.value)
-            for req_stat_name, req_stat in self.request_stats.items():
-                datapoint[req_stat_name] = getattr(dp_v, req_stat['datapoint'])
+    def _count_evictions(self, name, n_inserted, n_entries):
+        '''
+        LRU maps drop entries without telling: those inserted before a harvest that were
+        neither deleted nor harvested were evicted. Insertions racing with the harvest
+        make this a lower bound.
+        '''
+        evicted = n_inserted - self.n_deleted[name] - n_entries
+        self.n_evicted[name] = max(self.n_evicted[name], evicted)
+
+    def harvest_datapoints(self):
+        ''' Read the datapoints map, combining per-CPU copies if need be '''
+        harvest_start = time.time()
+        n_inserted = self._n_inserted('datapoints') if self._is_lru('datapoints') else None
+        keys, values = self.harvester.harvest(self.ebpf['datapoints'])
+        if n_inserted is not None:
+            self._count_evictions('datapoints', n_inserted, len(keys))
+        if self.percpu:
+            values = reduce_percpu(values, PERCPU_MAX_FIELDS, PERCPU_MIN_FIELDS)
+        METRICS.observe('finelame_phase_duration_seconds', time.time() - harvest_start,
+                        phase='harvest', map='datapoints')
+        return keys, values
+
+    def harvest_scores(self):
+        ''' Read the outlier scores map '''
+        harvest_start = time.time()
+        n_inserted = self._n_inserted('outlier_scores_m') if self._is_lru('outlier_scores_m') else None
+        keys, values = self.harvester.harvest(self.ebpf['outlier_scores_m'])
+        if n_inserted is not None:
+            self._count_evictions('outlier_scores_m', n_inserted, len(keys))
+        METRICS.observe('finelame_phase_duration_seconds', time.time() - harvest_start,
+                        phase='harvest', map='outlier_scores_m')
+        return keys, values
 
-            buffer.append(datapoint)
+    def get_request_stats(self):
+        record_start = time.time()
 
-        log_info("Recorded data from eBPF map in %.1f seconds", time.time() - record_start)
+        keys, values = self.harvest_datapoints()
+        df = self.datapoints_frame(keys, values)
 
-        df = pd.DataFrame(buffer)
+        elapsed = time.time() - record_start
+        log_info("Recorded %d datapoints from eBPF map in %.3f seconds (%.0f rows/s)",
+                 len(df), elapsed, len(df) / elapsed if elapsed > 0 else 0)
 
         return df
+
+    def scores_frame(self, keys, values):
+        dists = values['distances']
+        if dists.ndim == 1:
+            dists = dists.reshape(-1, 1)
+        idx = np.argmin(np.abs(dists), axis=1)
+        apps, rids = split_keys(keys)
+        columns = dict(app = apps,
+                       req_id = rids,
+                       score = dists[np.arange(len(dists)), idx],
+                       detection_ts = values['detection_ts'],
+                       detection_cputime = values['detection_cputime'],
+                       last_ts = values['last_ts'],
+                       is_outlier = values['is_outlier'])
+        for i in range(dists.shape[1]):
+            columns['score_%d' % i] = dists[:, i]
+        return pd.DataFrame(columns)
+
+    def lookup_datapoints(self, keys):
+        '''
+        Datapoints of a few requests, looked up one by one and combining per-CPU copies
+        if need be. Returns the keys still in the map and their values.
+        '''
+        table = self.ebpf['datapoints']
+        dtype = ctypes_dtype(table.Leaf)
+        found, values = list(), list()
+        for key in keys:
+            try:
+                leaf = table[table.Key(int(key))]
+            except KeyError:
+                continue
+            copies = leaf if self.percpu else [leaf]
+            values.append(np.frombuffer(b''.join(ct.string_at(ct.addressof(c), ct.sizeof(c)) for c in copies),
+                                        dtype=dtype))
+            found.append(key)
+        if not values:
+            return np.array(found, dtype=np.uint64), np.empty(0, dtype=dtype)
+        values = np.stack(values)
+        if self.percpu:
+            values = reduce_percpu(values, PERCPU_MAX_FIELDS, PERCPU_MIN_FIELDS)
+        else:
+            values = values[:, 0]
+        return np.array(found, dtype=np.uint64), values
+
+    def get_outlier_scores(self):
+        keys, values = self.harvest_scores()
+        return self.scores_frame(keys, values)
+
+    def delete_requests(self, dp_keys, score_keys):
+        ''' Evict requests from the datapoints and outlier scores maps '''
+        n_dp = self.harvester.delete(self.ebpf['datapoints'], dp_keys)
+        n_scores = self.harvester.delete(self.ebpf['outlier_scores_m'], score_keys)
+        self.n_deleted['datapoints'] += n_dp
+        self.n_deleted['outlier_scores_m'] += n_scores
+        return n_dp, n_scores
+
+    def harvest_threads(self, name):
+        ''' Thread ids held by a thread map (tid_to_rid or start) '''
+        keys, _ = self.harvester.harvest(self.ebpf[name])
+        self.n_threads[name] = len(keys)
+        return keys
+
+    def mapped_requests(self):
+        ''' Keys of the requests at least one thread is mapped to, from tid_to_rid '''
+        keys, values = self.harvester.harvest(self.ebpf['tid_to_rid'])
+        self.n_threads['tid_to_rid'] = len(keys)
+        return np.unique(values)
+
+    def delete_threads(self, name, tids):
+        n_deleted = self.harvester.delete(self.ebpf[name], tids)
+        self.n_threads[name] = self.n_threads.get(name, n_deleted) - n_deleted
+        return n_deleted
+
+    def read_counters(self, name):
+        ''' Values of a per-CPU array of counters, summed over CPUs, as a NumPy array '''
+        table = self.ebpf[name]
+        keys, values = self.harvester.harvest(table)
+        if values.ndim > 1:
+            values = values.sum(axis=1)
+        counts = np.zeros(len(table), dtype=np.uint64)
+        counts[keys.astype(np.int64)] = values
+        return counts
+
+    def harvest_flagged(self):
+        ''' Read the requests the probes flagged as outliers since the last deletion '''
+        return self.harvester.harvest(self.ebpf['flagged'])
+
+    def delete_flagged(self, keys):
+        return self.harvester.delete(self.ebpf['flagged'], keys)
+
+    def set_verdicts(self, keys, verdicts, scores, ts):
+        ''' Record the detection cascade's verdict on candidate requests (FL_VERDICT_*) '''
+        table = self.ebpf['verdicts']
+        for key, verdict, score in zip(keys, verdicts, scores):
+            leaf = table.Leaf()
+            leaf.ts = ts
+            leaf.score = int(score)
+            leaf.verdict = int(verdict)
+            table[table.Key(int(key))] = leaf
+
+    def delete_verdicts(self, keys):
+        return self.harvester.delete(self.ebpf['verdicts'], keys)
+
+    def set_proc_filter(self, tgids, slots):
+        ''' Publish the thread group ids system-wide probes account for; too many turn the filter off '''
+        table = self.ebpf['proc_filter']
+        leaf = table.Leaf()
+        if len(tgids) > slots:
+            leaf.n = slots + 1
+        else:
+            leaf.n = len(tgids)
+            for i, tgid in enumerate(tgids):
+                leaf.tgids[i] = tgid
+        table[table.Key(0)] = leaf
+
+    def block_source(self, saddr, expiry_ns=0):
+        ''' Add an address to the blocklist map, until expiry_ns (bpf_ktime_get_ns time, 0 for never) '''
+        self.ebpf['blocklist'][c_uint32(saddr)] = c_uint64(expiry_ns)
+
+    def unblock_sources(self, saddrs):
+        blocklist = self.ebpf['blocklist']
+        for saddr in saddrs:
+            try:
+                del blocklist[c_uint32(saddr)]
+            except KeyError:
+                pass
+
+    def blocked_sources(self):
+        ''' Blocked addresses and their expiry '''
+        return {k.value: v.value for k, v in self.ebpf['blocklist'].items()}
+
+    def enable_prog_stats(self):
+        '''
+        Have the kernel account the run time of BPF programs (a couple of clock reads per
+        run), until restore_prog_stats. Returns whether statistics are enabled.
+        '''
+        if self.bpf_stats_enabled is not None:
+            return True
+        try:
+            with open(BPF_STATS) as f:
+                enabled = f.read().strip()
+            with open(BPF_STATS, 'w') as f:
+                f.write('1')
+        except OSError as e:
+            log_warn('Could not enable BPF statistics: {}'.format(e))
+            return False
+        self.bpf_stats_enabled = enabled
+        return True
+
+    def restore_prog_stats(self):
+        if self.bpf_stats_enabled is not None:
+            with open(BPF_STATS, 'w') as f:
+                f.write(self.bpf_stats_enabled)
+            self.bpf_stats_enabled = None
+
+    def prog_stats(self):
+        ''' run_time_ns and run_cnt of every loaded program, by function name '''
+        stats = dict()
+        for name, fn in getattr(self.ebpf, 'funcs', {}).items():
+            if isinstance(name, bytes):
+                name = name.decode()
+            stats[name] = prog_fd_stats(fn.fd)
+        return stats
+
+    def collect_metrics(self, metrics, app_names, footprint=None):
+        '''
+        Set the metrics kept in the kernel: program statistics, request map occupancy
+        (entries the program inserted minus those the agent deleted, or LRU maps evicted)
+        and outlier counts. With the tracking maps' footprint (see map_footprint), their
+        memory use is set as well: their full size if preallocated, else what their
+        entries take.
+        '''
+        for name, stats in self.prog_stats().items():
+            metrics.set('finelame_prog_run_count_total', stats['run_cnt'], prog=name)
+            metrics.set('finelame_prog_run_time_seconds_total', stats['run_time_ns'] / 1e9, prog=name)
+
+        fl_stats = self.ebpf['fl_stats']
+        entries = dict(self.n_threads)
+        for name, inserts, full in (('datapoints', FL_STAT_DP_INSERTS, FL_STAT_DP_FULL),
+                                    ('outlier_scores_m', FL_STAT_SCORE_INSERTS, FL_STAT_SCORE_FULL)):
+            n_entries = fl_stats.sum(inserts).value - self.n_deleted[name] - self.n_evicted[name]
+            entries[name] = max(n_entries, 0)
+            metrics.set('finelame_map_insert_failures_total', fl_stats.sum(full).value, map=name)
+            if self._is_lru(name):
+                metrics.set('finelame_map_evictions_total', self.n_evicted[name], map=name)
+            capacity = getattr(self.ebpf[name], 'max_entries', None)
+            if capacity is not None:
+                metrics.set('finelame_map_capacity', capacity, map=name)
+        for name, n_entries in entries.items():
+            metrics.set('finelame_map_entries', n_entries, map=name)
+        for name, fp in (footprint or {}).items():
+            if fp['prealloc']:
+                metrics.set('finelame_map_memory_bytes', fp['total'], map=name)
+            elif name in entries:
+                metrics.set('finelame_map_memory_bytes', fp['entry_size'] * entries[name], map=name)
+
+        outlier_counts = self.ebpf['outlier_counts']
+        for app, app_name in enumerate(app_names):
+            metrics.set('finelame_outliers_total', outlier_counts.sum(app).value, app=app_name)
+            metrics.set('finelame_model_version', self.get_model(app)['version'], app=app_name)
+
+    def set_sample_rate(self, rate, app=0):
+        ''' Share of an application's new requests the mappers track, between 0 and 1 '''
+        self.ebpf['sample_rate'][app] = c_uint32(int(round(min(max(rate, 0), 1) * SAMPLE_SCALE)))
+
+    def get_sample_counts(self, app=0):
+        ''' Requests of an application seen by the mappers, and how many were tracked '''
+        seen, sampled = 0, 0
+        for counts in self.ebpf['sample_counts'][app]:
+            seen += counts.seen
+            sampled += counts.sampled
+        return seen, sampled
+
+    def load_model(self, params, app=0):
+        '''
+        Write an application's model into its inactive slot of the models map, then
+        activate it by flipping active_model. Probes thus always see one complete model.
+        Returns the new model version and the time the swap took.
+        '''
+        models = self.ebpf['models']
+        active = self.ebpf['active_model']
+
+        swap_start = time.time()
+        slot = app * 2 + (active[app].value ^ 1)
+        version = max(models[app * 2].version, models[app * 2 + 1].version) + 1
+
+        model = models.Leaf()
+        model.version = version
+        model.centroid_offset = params['centroid_offset']
+        for i, l1 in enumerate(params['centroid_l1s']):
+            model.centroid_l1s[i] = l1
+        for i, threshold in enumerate(params['cluster_thresholds']):
+            model.cluster_thresholds[i] = threshold
+        for i, param in enumerate(params['train_set_params']):
+            model.train_set_params[i] = param
+        for i, (mult, shift) in enumerate(zip(params['norm_mult'], params['norm_shift'])):
+            model.norm[i].mult = mult
+            model.norm[i].shift = shift
+
+        models[slot] = model
+        active[app] = c_uint32(slot & 1)
+
+        swap_latency = time.time() - swap_start
+        METRICS.observe('finelame_phase_duration_seconds', swap_latency, phase='swap')
+        return version, swap_latency
+
+    def get_model(self, app=0):
+        ''' Parameters of the model the probes currently use for an application '''
+        model = self.ebpf['models'][app * 2 + self.ebpf['active_model'][app].value]
+        return dict(version = model.version,
+                    centroid_offset = model.centroid_offset,
+                    centroid_l1s = list(model.centroid_l1s),
+                    cluster_thresholds = list(model.cluster_thresholds),
+                    norm_mult = [norm.mult for norm in model.norm],
+                    norm_shift = [norm.shift for norm in model.norm],
+                    train_set_params = list(model.train_set_params))
@@ -0,0 +1,368 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Two-stage detection. The probes can only afford an L1 distance to k centroids per
+resource event, so with a cascade the thresholds they get are loosened by the screen
+factor and the requests they flag are only candidates. The agent scores candidates
+again, in micro-batches, with a second-stage model of the same clusters:
+    mahalanobis: distance to each centroid under its cluster's covariance
+    euclidean: distance to each centroid in standardized space
+Each cluster's threshold is the mean plus sigmas standard deviations of the distances
+of its training points. Without training data (saved models, models from the
+collector), candidates are scored with the unloosened kernel model instead.
+Verdicts go to the verdicts map (FL_VERDICT_*) and, for outliers, to the mitigation.
+'''
+
+import collections
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from logger import *
+from .harvest import split_keys, APP_SHIFT
+from .metrics import METRICS
+from .fixed_point import kernel_normalize, kernel_decide
+from .mitigation import format_addr
+from .notification import EVT_OUTLIER
+
+# Must match FL_VERDICT_* in the eBPF program
+VERDICT_OUTLIER = 1
+VERDICT_CLEARED = 2
+VERDICT_NAMES = {VERDICT_OUTLIER: 'outlier', VERDICT_CLEARED: 'cleared'}
+
+METRICS_NAMES = ('mahalanobis', 'euclidean')
+
+DEFAULT_SCREEN = 0.5
+DEFAULT_METRIC = 'mahalanobis'
+DEFAULT_SIGMAS = 5
+DEFAULT_INTERVAL = 0.01
+DEFAULT_BATCH_SIZE = 1024
+DEFAULT_SWEEP_INTERVAL = 1
+DEFAULT_TTL = 60
+
+# Ridge added to cluster covariances, so that constant features do not make them singular
+COV_RIDGE = 1e-6
+
+NS_PER_S = 1000 * 1000 * 1000
+
+class SecondStage():
+    '''
+    Distances of standardized rows to the centroids, and per-cluster thresholds.
+    Features outside mask (dropped from the model) are left out.
+    '''
+    def __init__(self, metric, scaler, centers, X, labels, sigmas, mask=None):
+        self.metric = metric
+        self.mask = mask
+        self.mean = np.asarray(scaler.mean_, dtype=np.float64)
+        self.scale = np.where(scaler.scale_ == 0, 1, scaler.scale_)
+        self.centers = np.asarray(centers, dtype=np.float64)
+        k, n_features = self.centers.shape
+        Z = self.standardize(X)
+        self.inv_covs = np.tile(np.eye(n_features), (k, 1, 1))
+        if metric == 'mahalanobis':
+            for c in range(k):
+                Zc = Z[labels == c]
+                if len(Zc) > n_features:
+                    cov = np.cov(Zc, rowvar=False).reshape(n_features, n_features)
+                    self.inv_covs[c] = np.linalg.pinv(cov + COV_RIDGE * np.eye(n_features))
+        distances = self.distances(Z)
+        # As in the kernel, clusters without points get no threshold and are never the closest
+        self.thresholds = np.zeros(k)
+        for c in range(k):
+            d = distances[labels == c, c]
+            if len(d):
+                self.thresholds[c] = d.mean() + sigmas * d.std()
+
+    def standardize(self, X):
+        Z = (np.asarray(X, dtype=np.float64) - self.mean) / self.scale
+        if self.mask is not None:
+            Z[:, ~self.mask] = 0
+        return Z
+
+    def distances(self, Z):
+        diffs = Z[:, None, :] - self.centers[None, :, :]
+        return np.sqrt(np.maximum(np.einsum('nki,kij,nkj->nk', diffs, self.inv_covs, diffs), 0))
+
+    def score(self, X):
+        ''' Distance to the closest cluster with a threshold, and whether it is past it '''
+        distances = self.distances(self.standardize(X))
+        valid = self.thresholds > 0
+        closest = np.argmin(np.where(valid, distances, np.inf), axis=1)
+        score = distances[np.arange(len(distances)), closest]
+        return score, valid.any() & (score > self.thresholds[closest])
+
+class KernelStage():
+    ''' The kernel model with its own thresholds, for applications without a second stage '''
+    def __init__(self, params):
+        self.mult = np.asarray(params['norm_mult'], dtype=np.uint64)
+        self.shift = np.asarray(params['norm_shift'], dtype=np.uint64)
+        self.centroid_l1s = np.asarray(params['centroid_l1s'], dtype=np.int64)
+        self.centroid_offset = int(params['centroid_offset'])
+        self.thresholds = np.asarray(params['cluster_thresholds'], dtype=np.int64)
+
+    def score(self, X):
+        X = np.asarray(X, dtype=np.int64)
+        # Models read back from the kernel hold a normalization for every feature slot
+        n_features = X.shape[1]
+        totals = kernel_normalize(X, self.mult[:n_features], self.shift[:n_features]).sum(axis=1)
+        distances = totals[:, None] - self.centroid_l1s[None, :] - self.centroid_offset
+        return kernel_decide(distances, self.thresholds)
+
+class Cascade():
+    '''
+    Scores the candidates the probes flag. Candidates come from outlier events
+    (on_events, on the event loop) and from the flagged map (sweep), and are scored
+    by process every interval seconds, batch_size at a time; the flagged map is swept
+    every sweep_interval seconds. A cleared candidate is
+    scored again on its final totals when it is drained (recheck), since the probes
+    flag a request only once. Confirmed outliers are handed to on_confirm, as a list
+    of (request key, flag) in the mitigation's format.
+    '''
+
+    def __init__(self, bm, features, app_names, screen=DEFAULT_SCREEN, metric=DEFAULT_METRIC,
+                 sigmas=DEFAULT_SIGMAS, interval=DEFAULT_INTERVAL, batch_size=DEFAULT_BATCH_SIZE,
+                 sweep_interval=DEFAULT_SWEEP_INTERVAL, ttl=DEFAULT_TTL, on_confirm=None):
+        if metric not in METRICS_NAMES:
+            raise Exception('Unknown second-stage metric {} ({})'.format(metric, ', '.join(METRICS_NAMES)))
+        if not 0 < screen <= 1:
+            raise Exception('The cascade screen factor must be in (0, 1], not {}'.format(screen))
+        self.BM = bm
+        self.features = features
+        self.fields = [bm.request_stats[f]['datapoint'] for f in features]
+        self.app_names = app_names
+        self.screen = screen
+        self.metric = metric
+        self.sigmas = sigmas
+        self.interval = interval
+        self.batch_size = batch_size
+        self.sweep_interval = sweep_interval
+        self.ttl = ttl
+        self.on_confirm = on_confirm
+
+        n_apps = len(app_names)
+        self.stages = [None] * n_apps
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        # Candidates queued or scored by key, when they were seen
+        self.seen = dict()
+        # Cleared candidates by key, when they were cleared and the candidate itself
+        self.cleared = dict()
+        self.verdict_ts = dict()
+        self.latencies = collections.deque(maxlen=100000)
+        self.records = list()
+        self.counts = dict(candidates = np.zeros(n_apps, dtype=np.int64),
+                           completed = np.zeros(n_apps, dtype=np.int64),
+                           outliers = np.zeros(n_apps, dtype=np.int64),
+                           cleared = np.zeros(n_apps, dtype=np.int64),
+                           expired = np.zeros(n_apps, dtype=np.int64))
+        self.n_scored = 0
+        self.busy_time = 0.
+        METRICS.histogram('finelame_cascade_latency_seconds')
+
+    def screen_params(self, params):
+        ''' Kernel parameters with the thresholds loosened into candidate thresholds '''
+        return dict(params, cluster_thresholds = [int(t * self.screen) for t in params['cluster_thresholds']])
+
+    def set_kernel_model(self, app_id, params):
+        ''' A model is loaded: score candidates with it until a second stage is fitted '''
+        with self.lock:
+            self.stages[app_id] = KernelStage(params)
+
+    def set_model(self, app_id, scaler, centers, X, labels, mask=None):
+        '''
+        Fit the second stage of an application on the model's training set: raw feature
+        rows X, their cluster labels, the scaler, the (standardized) centroids and the
+        features the model uses
+        '''
+        fit_start = time.time()
+        stage = SecondStage(self.metric, scaler, centers, X, labels, self.sigmas, mask)
+        with self.lock:
+            self.stages[app_id] = stage
+        log_info('Fitted the {} second stage of {} in {:.3f} seconds, thresholds {}'.format(
+                 self.metric, self.app_names[app_id], time.time() - fit_start,
+                 np.round(stage.thresholds, 3).tolist()))
+
+    def _add(self, key, detection_ts, kernel_score, saddr, cputime, now):
+        if key in self.seen:
+            return
+        self.seen[key] = now
+        self.queue.append((key, detection_ts, kernel_score, saddr, cputime))
+        app = key >> APP_SHIFT
+        self.counts['candidates'][app] += 1
+        METRICS.inc('finelame_cascade_candidates_total', app=self.app_names[app])
+
+    def on_events(self, events):
+        ''' Queue the candidates of a decoded batch of events '''
+        outliers = events[events['type'] == EVT_OUTLIER]
+        now = time.monotonic()
+        with self.lock:
+            for evt in outliers:
+                self._add(int(evt['req_id']), int(evt['ts']), int(evt['score']), int(evt['saddr']),
+                          int(evt['cputime']), now)
+
+    def sweep(self):
+        '''
+        Queue the flagged requests no event was received for, then clear the flagged map,
+        and the verdicts and candidates older than ttl
+        '''
+        keys, values = self.BM.harvest_flagged()
+        now = time.monotonic()
+        with self.lock:
+            for key, value in zip(keys, values):
+                self._add(int(key), int(value['detection_ts']), int(value['score']), int(value['saddr']),
+                          None, now)
+            expired = [key for key, ts in self.verdict_ts.items() if now - ts > self.ttl]
+            for key in expired:
+                del self.verdict_ts[key]
+            self.seen = {k: t for k, t in self.seen.items() if now - t < self.ttl}
+            self.cleared = {k: c for k, c in self.cleared.items() if now - c[0] < self.ttl}
+        self.BM.delete_flagged(keys)
+        if expired:
+            self.BM.delete_verdicts(np.array(expired, dtype=np.uint64))
+
+    def _take(self):
+        batch = list()
+        while self.queue and len(batch) < self.batch_size:
+            batch.append(self.queue.popleft())
+        return batch
+
+    def process(self):
+        ''' Score the queued candidates, batch_size at a time '''
+        while True:
+            with self.lock:
+                batch = self._take()
+            if not batch:
+                return
+            self._process(batch)
+
+    def _process(self, batch):
+        process_start = time.time()
+        keys = np.array([c[0] for c in batch], dtype=np.uint64)
+        found, values = self.BM.lookup_datapoints(keys)
+        found_set = set(found.tolist())
+        for key in keys.tolist():
+            if key not in found_set:
+                # Drained before it could be scored
+                app = key >> APP_SHIFT
+                self.counts['expired'][app] += 1
+                METRICS.inc('finelame_cascade_verdicts_total', app=self.app_names[app], verdict='expired')
+        if len(found):
+            X = np.stack([values[field] for field in self.fields], axis=1)
+            candidates = {c[0]: c for c in batch}
+            self._decide(found, X, [candidates[key] for key in found.tolist()], 'stage2')
+        elapsed = time.time() - process_start
+        self.n_scored += len(batch)
+        self.busy_time += elapsed
+        if elapsed > 0:
+            METRICS.set('finelame_cascade_throughput', len(batch) / elapsed)
+        METRICS.observe('finelame_phase_duration_seconds', elapsed, phase='cascade')
+
+    def _decide(self, keys, X, candidates, path):
+        ''' Score candidates per application, write their verdicts and confirm outliers '''
+        apps, rids = split_keys(keys)
+        confirmed = list()
+        ts = time.monotonic_ns()
+        now = time.monotonic()
+        for app_id in np.unique(apps):
+            with self.lock:
+                stage = self.stages[app_id]
+            if stage is None:
+                continue
+            rows = np.flatnonzero(apps == app_id)
+            scores, is_outlier = stage.score(X[rows])
+            verdicts = np.where(is_outlier, VERDICT_OUTLIER, VERDICT_CLEARED)
+            # Verdict scores are kept in thousandths of a distance unit for second stages
+            kernel_scores = scores if isinstance(stage, KernelStage) else scores * 1000
+            self.BM.set_verdicts(keys[rows], verdicts, kernel_scores, ts)
+            name = self.app_names[app_id]
+            for row, score, verdict in zip(rows, scores, verdicts):
+                key, detection_ts, kernel_score, saddr, cputime = candidates[row]
+                latency = (ts - detection_ts) / NS_PER_S
+                if path == 'stage2':
+                    self.latencies.append(latency)
+                    METRICS.observe_hist('finelame_cascade_latency_seconds', latency)
+                METRICS.inc('finelame_cascade_verdicts_total', app=name, verdict=VERDICT_NAMES[verdict])
+                with self.lock:
+                    self.verdict_ts[key] = now
+                    if path == 'recheck':
+                        # The final verdict replaces the one the candidate was cleared with
+                        self.counts['cleared'][app_id] -= 1
+                    if verdict == VERDICT_OUTLIER:
+                        self.counts['outliers'][app_id] += 1
+                        self.cleared.pop(key, None)
+                    else:
+                        self.counts['cleared'][app_id] += 1
+                        if path == 'stage2':
+                            self.cleared[key] = (now, candidates[row])
+                self.records.append(dict(app = int(app_id), rid = int(rids[row]), kernel_score = kernel_score,
+                                         score = float(score), verdict = VERDICT_NAMES[verdict],
+                                         detection_ts = detection_ts, latency = latency, path = path))
+                if verdict == VERDICT_OUTLIER:
+                    confirmed.append((key, dict(app = int(app_id), rid = int(rids[row]), saddr = saddr,
+                                                addr = format_addr(saddr), score = kernel_score,
+                                                cputime = cputime, detection_ts = detection_ts)))
+        if confirmed and self.on_confirm is not None:
+            self.on_confirm(confirmed)
+
+    def recheck(self, datapoints):
+        '''
+        Count drained requests, and score the cleared candidates among them again on
+        their final totals
+        '''
+        if datapoints.empty:
+            return
+        self.counts['completed'] += np.bincount(datapoints.app.to_numpy(dtype=np.int64),
+                                                minlength=len(self.app_names))[:len(self.app_names)]
+        for app_id, name in enumerate(self.app_names):
+            if self.counts['completed'][app_id]:
+                METRICS.set('finelame_cascade_candidate_rate',
+                            self.counts['candidates'][app_id] / self.counts['completed'][app_id], app=name)
+        if not self.cleared:
+            return
+        keys = (datapoints.app.to_numpy(dtype=np.uint64) << np.uint64(APP_SHIFT)) | \
+               datapoints.req_id.to_numpy(dtype=np.uint64)
+        with self.lock:
+            cleared = np.array([key in self.cleared for key in keys.tolist()], dtype=bool)
+            candidates = [self.cleared.pop(key)[1] for key in keys[cleared].tolist()]
+        if candidates:
+            self._decide(keys[cleared], datapoints[cleared][self.features].to_numpy(), candidates, 'recheck')
+
+    def take_records(self):
+        ''' Verdicts given since the last call, one row per candidate '''
+        records, self.records = self.records, list()
+        return pd.DataFrame(records, columns=['app', 'rid', 'kernel_score', 'score', 'verdict',
+                                              'detection_ts', 'latency', 'path'])
+
+    def stats(self):
+        n_candidates = int(self.counts['candidates'].sum())
+        n_completed = int(self.counts['completed'].sum())
+        stats = dict(candidates = n_candidates,
+                     outliers = int(self.counts['outliers'].sum()),
+                     cleared = int(self.counts['cleared'].sum()),
+                     expired = int(self.counts['expired'].sum()),
+                     candidate_rate = n_candidates / n_completed if n_completed else None,
+                     throughput = self.n_scored / self.busy_time if self.busy_time > 0 else None)
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1e3
+            stats.update(latency_p50_ms = float(np.percentile(latencies, 50)),
+                         latency_p99_ms = float(np.percentile(latencies, 99)))
+        return stats
@@ -0,0 +1,202 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import asyncio
+import json
+import os
+import signal
+import time
+import yaml
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import *
+from .ebpf_rewriter import app_names
+from .finelame import FinelameDetector, app_model_params
+from .fleet import read_msg, write_msg, DEFAULT_PATH
+
+class Collector():
+    '''
+    Trains one model per application on the requests agents stream to it (see fleet),
+    and pushes the models to the agents, which load them without training locally.
+    The first models are trained train.time seconds after the collector starts, new
+    ones every train.interval seconds, each on the requests received since the
+    previous round (a uniform sample of train_samples of them per application).
+    Applications with fewer than train.min_samples new requests keep their model.
+    Agents that connect later get the latest models at once.
+    '''
+
+    DEFAULT_TRAIN_TIME = 60
+    DEFAULT_TRAIN_INTERVAL = 600
+    DEFAULT_MIN_SAMPLES = 1000
+
+    def __init__(self, cfg_file, run_label, outdir, train_time=None):
+        self.outdir = outdir
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        with open(cfg_file, 'r') as f:
+            self.cfg = yaml.safe_load(f)
+        self.run_label = run_label
+
+        self.applications = self.cfg['applications']
+        self.app_names = app_names(self.applications)
+        self.FDs = {name: FinelameDetector(model_params=app_model_params(self.cfg, application))
+                    for name, application in zip(self.app_names, self.applications)}
+
+        collector_cfg = self.cfg.get('collector', {})
+        train_cfg = collector_cfg.get('train', {})
+        self.path = collector_cfg.get('path', DEFAULT_PATH)
+        self.train_time = train_time if train_time is not None else \
+                          train_cfg.get('time', self.DEFAULT_TRAIN_TIME)
+        self.train_interval = train_cfg.get('interval', self.DEFAULT_TRAIN_INTERVAL)
+        self.min_samples = train_cfg.get('min_samples', self.DEFAULT_MIN_SAMPLES)
+
+        self.models = dict()
+        self.agents = dict()
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fl-collector')
+        self.loop = None
+        self.stop_requested = None
+
+    def _check_hello(self, hello):
+        ''' Reason to refuse an agent, if its applications do not match ours '''
+        for name, app in hello['apps'].items():
+            if name not in self.FDs:
+                return 'unknown application {}'.format(name)
+            FD = self.FDs[name]
+            if app['features'] != FD.features:
+                return 'features of {} differ: {} instead of {}'.format(name, app['features'], FD.features)
+            if app['k'] < FD.k:
+                return 'the eBPF program of {} holds {} clusters, {} needed'.format(name, app['k'], FD.k)
+        return None
+
+    def _push(self, writer, name):
+        version, params = self.models[name]
+        write_msg(writer, dict(type = 'model', app = name, version = version, params = params))
+
+    async def _handle(self, reader, writer):
+        hello, _ = await read_msg(reader)
+        if hello is None or hello.get('type') != 'hello':
+            writer.close()
+            return
+        agent = '{}:{}'.format(hello['host'], hello['pid'])
+        error = self._check_hello(hello)
+        if error is not None:
+            log_warn('Refusing agent {}: {}'.format(agent, error))
+            write_msg(writer, dict(type = 'error', message = error))
+            writer.close()
+            return
+
+        log_info('Agent {} connected for {}'.format(agent, ', '.join(hello['apps'])))
+        self.agents[writer] = dict(name = agent, apps = set(hello['apps']), rows = 0)
+        try:
+            for name in hello['apps']:
+                if name in self.models:
+                    self._push(writer, name)
+            await writer.drain()
+
+            while True:
+                header, payload = await read_msg(reader)
+                if header is None:
+                    break
+                if header['type'] == 'batch' and header['app'] in self.agents[writer]['apps']:
+                    FD = self.FDs[header['app']]
+                    X = np.frombuffer(payload, dtype=np.float64).reshape(header['rows'], len(FD.features))
+                    FD.add_train_data(pd.DataFrame(X, columns=FD.features))
+                    self.agents[writer]['rows'] += len(X)
+        except ConnectionError:
+            pass
+        finally:
+            stats = self.agents.pop(writer)
+            log_info('Agent {} disconnected after sending {} requests'.format(agent, stats['rows']))
+            writer.close()
+
+    def _fit(self, name, x_train):
+        FD = self.FDs[name]
+        FD.set_train_data(x_train)
+        return FD.fit()
+
+    def _save(self, name, version, params):
+        fname = os.path.join(self.outdir, 'collector_model_{}_{}.json'.format(self.run_label, name))
+        with open(fname, 'w') as f:
+            json.dump(dict(app = name, version = version, params = params), f)
+
+    async def _train_round(self):
+        for name, FD in self.FDs.items():
+            n_samples = len(FD.reservoir)
+            if n_samples < self.min_samples:
+                log_info('Only {} new requests of {}, not training'.format(n_samples, name))
+                continue
+            log_info('Training {} on {} of {} requests'.format(name, n_samples, FD.reservoir.n_seen))
+            x_train = FD.reservoir.frame()
+            FD.reservoir.clear()
+            train_start = time.time()
+            params = await self.loop.run_in_executor(self.worker, self._fit, name, x_train)
+            version = self.models[name][0] + 1 if name in self.models else 1
+            self.models[name] = (version, params)
+            await self.loop.run_in_executor(self.worker, self._save, name, version, params)
+
+            n_agents = 0
+            for writer, agent in list(self.agents.items()):
+                if name in agent['apps']:
+                    self._push(writer, name)
+                    n_agents += 1
+            log_info('Trained model v{} of {} in {:.2f} seconds, pushed to {} agents'.format(
+                     version, name, time.time() - train_start, n_agents))
+
+    async def _train(self):
+        await asyncio.sleep(self.train_time)
+        while True:
+            await self._train_round()
+            await asyncio.sleep(self.train_interval)
+
+    def _on_signal(self):
+        log_info('Stopping the collector')
+        self.stop_requested.set()
+
+    async def _run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_requested = asyncio.Event()
+        self.loop.add_signal_handler(signal.SIGINT, self._on_signal)
+        self.loop.add_signal_handler(signal.SIGTERM, self._on_signal)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self._handle, self.path)
+        log_info('Collecting requests on {}, first models in {} seconds'.format(self.path, self.train_time))
+
+        train = asyncio.ensure_future(self._train())
+        stop = asyncio.ensure_future(self.stop_requested.wait())
+        await asyncio.wait([train, stop], return_when=asyncio.FIRST_COMPLETED)
+        if train.done() and train.exception() is not None:
+            log_error('Training failed: {!r}'.format(train.exception()))
+        train.cancel()
+        stop.cancel()
+
+        server.close()
+        for writer in list(self.agents):
+            writer.close()
+        await server.wait_closed()
+        os.remove(self.path)
+        self.worker.shutdown()
+
+    def start(self):
+        asyncio.run(self._run())
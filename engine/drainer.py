@@ -0,0 +1,105 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import time
+import numpy as np
+
+from logger import *
+from .metrics import METRICS
+
+NS_PER_S = 1000 * 1000 * 1000
+
+class RequestDrainer():
+    '''
+    Periodically moves finished requests out of the kernel maps.
+    A request is drained once it has been unmapped from a thread and saw no activity for
+    complete_age seconds, or once it has been idle for idle_age seconds, but never while
+    a thread is still mapped to it in tid_to_rid: a request served by several threads
+    stays until the last one unmaps, and one blocked for long in a mapped thread is not
+    split in two. Mappings of exited threads are removed by the thread sweeper. Drained
+    requests are handed to every sink as a pair of DataFrames (datapoints, outlier
+    scores) and deleted from both maps.
+    '''
+
+    DEFAULT_INTERVAL = 5
+    DEFAULT_COMPLETE_AGE = 1
+    DEFAULT_IDLE_AGE = 60
+
+    def __init__(self, bm, interval=DEFAULT_INTERVAL,
+                 complete_age=DEFAULT_COMPLETE_AGE, idle_age=DEFAULT_IDLE_AGE):
+        self.BM = bm
+        self.interval = interval
+        self.complete_age_ns = int(complete_age * NS_PER_S)
+        self.idle_age_ns = int(idle_age * NS_PER_S)
+        self.sinks = []
+        self.n_drained = 0
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def _evictable(self, values, now_ns):
+        # bpf_ktime_get_ns() and time.monotonic_ns() share CLOCK_MONOTONIC
+        latest = values['latest_ts_update'].astype(np.int64)
+        idle = now_ns - latest
+        complete = (values['last_unmap_ts'].astype(np.int64) >= latest) \
+                   & (idle >= self.complete_age_ns)
+        return complete | (idle >= self.idle_age_ns)
+
+    def drain(self, force=False):
+        '''
+        Drain completed and idle requests. With force, drain everything.
+        Returns the drained (datapoints, scores) DataFrames.
+        '''
+        drain_start = time.time()
+        now_ns = time.monotonic_ns()
+
+        dp_keys, dp_values = self.BM.harvest_datapoints()
+        sc_keys, sc_values = self.BM.harvest_scores()
+
+        if force:
+            dp_mask = np.ones(len(dp_keys), dtype=bool)
+            sc_mask = np.ones(len(sc_keys), dtype=bool)
+        else:
+            # Read after the datapoints, so that threads mapped since are seen
+            mapped = self.BM.mapped_requests()
+            dp_mask = self._evictable(dp_values, now_ns) & ~np.isin(dp_keys, mapped)
+            # Scores go with their datapoint, or on their own if they were orphaned
+            orphans = ~np.isin(sc_keys, dp_keys) & ~np.isin(sc_keys, mapped) \
+                      & (now_ns - sc_values['last_ts'].astype(np.int64) >= self.idle_age_ns)
+            sc_mask = np.isin(sc_keys, dp_keys[dp_mask]) | orphans
+
+        dp_keys, dp_values = dp_keys[dp_mask], dp_values[dp_mask]
+        sc_keys, sc_values = sc_keys[sc_mask], sc_values[sc_mask]
+
+        # Probes may still touch an entry between the read above and its deletion;
+        # those updates are lost, which is why only idle requests are drained.
+        self.BM.delete_requests(dp_keys, sc_keys)
+
+        datapoints = self.BM.datapoints_frame(dp_keys, dp_values)
+        scores = self.BM.scores_frame(sc_keys, sc_values)
+        for sink in self.sinks:
+            sink(datapoints, scores)
+
+        self.n_drained += len(datapoints)
+        METRICS.inc('finelame_requests_drained_total', len(datapoints))
+        METRICS.observe('finelame_phase_duration_seconds', time.time() - drain_start, phase='drain')
+        log_info('Drained %d requests (%d scores) in %.3f seconds, %d remain in kernel',
+                 len(dp_keys), len(sc_keys), time.time() - drain_start, int((~dp_mask).sum()))
+        return datapoints, scores
@@ -0,0 +1,205 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import collections
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from logger import *
+from .metrics import METRICS
+
+# Must match FL_HIST_BUCKETS in the eBPF program
+HIST_BUCKETS = 65
+
+DEFAULT_INTERVAL = 1
+DEFAULT_WINDOW = 60
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_MIN_REQUESTS = 1000
+
+def log2_buckets(X):
+    ''' Histogram bucket of each value, as the eBPF program computes it '''
+    v = np.asarray(X).astype(np.uint64)
+    buckets = np.zeros(v.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = v >= np.uint64(1 << shift)
+        buckets[high] += shift
+        v = np.where(high, v >> np.uint64(shift), v)
+    return np.where(np.asarray(X) > 0, buckets + 1, 0)
+
+def log2_histograms(X):
+    ''' Per-feature log2 histograms of the rows of X, shaped (features, HIST_BUCKETS) '''
+    buckets = log2_buckets(np.clip(np.asarray(X, dtype=np.float64), 0, None))
+    return np.stack([np.bincount(buckets[:, i], minlength=HIST_BUCKETS)
+                     for i in range(buckets.shape[1])])
+
+def psi(expected, actual, eps=1e-4):
+    '''
+    Population stability index of actual against expected, two histograms with the
+    same buckets. Below 0.1 distributions hardly differ; above 0.2 they shifted.
+    '''
+    p = np.maximum(expected / max(expected.sum(), 1), eps)
+    q = np.maximum(actual / max(actual.sum(), 1), eps)
+    return float(np.sum((q - p) * np.log(q / p)))
+
+class DriftMonitor():
+    '''
+    Compares the distribution of recent requests with the one the model was trained
+    on, from the log2 histograms the eBPF program fills when requests are unmapped.
+    Every interval seconds, the cumulative counters are read (a few hundred per
+    application), and the counts of the last window seconds are compared with the
+    reference histograms, feature by feature, with the population stability index.
+    With cluster histograms, the shares of requests closest to each cluster are
+    compared as well. An application drifts when any index reaches threshold;
+    on_drift(app_id) is then called, at most once per window.
+    Applications without a reference adopt their first full window as one.
+    '''
+
+    def __init__(self, bm, app_names, features, k, interval=DEFAULT_INTERVAL, window=DEFAULT_WINDOW,
+                 threshold=DEFAULT_THRESHOLD, min_requests=DEFAULT_MIN_REQUESTS, clusters=False,
+                 retrain=True, on_drift=None):
+        self.BM = bm
+        self.app_names = app_names
+        self.features = features
+        self.k = k
+        self.interval = interval
+        self.window = window
+        self.threshold = threshold
+        self.min_requests = min_requests
+        self.clusters = clusters
+        self.retrain = retrain
+        self.on_drift = on_drift
+        # Features no probe feeds anymore (see FeatureSelector.detach)
+        self.ignored = set()
+
+        n_apps = len(app_names)
+        self.reference = [None] * n_apps
+        self.cluster_reference = [None] * n_apps
+        self.windows = [collections.deque() for _ in range(n_apps)]
+        self.previous = None
+        self.previous_clusters = None
+        self.scores = [dict() for _ in range(n_apps)]
+        self.drifting = [False] * n_apps
+        self.last_alarm = [0.] * n_apps
+        self.records = list()
+        self.lock = threading.Lock()
+
+    def set_reference(self, app_id, X, labels=None):
+        ''' Reference distributions: raw feature rows, and their cluster labels '''
+        reference = log2_histograms(X)
+        with self.lock:
+            self.reference[app_id] = reference
+            if labels is not None:
+                self.cluster_reference[app_id] = np.bincount(labels, minlength=self.k)[:self.k]
+            self.windows[app_id].clear()
+            self.scores[app_id] = dict()
+            self.drifting[app_id] = False
+
+    def ignore(self, features):
+        ''' Stop comparing features whose probes were detached: they read 0 from then on '''
+        with self.lock:
+            self.ignored.update(features)
+
+    def _read(self):
+        n_apps = len(self.app_names)
+        n_features = max(len(self.features), 1)
+        counts = self.BM.read_counters('feature_hist').reshape(n_apps, n_features, HIST_BUCKETS)
+        clusters = None
+        if self.clusters:
+            clusters = self.BM.read_counters('cluster_hist').reshape(n_apps, self.k)
+        return counts[:, :len(self.features)].astype(np.int64), \
+               clusters if clusters is None else clusters.astype(np.int64)
+
+    def _window_counts(self, app_id, now):
+        window = self.windows[app_id]
+        while window and now - window[0][0] > self.window:
+            window.popleft()
+        hist = sum(w[1] for w in window)
+        clusters = sum(w[2] for w in window) if self.clusters else None
+        return hist, clusters
+
+    def update(self):
+        ''' Read the kernel histograms and update every application's drift scores '''
+        now = time.time()
+        counts, clusters = self._read()
+        with self.lock:
+            self._update(now, counts, clusters)
+
+    def _update(self, now, counts, clusters):
+        if self.previous is None:
+            self.previous, self.previous_clusters = counts, clusters
+            return
+        deltas = counts - self.previous
+        cluster_deltas = clusters - self.previous_clusters if self.clusters else [None] * len(deltas)
+        self.previous, self.previous_clusters = counts, clusters
+
+        for app_id, name in enumerate(self.app_names):
+            self.windows[app_id].append((now, deltas[app_id], cluster_deltas[app_id]))
+            hist, cluster_hist = self._window_counts(app_id, now)
+            n_requests = int(hist[0].sum()) if len(self.features) else 0
+            METRICS.set('finelame_drift_window_requests', n_requests, app=name)
+            if n_requests < self.min_requests:
+                continue
+            if self.reference[app_id] is None:
+                log_info('Using the last {} requests of {} as reference distribution'.format(n_requests, name))
+                self.reference[app_id] = hist
+                if cluster_hist is not None and cluster_hist.sum() > 0:
+                    self.cluster_reference[app_id] = cluster_hist
+                continue
+
+            scores = {feature: psi(self.reference[app_id][i], hist[i])
+                      for i, feature in enumerate(self.features) if feature not in self.ignored}
+            if cluster_hist is not None and self.cluster_reference[app_id] is not None \
+               and cluster_hist.sum() > 0:
+                scores['cluster'] = psi(self.cluster_reference[app_id], cluster_hist)
+            self.scores[app_id] = scores
+            for feature, score in scores.items():
+                METRICS.set('finelame_feature_drift', score, app=name, feature=feature)
+                self.records.append(dict(ts = now, app = name, feature = feature,
+                                         psi = score, requests = n_requests))
+            self._check(app_id, now)
+
+    def _check(self, app_id, now):
+        name = self.app_names[app_id]
+        if not self.scores[app_id]:
+            return
+        worst = max(self.scores[app_id], key=self.scores[app_id].get)
+        drifting = self.scores[app_id][worst] >= self.threshold
+        if drifting and not self.drifting[app_id]:
+            log_warn('{} drifted from its training distribution: PSI {:.3f} on {}'.format(
+                     name, self.scores[app_id][worst], worst))
+            METRICS.inc('finelame_drift_alarms_total', app=name)
+        elif not drifting and self.drifting[app_id]:
+            log_info('{} is back to its training distribution'.format(name))
+        self.drifting[app_id] = drifting
+        if drifting and self.on_drift is not None and now - self.last_alarm[app_id] >= self.window:
+            self.last_alarm[app_id] = now
+            self.on_drift(app_id)
+
+    def stable(self, app_id):
+        ''' Whether an application's recent requests are known to match its reference '''
+        return self.reference[app_id] is not None and bool(self.scores[app_id]) \
+               and not self.drifting[app_id]
+
+    def take_records(self):
+        ''' Drift scores computed since the last call, one row per application and feature '''
+        records, self.records = self.records, list()
+        return pd.DataFrame(records, columns=['ts', 'app', 'feature', 'psi', 'requests'])
@@ -24,140 +24,451 @@ END OF LICENSE STUB
 #include <net/sock.h>
 #include <uapi/linux/bpf_perf_event.h>
 
+#define MAX_TIDS 32
+#define K $K
+#define MAX_APPS $N_APPS
+
 /**
- * Features order:
-        - 'REQ_CPUTIME'
-        - 'REQ_MEM_MALLOC'
-        - 'REQ_PGFLT'
-        - 'REQ_IDLE_TIME'
-        - 'REQ_TCP_SENT'
-        - 'REQ_TCP_RCVD'
-        - 'REQ_CACHE_MISSES'
-        - 'REQ_CACHE_REFS'
+ * Requests are keyed by a u64 holding the application id in its top byte and the
+ * application's own request id in the lower 56 bits.
  */
+#define FL_APP_SHIFT 56
+#define FL_RID_MASK ((1ULL << FL_APP_SHIFT) - 1)
 
-#define MAX_TIDS 32
-#define K $K
-#define N_FEATURES 6
-#define MAX_DATAPOINTS 4194304
+static inline __attribute__((always_inline)) u64 fl_key(u32 app, u64 rid) {
+    return ((u64) app << FL_APP_SHIFT) | (rid & FL_RID_MASK);
+}
+
+static inline __attribute__((always_inline)) u32 fl_app(u64 key) {
+    return key >> FL_APP_SHIFT;
+}
 
 // DO NOT REMOVE: Used for ebpf_rewriter
 #define IGNORE(...)
 
-struct datapoint {
-    u64 latest_ts_update;
-    u64 cputime;
-    u64 pgfaults;
-    size_t tcp_sent;
-    size_t tcp_rcvd;
-    u64 last_tcp_rcv_ts;
-    u64 tcp_idle_time;
-    size_t mem_malloc;
-    u64 first_ts;
-    u32 saddr;
-    int n_cputime_updates;
-    u32 cache_misses;
-    u32 cache_refs;
-};
+/**
+ * struct datapoint only holds the fields the configuration uses (see DATAPOINT_FIELDS
+ * in ebpf_rewriter), each announced by a FL_DP_<FIELD> define. latest_ts_update,
+ * first_ts and last_unmap_ts are always there. The model's features are numbered in
+ * configuration order: <FEATURE>_OFFSET is a feature's index, or N_FEATURES for fields
+ * the model does not use, which normalize to 0.
+ */
+$DATAPOINT_LAYOUT
 
-#define CPUTIME_OFFSET 0
-#define MALLOC_OFFSET 1
-#define PGFAULT_OFFSET 2
-#define IDLE_TIME_OFFSET 3
-#define TCP_SENT_OFFSET 4
-#define TCP_RCVD_OFFSET 5
-#define CACHE_MISSES_OFFSET 6
-#define CACHE_REFS_OFFSET 7
+#ifdef FL_DP_SADDR
+#define DP_SADDR(dp) ((dp)->saddr)
+#else
+#define DP_SADDR(dp) 0
+#endif
 
 struct outlier_score {
     long long distances[K];
+    u64 model_version;
     u8 is_outlier;
     u64 detection_ts;
     u64 last_ts;
     u64 detection_cputime;
 };
 
-BPF_ARRAY(max_rid, $RID_TYPE, 1);
-BPF_HASH(assoc_to_rid, unsigned long, $RID_TYPE, MAX_DATAPOINTS);
-BPF_HASH(tid_to_rid, u32, $RID_TYPE);
-BPF_HASH(start, u32, u64);
-BPF_HASH(datapoints, $RID_TYPE, struct datapoint, MAX_DATAPOINTS);
-BPF_HASH(outlier_scores_m, $RID_TYPE, struct outlier_score, MAX_DATAPOINTS);
+/**
+ * Table type ("hash" or "lru_hash", per-CPU for per-CPU datapoints), size and flags
+ * (BPF_F_NO_PREALLOC or 0) of the request and thread tracking maps, from the
+ * configuration (see map_config in ebpf_rewriter). LRU maps evict their least recently
+ * used entries instead of failing insertions when full.
+ */
+$MAP_CONFIG
+
+BPF_ARRAY(max_rid, u64, MAX_APPS); // Last rid generated, per application
+BPF_F_TABLE(FL_MAP_ASSOC_TO_RID_TYPE, unsigned long, u64, assoc_to_rid,
+            FL_MAP_ASSOC_TO_RID_ENTRIES, FL_MAP_ASSOC_TO_RID_FLAGS);
+BPF_F_TABLE(FL_MAP_TID_TO_RID_TYPE, u32, u64, tid_to_rid,
+            FL_MAP_TID_TO_RID_ENTRIES, FL_MAP_TID_TO_RID_FLAGS);
+BPF_F_TABLE(FL_MAP_START_TYPE, u32, u64, start, FL_MAP_START_ENTRIES, FL_MAP_START_FLAGS);
+$PERCPU
+/**
+ * With FL_PERCPU, each CPU accumulates its share of a request's counters in its own copy
+ * of the entry, so probes never write to a cache line another CPU is updating. User space
+ * sums the copies (and takes the min/max of timestamps) when harvesting.
+ */
+BPF_F_TABLE(FL_MAP_DATAPOINTS_TYPE, u64, struct datapoint, datapoints,
+            FL_MAP_DATAPOINTS_ENTRIES, FL_MAP_DATAPOINTS_FLAGS);
+#ifdef FL_PERCPU
+#define DP_ADD(field, value) ((field) += (value))
+#else
+#define DP_ADD(field, value) lock_xadd(&(field), (value))
+#endif
+BPF_F_TABLE(FL_MAP_OUTLIER_SCORES_M_TYPE, u64, struct outlier_score, outlier_scores_m,
+            FL_MAP_OUTLIER_SCORES_M_ENTRIES, FL_MAP_OUTLIER_SCORES_M_FLAGS);
 
-/** Model params */
-BPF_ARRAY(cluster_thresholds, u64, K);
-BPF_ARRAY(centroid_l1s, long long, K);
-BPF_ARRAY(centroid_offset, long long, 1);
-BPF_ARRAY(train_set_params, u64, N_FEATURES * 2); // Mean and std of each feature in the training set
+/**
+ * Counters read by the agent's metrics: insertions in the request maps (user space
+ * knows how many entries it deleted), insertions that failed because a map was full,
+ * and requests flagged as outliers per application.
+ */
+#define FL_STAT_DP_INSERTS 0
+#define FL_STAT_DP_FULL 1
+#define FL_STAT_SCORE_INSERTS 2
+#define FL_STAT_SCORE_FULL 3
+#define FL_N_STATS 4
+BPF_PERCPU_ARRAY(fl_stats, u64, FL_N_STATS);
+BPF_PERCPU_ARRAY(outlier_counts, u64, MAX_APPS);
+
+static inline __attribute__((always_inline)) void fl_stat_inc(int idx) {
+    u64 *count = fl_stats.lookup(&idx);
+    if (count) {
+        (*count)++;
+    }
+}
 
-static inline __attribute__((always_inline)) long long normalize_datapoint(long long dp, int offset) {
-    //$DEBUG_PRINTK("to normalize dp: %lld\n", dp);
-    if (dp == 0) {
+/**
+ * Request sampling. A mapper only tracks a request if a hash of its key falls under
+ * the application's sample_rate, out of FL_SAMPLE_SCALE. The decision only depends
+ * on the key and the rate, so all mappers of a request agree on it, and raising the
+ * rate never drops a request that was being tracked. Requests that are not tracked
+ * get no thread mapping, so no other probe accounts for them.
+ */
+#define FL_SAMPLE_SCALE (1 << 16)
+$SAMPLING
+#ifdef FL_SAMPLING
+struct fl_sample_counts {
+    u64 seen;
+    u64 sampled;
+};
+
+BPF_ARRAY(sample_rate, u32, MAX_APPS);
+BPF_PERCPU_ARRAY(sample_counts, struct fl_sample_counts, MAX_APPS);
+#endif
+
+static inline __attribute__((always_inline)) int fl_sampled(u64 key) {
+#ifdef FL_SAMPLING
+    u32 app = fl_app(key);
+    u32 *rate = sample_rate.lookup(&app);
+    struct fl_sample_counts *counts = sample_counts.lookup(&app);
+    if (!rate || !counts) {
+        return 1;
+    }
+    counts->seen++;
+    // Fibonacci hashing: the top 16 bits of key * 2^64 / phi
+    if (((key * 0x9E3779B97F4A7C15ULL) >> 48) >= *rate) {
         return 0;
     }
+    counts->sampled++;
+#endif
+    return 1;
+}
 
-    u64 *mean, *std_p;
-    int meanidx = offset * 2;
-    int stdidx = offset * 2 + 1;
-    mean = train_set_params.lookup(&meanidx);
-    std_p = train_set_params.lookup(&stdidx);
+/**
+ * Process scoping. Probes that fire for every task on the host (scheduler, page faults,
+ * libc, TCP, perf events) first check that the task belongs to one of the processes the
+ * agent published, before any hash lookup: a single array lookup and at most
+ * FL_FILTER_SLOTS comparisons. n above FL_FILTER_SLOTS (more processes than slots) lets
+ * every task through. The agent rewrites the list as processes come and go; a probe
+ * racing with an update may miss the events of a process being added.
+ */
+$PROC_FILTER
+#ifdef FL_PROC_FILTER
+struct fl_proc_filter {
+    u32 n;
+    u32 tgids[FL_FILTER_SLOTS];
+};
 
-    if (!mean || !std_p) {
-        return 0;
+BPF_ARRAY(proc_filter, struct fl_proc_filter, 1);
+
+static inline __attribute__((always_inline)) int fl_tracked_tgid(u32 tgid) {
+    int zero = 0;
+    struct fl_proc_filter *filter = proc_filter.lookup(&zero);
+    if (!filter || filter->n > FL_FILTER_SLOTS) {
+        return 1;
+    }
+#pragma unroll
+    for (int i = 0; i < FL_FILTER_SLOTS; i++) {
+        if (i >= filter->n) {
+            return 0;
+        }
+        if (filter->tgids[i] == tgid) {
+            return 1;
+        }
     }
+    return 0;
+}
+// Macros, so that the task fields they read are not even loaded without the filter
+#define FL_TRACKED_TGID(tgid) fl_tracked_tgid(tgid)
+#define FL_TRACKED_CURRENT() fl_tracked_tgid(bpf_get_current_pid_tgid() >> 32)
+#else
+#define FL_TRACKED_TGID(tgid) 1
+#define FL_TRACKED_CURRENT() 1
+#endif
+
+/** Events pushed to user space */
+#define FL_EVT_REQ_DONE 1
+#define FL_EVT_OUTLIER 2
+
+struct fl_event {
+    u64 req_id;
+    u64 ts;
+    u64 cputime;
+    long long score;
+    u32 type;
+    u32 is_outlier;
+    u32 saddr;
+    u32 pad;
+};
+
+$EVENTS_OUTPUT
+BPF_PERCPU_ARRAY(event_drops, u64, 1);
+
+/**
+ * Mitigation. Requests are recorded in flagged, with their source address (if known),
+ * when they are first flagged as outliers. The agent's mitigation actions may fill
+ * blocklist (address -> expiry, in bpf_ktime_get_ns time, 0 for never), which a packet
+ * filter can share through a pinned map.
+ */
+#define MAX_FLAGGED 65536
+
+struct fl_flagged {
+    u64 detection_ts;
+    long long score;
+    u32 saddr;
+    u32 pad;
+};
+
+BPF_HASH(flagged, u64, struct fl_flagged, MAX_FLAGGED);
+BPF_HASH(blocklist, u32, u64, MAX_FLAGGED);
+
+/**
+ * Detection cascade. With FL_CASCADE, the thresholds the agent loads only screen for
+ * candidates, which the agent scores again with a richer model. It writes its verdict
+ * on each candidate in verdicts, and request completion events report it instead of
+ * the screening decision.
+ */
+$CASCADE
+#ifdef FL_CASCADE
+#define FL_VERDICT_OUTLIER 1
+#define FL_VERDICT_CLEARED 2
+
+struct fl_verdict {
+    u64 ts;
+    long long score;
+    u32 verdict;
+    u32 pad;
+};
+
+BPF_HASH(verdicts, u64, struct fl_verdict, MAX_FLAGGED);
+#endif
+
+static inline __attribute__((always_inline))
+void record_flagged(u64 req_id, u32 saddr, long long score, u64 ts) {
+    struct fl_flagged flag = {};
+    flag.detection_ts = ts;
+    flag.score = score;
+    flag.saddr = saddr;
+    flagged.update(&req_id, &flag);
+}
+
+static inline __attribute__((always_inline)) void emit_event(void *ctx, struct fl_event *evt) {
+    int ret = 0;
+    $EMIT_EVENT
+    if (ret < 0) {
+        int idx = 0;
+        u64 *drops = event_drops.lookup(&idx);
+        if (drops) {
+            (*drops)++;
+        }
+    }
+}
+
+/**
+ * Trace records. With FL_TRACE, probes push a fixed-size record for every resource
+ * they account to a request, and for every thread mapped to or unmapped from a
+ * request, so that runs can be replayed offline (see engine/trace_replay).
+ */
+#define FL_TR_CPU 1
+#define FL_TR_PGFAULT 2
+#define FL_TR_MALLOC 3
+#define FL_TR_TCP_SENT 4
+#define FL_TR_TCP_RCVD 5
+#define FL_TR_CACHE_MISS 6
+#define FL_TR_CACHE_REF 7
+#define FL_TR_MAP 8
+#define FL_TR_UNMAP 9
+
+struct fl_trace_rec {
+    u64 ts;
+    u64 req_id;
+    u64 value;
+    u32 tid;
+    u16 type;
+    u16 cpu;
+};
+
+$TRACE_OUTPUT
+#ifdef FL_TRACE
+BPF_PERCPU_ARRAY(trace_drops, u64, 1);
+#endif
+
+static inline __attribute__((always_inline))
+void fl_trace(void *ctx, u16 type, u32 tid, u64 req_id, u64 value, u64 ts) {
+#ifdef FL_TRACE
+    struct fl_trace_rec rec = {};
+    rec.ts = ts;
+    rec.req_id = req_id;
+    rec.value = value;
+    rec.tid = tid;
+    rec.type = type;
+    rec.cpu = bpf_get_smp_processor_id();
+    int ret = 0;
+    $EMIT_TRACE
+    if (ret < 0) {
+        int idx = 0;
+        u64 *drops = trace_drops.lookup(&idx);
+        if (drops) {
+            (*drops)++;
+        }
+    }
+#endif
+}
+
+/**
+ * Normalization of a feature: x * m_scale / std is computed as (x * mult) >> shift,
+ * with mult < 2^32 precomputed by the agent.
+ */
+struct fl_norm {
+    u64 mult;
+    u64 shift;
+};
+
+/**
+ * Model params: two slots per application, probes only use the one active_model
+ * points to. Application app uses slots app * 2 and app * 2 + 1.
+ */
+struct fl_model {
+    u64 version; // 0 until a model is loaded
+    long long centroid_offset;
+    long long centroid_l1s[K];
+    u64 cluster_thresholds[K];
+    struct fl_norm norm[N_FEATURES];
+    u64 train_set_params[N_FEATURES * 2]; // Mean and std of each feature in the training set (informative)
+};
+
+BPF_ARRAY(models, struct fl_model, 2 * MAX_APPS);
+BPF_ARRAY(active_model, u32, MAX_APPS);
 
-    u64 std = *std_p;
-    if (std == 0) {
-        std = 10000;
+static inline __attribute__((always_inline)) struct fl_model *current_model(u64 req_id) {
+    u32 app = fl_app(req_id);
+    if (app >= MAX_APPS) {
+        return NULL;
     }
+    u32 *slot = active_model.lookup(&app);
+    if (!slot) {
+        return NULL;
+    }
+    int slot_idx = app * 2 + (*slot & 1);
+    struct fl_model *model = models.lookup(&slot_idx);
+    if (!model || model->version == 0) {
+        return NULL;
+    }
+    return model;
+}
 
-    long long scaled = $MSCALE(dp);
-    //$DEBUG_PRINTK("Scaled dp: %lld, mean: %lld, std: %lld\n", scaled, *mean, std);
-    //scaled -= *mean;
-    //$DEBUG_PRINTK("-mean: %lld\n", scaled);
-    if (scaled < 0) {
-        scaled *= -1;
-        scaled /= std;
-        scaled *= -1;
+/* (x * mult) >> shift without overflowing the intermediate product: x is split in 32-bit halves */
+static inline __attribute__((always_inline))
+u64 mul_shift(u64 x, u64 mult, u64 shift) {
+    u64 lo = ((x & 0xffffffff) * mult) >> shift;
+    u64 hi = (x >> 32) * mult;
+    if (shift >= 32) {
+        hi >>= shift - 32;
     } else {
-        scaled /= std;
+        hi <<= 32 - shift;
     }
-    //$DEBUG_PRINTK("/std: %lld\n", scaled);
+    return hi + lo;
+}
 
-    return scaled;
+static inline __attribute__((always_inline))
+long long normalize_datapoint(struct fl_model *model, long long dp, int offset) {
+    //$DEBUG_PRINTK("to normalize dp: %lld\n", dp);
+    if (dp == 0 || offset >= N_FEATURES) {
+        return 0;
+    }
+
+    struct fl_norm *norm = &model->norm[offset];
+    u64 shift = norm->shift & 63;
+    if (dp < 0) {
+        return -(long long) mul_shift(-dp, norm->mult, shift);
+    }
+    return mul_shift(dp, norm->mult, shift);
 }
 
-static inline __attribute__((always_inline)) int centroids_defined() {
-    int idx = 0;
-    long long *k0_l1 = centroid_l1s.lookup(&idx);
-    return k0_l1 && *k0_l1;
+/* Sum of a request's normalized totals, used to rebase its score on a new model */
+static inline __attribute__((always_inline))
+long long normalized_totals(struct fl_model *model, struct datapoint *dp) {
+    long long totals = 0;
+#ifdef FL_DP_CPUTIME
+    totals += normalize_datapoint(model, dp->cputime, CPUTIME_OFFSET);
+#endif
+#ifdef FL_DP_MEM_MALLOC
+    totals += normalize_datapoint(model, dp->mem_malloc, MALLOC_OFFSET);
+#endif
+#ifdef FL_DP_PGFAULTS
+    totals += normalize_datapoint(model, dp->pgfaults, PGFAULT_OFFSET);
+#endif
+#ifdef FL_DP_TCP_IDLE_TIME
+    totals += normalize_datapoint(model, dp->tcp_idle_time, IDLE_TIME_OFFSET);
+#endif
+#ifdef FL_DP_TCP_SENT
+    totals += normalize_datapoint(model, dp->tcp_sent, TCP_SENT_OFFSET);
+#endif
+#ifdef FL_DP_TCP_RCVD
+    totals += normalize_datapoint(model, dp->tcp_rcvd, TCP_RCVD_OFFSET);
+#endif
+#ifdef FL_DP_CACHE_MISSES
+    totals += normalize_datapoint(model, dp->cache_misses, CACHE_MISSES_OFFSET);
+#endif
+#ifdef FL_DP_CACHE_REFS
+    totals += normalize_datapoint(model, dp->cache_refs, CACHE_REFS_OFFSET);
+#endif
+    return totals;
 }
 
 static inline __attribute__((always_inline))
-int update_outlier_score($RID_TYPE req_id, long long delta, u64 ts, u64 cputime) {
+int update_outlier_score(void *ctx, struct fl_model *model, u64 req_id,
+                         struct datapoint *dp, long long delta, u64 ts) {
     //$DEBUG_PRINTK("Delta is %lld\n", delta);
+#ifdef FL_DP_CPUTIME
+    u64 cputime = dp->cputime;
+#else
+    u64 cputime = 0;
+#endif
     struct outlier_score *out = outlier_scores_m.lookup(&req_id);
     if (!out) {
         struct outlier_score init_out = {};
-        int off_i = 0;
-        long long *centroid_offset_p = centroid_offset.lookup(&off_i);
-        if (!centroid_offset_p) {
-            return -1;
-        }
+        init_out.model_version = model->version;
 
 #pragma unroll
         for (int i = 0; i < K; i++) {
-            // Must assign i to new variable, else reference to i
-            // makes it so loop can't be unrolled
-            int j = i;
-            long long *centroid = centroid_l1s.lookup(&j);
-            if (centroid) {
-                init_out.distances[i] = -(*centroid) - (*centroid_offset_p);
-            } else {
-                $DEBUG_PRINTK("Centroid %d not defined", i);
-            }
+            init_out.distances[i] = -model->centroid_l1s[i] - model->centroid_offset;
         }
         out = outlier_scores_m.lookup_or_init(&req_id, &init_out);
+        if (!out) {
+            fl_stat_inc(FL_STAT_SCORE_FULL);
+            return -1;
+        }
+        fl_stat_inc(FL_STAT_SCORE_INSERTS);
+    } else if (out->model_version != model->version) {
+        // The model was swapped while the request was in flight: rebase the
+        // score on the new model. The request's totals already include delta.
+#ifdef FL_PERCPU
+        // Only this CPU's share of the totals is visible here: restart the
+        // score from the new model instead.
+        long long totals = delta;
+#else
+        long long totals = normalized_totals(model, dp);
+#endif
+#pragma unroll
+        for (int i = 0; i < K; i++) {
+            out->distances[i] = totals - model->centroid_l1s[i] - model->centroid_offset;
+        }
+        out->model_version = model->version;
+        delta = 0;
     }
 
     long long min_dist = (1LL) << 62; // A very large number...
@@ -165,34 +476,51 @@ int update_outlier_score($RID_TYPE req_id, long long delta, u64 ts, u64 cputime)
 
 #pragma unroll
     for (int idx = 0; idx < K; idx++) {
-        int idx_cp = idx;
         //$DEBUG_PRINTK("dist[0]: %lld + delta = %lld\n", out->distances[0], out->distances[0]+delta);
         // I don't know why two threads would be running this code concurrently,
         // but this locking prevents discrepancies between cluster scores
         lock_xadd(&out->distances[idx], delta);
         //$DEBUG_PRINTK("dist[0]: is now %lld\n", out->distances[0]);
         if (abs(out->distances[idx]) < abs(min_dist)) {
-            u64 *threshold = cluster_thresholds.lookup(&idx_cp);
-            if (threshold && *threshold != 0) {
+            u64 threshold = model->cluster_thresholds[idx];
+            if (threshold != 0) {
                 min_dist = out->distances[idx];
-                if (min_dist > 0 && min_dist > *threshold) {
+                if (min_dist > 0 && min_dist > threshold) {
                     is_outlier = 1;
                 } else {
                     is_outlier = 0;
                 }
-                $DEBUG_PRINTK("Distance to %d(%lld) is: %lld\n", idx, *threshold, min_dist);
-                $DEBUG_PRINTK("[%$REQ_TYPE_FORMAT] is outlier? %d.\n", req_id, is_outlier);
+                $DEBUG_PRINTK("Distance to %d(%lld) is: %lld\n", idx, threshold, min_dist);
+                $DEBUG_PRINTK("[%llx] is outlier? %d.\n", req_id, is_outlier);
             }
         }
     }
 
-    $DEBUG_PRINTK("[%$REQ_TYPE_FORMAT] final decision: %d\n", req_id, is_outlier);
+    $DEBUG_PRINTK("[%llx] final decision: %d\n", req_id, is_outlier);
 
     out->is_outlier = is_outlier;
 
     if (out->detection_ts == 0 && is_outlier) {
         out->detection_ts = ts;
         out->detection_cputime = cputime;
+
+        u32 app = fl_app(req_id);
+        u64 *n_outliers = outlier_counts.lookup(&app);
+        if (n_outliers) {
+            (*n_outliers)++;
+        }
+
+        record_flagged(req_id, DP_SADDR(dp), min_dist, ts);
+
+        struct fl_event evt = {};
+        evt.type = FL_EVT_OUTLIER;
+        evt.req_id = req_id;
+        evt.ts = ts;
+        evt.cputime = cputime;
+        evt.score = min_dist;
+        evt.is_outlier = 1;
+        evt.saddr = DP_SADDR(dp);
+        emit_event(ctx, &evt);
     }
 
     out->last_ts = ts;
@@ -200,7 +528,7 @@ int update_outlier_score($RID_TYPE req_id, long long delta, u64 ts, u64 cputime)
     return 0;
 }
 
-static struct datapoint * lookup_or_init_dp($RID_TYPE req_id, u64 ts) {
+static struct datapoint * lookup_or_init_dp(u64 req_id, u64 ts) {
     struct datapoint *dp = datapoints.lookup(&req_id);
     if (dp) {
         dp->latest_ts_update = ts;
@@ -209,11 +537,106 @@ static struct datapoint * lookup_or_init_dp($RID_TYPE req_id, u64 ts) {
     struct datapoint new_dp = {};
     new_dp.first_ts = ts;
     new_dp.latest_ts_update = ts;
-    return datapoints.lookup_or_init(&req_id, &new_dp);
+    dp = datapoints.lookup_or_init(&req_id, &new_dp);
+    fl_stat_inc(dp ? FL_STAT_DP_INSERTS : FL_STAT_DP_FULL);
+    return dp;
+}
+
+/**
+ * Distribution tracking. When a request is first unmapped, each of its features is
+ * counted in a log2 histogram of its application (bucket 0 holds zeros, bucket b > 0
+ * values in [2^(b-1), 2^b)), and, with FL_HIST_CLUSTERS, the cluster it is closest to.
+ * Per-CPU datapoints only hold a CPU's share of a request, so they are not tracked.
+ */
+#define FL_HIST_BUCKETS 65
+$HISTOGRAMS
+#if defined(FL_HISTOGRAMS) && !defined(FL_PERCPU)
+BPF_PERCPU_ARRAY(feature_hist, u64, MAX_APPS * N_FEATURES * FL_HIST_BUCKETS);
+#ifdef FL_HIST_CLUSTERS
+BPF_PERCPU_ARRAY(cluster_hist, u64, MAX_APPS * K);
+#endif
+
+static inline __attribute__((always_inline)) void fl_hist_inc(u32 app, int feature, u64 value) {
+    int idx = (app * N_FEATURES + feature) * FL_HIST_BUCKETS + (value ? bpf_log2l(value) : 0);
+    u64 *count = feature_hist.lookup(&idx);
+    if (count) {
+        (*count)++;
+    }
+}
+
+static inline __attribute__((always_inline)) void fl_hist_request(u64 req_id, struct datapoint *dp) {
+    u32 app = fl_app(req_id);
+    if (app >= MAX_APPS) {
+        return;
+    }
+#define FL_HIST_FEATURE(offset, field) fl_hist_inc(app, offset, dp->field);
+    FL_FOR_EACH_FEATURE(FL_HIST_FEATURE)
+
+#ifdef FL_HIST_CLUSTERS
+    struct fl_model *model = current_model(req_id);
+    struct outlier_score *out = outlier_scores_m.lookup(&req_id);
+    if (!model || !out) {
+        return;
+    }
+    int closest = -1;
+    long long min_dist = (1LL) << 62;
+#pragma unroll
+    for (int i = 0; i < K; i++) {
+        if (model->cluster_thresholds[i] != 0 && abs(out->distances[i]) < abs(min_dist)) {
+            min_dist = out->distances[i];
+            closest = i;
+        }
+    }
+    if (closest >= 0) {
+        int idx = app * K + closest;
+        u64 *count = cluster_hist.lookup(&idx);
+        if (count) {
+            (*count)++;
+        }
+    }
+#endif
+}
+#endif
+
+/* Record that no thread is serving the request anymore, so that user space can drain it */
+static inline __attribute__((always_inline))
+void mark_unmapped(void *ctx, u64 req_id, u64 ts) {
+    fl_trace(ctx, FL_TR_UNMAP, bpf_get_current_pid_tgid(), req_id, 0, ts);
+    struct datapoint *dp = datapoints.lookup(&req_id);
+    if (!dp) {
+        return;
+    }
+#if defined(FL_HISTOGRAMS) && !defined(FL_PERCPU)
+    if (dp->last_unmap_ts == 0) {
+        fl_hist_request(req_id, dp);
+    }
+#endif
+    dp->last_unmap_ts = ts;
+
+    struct fl_event evt = {};
+    evt.type = FL_EVT_REQ_DONE;
+    evt.req_id = req_id;
+    evt.ts = ts;
+#ifdef FL_DP_CPUTIME
+    evt.cputime = dp->cputime;
+#endif
+    evt.saddr = DP_SADDR(dp);
+    struct outlier_score *out = outlier_scores_m.lookup(&req_id);
+    if (out) {
+        evt.is_outlier = out->is_outlier;
+    }
+#ifdef FL_CASCADE
+    struct fl_verdict *verdict = verdicts.lookup(&req_id);
+    if (verdict) {
+        evt.is_outlier = verdict->verdict == FL_VERDICT_OUTLIER;
+    }
+#endif
+    emit_event(ctx, &evt);
 }
 
 static inline __attribute__((always_inline))
-int update_array(struct pt_regs *ctx, u32 pid, u64 ts, $RID_TYPE req_id) {
+int update_array(struct pt_regs *ctx, u32 pid, u64 ts, u64 req_id) {
+#ifdef FL_DP_CPUTIME
     u64 *tsp = start.lookup(&pid);
     if (tsp == 0) {
         return -1;
@@ -231,20 +654,23 @@ int update_array(struct pt_regs *ctx, u32 pid, u64 ts, $RID_TYPE req_id) {
         return -1;
     }
 
-    lock_xadd(&dp->n_cputime_updates, 1);
-    lock_xadd(&dp->cputime, delta);
+    DP_ADD(dp->n_cputime_updates, 1);
+    DP_ADD(dp->cputime, delta);
+    fl_trace(ctx, FL_TR_CPU, pid, req_id, delta, ts);
 
-    $DEBUG_PRINTK("RID [%$REQ_TYPE_FORMAT]: CPUTIME: %lld\n", req_id, dp->cputime);
-    if (centroids_defined()) {
-        long long delta_scaled = normalize_datapoint(delta, CPUTIME_OFFSET);
-        update_outlier_score(req_id, delta_scaled, ts, dp->cputime);
+    $DEBUG_PRINTK("RID [%llx]: CPUTIME: %lld\n", req_id, dp->cputime);
+    struct fl_model *model = current_model(req_id);
+    if (model) {
+        long long delta_scaled = normalize_datapoint(model, delta, CPUTIME_OFFSET);
+        update_outlier_score(ctx, model, req_id, dp, delta_scaled, ts);
     }
+#endif
     return 0;
 }
 
 int update_cputime(struct pt_regs *ctx) {
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
     if (!req_id) {
         return 0;
     }
@@ -256,14 +682,19 @@ int update_cputime(struct pt_regs *ctx) {
 
 int sched_switch(struct pt_regs *ctx, struct task_struct *prev) {
     //PID is stored in the first 32 LS bytes. (TGID are the next 32 bytes)
-    u32 prev_pid = prev->pid;
-    $RID_TYPE *prev_req_id = tid_to_rid.lookup(&prev_pid);
-    if (prev_req_id) {
-        u64 ts = bpf_ktime_get_ns();
-        update_array(ctx, prev_pid, ts, *prev_req_id);
+    if (FL_TRACKED_TGID(prev->tgid)) {
+        u32 prev_pid = prev->pid;
+        u64 *prev_req_id = tid_to_rid.lookup(&prev_pid);
+        if (prev_req_id) {
+            u64 ts = bpf_ktime_get_ns();
+            update_array(ctx, prev_pid, ts, *prev_req_id);
+        }
+    }
+    if (!FL_TRACKED_CURRENT()) {
+        return 0;
     }
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
     if (req_id) {
         u64 ts = bpf_ktime_get_ns();
         start.update(&pid, &ts);
@@ -272,8 +703,12 @@ int sched_switch(struct pt_regs *ctx, struct task_struct *prev) {
 }
 
 int handle_pg_fault(struct pt_regs *ctx) {
+#ifdef FL_DP_PGFAULTS
+    if (!FL_TRACKED_CURRENT()) {
+        return 0;
+    }
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
 
     if (!req_id) {
         return 0;
@@ -286,24 +721,28 @@ int handle_pg_fault(struct pt_regs *ctx) {
         return 0;
     }
     dp->pgfaults++;
+    fl_trace(ctx, FL_TR_PGFAULT, pid, *req_id, 1, ts);
 
-    $DEBUG_PRINTK("RID: [%$REQ_TYPE_FORMAT] PGFAULTS: %d\n", *req_id, dp->pgfaults);
-    if (centroids_defined()) {
-        long long delta = normalize_datapoint(1, PGFAULT_OFFSET);
-        update_outlier_score(*req_id, delta, ts, dp->cputime);
+    $DEBUG_PRINTK("RID: [%llx] PGFAULTS: %d\n", *req_id, dp->pgfaults);
+    struct fl_model *model = current_model(*req_id);
+    if (model) {
+        long long delta = normalize_datapoint(model, 1, PGFAULT_OFFSET);
+        update_outlier_score(ctx, model, *req_id, dp, delta, ts);
     }
+#endif
     return 0;
 }
 
 
 int ap_probe_malloc(struct pt_regs *ctx) {
+#ifdef FL_DP_MEM_MALLOC
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id_p = tid_to_rid.lookup(&pid);
+    u64 *req_id_p = tid_to_rid.lookup(&pid);
 
     if (!req_id_p) {
         return 0;
     }
-    $RID_TYPE req_id = *req_id_p;
+    u64 req_id = *req_id_p;
 
     size_t malloc_size;
     bpf_probe_read(&malloc_size, sizeof(malloc_size), (void*)&PT_REGS_PARM1(ctx));
@@ -313,18 +752,25 @@ int ap_probe_malloc(struct pt_regs *ctx) {
         return 0;
     }
     dp->mem_malloc += malloc_size;
+    fl_trace(ctx, FL_TR_MALLOC, pid, req_id, malloc_size, ts);
 
-    $DEBUG_PRINTK("RID: [%$REQ_TYPE_FORMAT] MALLOC: %d\n", req_id, dp->mem_malloc);
-    if (centroids_defined()) {
-        long long delta = normalize_datapoint(malloc_size, MALLOC_OFFSET);
-        update_outlier_score(req_id, delta, ts, dp->cputime);
+    $DEBUG_PRINTK("RID: [%llx] MALLOC: %d\n", req_id, dp->mem_malloc);
+    struct fl_model *model = current_model(req_id);
+    if (model) {
+        long long delta = normalize_datapoint(model, malloc_size, MALLOC_OFFSET);
+        update_outlier_score(ctx, model, req_id, dp, delta, ts);
     }
+#endif
     return 0;
 };
 
 int probe_realloc(struct pt_regs *ctx) {
+#ifdef FL_DP_MEM_MALLOC
+    if (!FL_TRACKED_CURRENT()) {
+        return 0;
+    }
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
 
     if (!req_id) {
         return 0;
@@ -338,18 +784,25 @@ int probe_realloc(struct pt_regs *ctx) {
         return 0;
     }
     dp->mem_malloc += malloc_size;
+    fl_trace(ctx, FL_TR_MALLOC, pid, *req_id, malloc_size, ts);
 
-    $DEBUG_PRINTK("RID: [%$REQ_TYPE_FORMAT] MEM_MALLOC: %d\n", *req_id, dp->mem_malloc);
-    if (centroids_defined()) {
-        long long delta = normalize_datapoint(malloc_size, MALLOC_OFFSET);
-        update_outlier_score(*req_id, delta, ts, dp->cputime);
+    $DEBUG_PRINTK("RID: [%llx] MEM_MALLOC: %d\n", *req_id, dp->mem_malloc);
+    struct fl_model *model = current_model(*req_id);
+    if (model) {
+        long long delta = normalize_datapoint(model, malloc_size, MALLOC_OFFSET);
+        update_outlier_score(ctx, model, *req_id, dp, delta, ts);
     }
+#endif
     return 0;
 };
 
 int probe_malloc(struct pt_regs *ctx) {
+#ifdef FL_DP_MEM_MALLOC
+    if (!FL_TRACKED_CURRENT()) {
+        return 0;
+    }
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
 
     if (!req_id) {
         return 0;
@@ -363,23 +816,30 @@ int probe_malloc(struct pt_regs *ctx) {
         return 0;
     }
     dp->mem_malloc += malloc_size;
+    fl_trace(ctx, FL_TR_MALLOC, pid, *req_id, malloc_size, ts);
 
-    $DEBUG_PRINTK("RID: [%$REQ_TYPE_FORMAT] MEM_MALLOC: %d\n", *req_id, dp->mem_malloc);
-    if (centroids_defined()) {
-        long long delta = normalize_datapoint(malloc_size, MALLOC_OFFSET);
-        update_outlier_score(*req_id, delta, ts, dp->cputime);
+    $DEBUG_PRINTK("RID: [%llx] MEM_MALLOC: %d\n", *req_id, dp->mem_malloc);
+    struct fl_model *model = current_model(*req_id);
+    if (model) {
+        long long delta = normalize_datapoint(model, malloc_size, MALLOC_OFFSET);
+        update_outlier_score(ctx, model, *req_id, dp, delta, ts);
     }
+#endif
     return 0;
 };
 
 int probe_tcp_sendmsg(struct pt_regs *ctx, struct sock *sk, struct msghdr *hdr, size_t size) {
+#ifdef FL_DP_TCP_SENT
+    if (!FL_TRACKED_CURRENT()) {
+        return 0;
+    }
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id_p = tid_to_rid.lookup(&pid);
+    u64 *req_id_p = tid_to_rid.lookup(&pid);
 
     if (!req_id_p) {
         return 0;
     }
-    $RID_TYPE req_id = *req_id_p;
+    u64 req_id = *req_id_p;
 
     u64 ts = bpf_ktime_get_ns();
 
@@ -388,12 +848,15 @@ int probe_tcp_sendmsg(struct pt_regs *ctx, struct sock *sk, struct msghdr *hdr,
         return 0;
     }
     dp->tcp_sent += size;
+    fl_trace(ctx, FL_TR_TCP_SENT, pid, req_id, size, ts);
 
-    $DEBUG_PRINTK("RID: [%$REQ_TYPE_FORMAT] MEM_MALLOC: %d\n", req_id, dp->tcp_sent);
-    if (centroids_defined()) {
-        long long delta = normalize_datapoint(size, TCP_SENT_OFFSET);
-        update_outlier_score(req_id, delta, ts, dp->cputime);
+    $DEBUG_PRINTK("RID: [%llx] MEM_MALLOC: %d\n", req_id, dp->tcp_sent);
+    struct fl_model *model = current_model(req_id);
+    if (model) {
+        long long delta = normalize_datapoint(model, size, TCP_SENT_OFFSET);
+        update_outlier_score(ctx, model, req_id, dp, delta, ts);
     }
+#endif
     return 0;
 }
 
@@ -402,8 +865,11 @@ int probe_tcp_cleanup_rbuf(struct pt_regs *ctx, struct sock *sk, int copied) {
     if (copied <= 0) {
         return -1;
     }
+    if (!FL_TRACKED_CURRENT()) {
+        return 0;
+    }
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
     if (!req_id) {
         return 0;
     }
@@ -415,42 +881,55 @@ int probe_tcp_cleanup_rbuf(struct pt_regs *ctx, struct sock *sk, int copied) {
     if (!dp) {
         return 0;
     }
+#ifdef FL_DP_TCP_RCVD
     dp->tcp_rcvd += copied;
+#endif
+#if defined(FL_DP_TCP_RCVD) || defined(FL_DP_TCP_IDLE_TIME)
+    fl_trace(ctx, FL_TR_TCP_RCVD, pid, *req_id, copied, ts);
+#endif
+#ifdef FL_DP_TCP_IDLE_TIME
     if (dp->last_tcp_rcv_ts != 0) { // If not our first rcv()
         idle_time = ts - dp->last_tcp_rcv_ts;
         dp->tcp_idle_time += idle_time;
     }
     dp->last_tcp_rcv_ts = ts;
+#endif
+#ifdef FL_DP_SADDR
     if (dp->saddr == 0) {
         dp->saddr = sk->__sk_common.skc_daddr;
     }
+#endif
 
-    $DEBUG_PRINTK("RID [%$REQ_TYPE_FORMAT] SADDR: %d\n", *req_id, dp->saddr);
-    $DEBUG_PRINTK("RID [%$REQ_TYPE_FORMAT] TCP_RCV: %d\n", *req_id, dp->tcp_rcvd);
-    $DEBUG_PRINTK("RID [%$REQ_TYPE_FORMAT] TCP_IDLE_TIME: %lld\n", *req_id, dp->tcp_idle_time);
-    if (centroids_defined()) {
+    $DEBUG_PRINTK("RID [%llx] SADDR: %d\n", *req_id, DP_SADDR(dp));
+    $DEBUG_PRINTK("RID [%llx] TCP_RCV: %d, TCP_IDLE_TIME: %lld\n", *req_id, copied, idle_time);
+    struct fl_model *model = current_model(*req_id);
+    if (model) {
         if (idle_time) {
             //FIXME: There is an overflow problem that should disappear when we move
             //to bitshift rather than 10^ exponentiation for FPA.
             if (idle_time > 1000000000) {
                 bpf_trace_printk("idle time was greater than 1s: %s\n", idle_time);
                 long long delta = 1000000000000000;
-                update_outlier_score(*req_id, delta, ts, dp->cputime);
+                update_outlier_score(ctx, model, *req_id, dp, delta, ts);
             } else {
-                long long delta = normalize_datapoint(idle_time, IDLE_TIME_OFFSET);
-                update_outlier_score(*req_id, delta, ts, dp->cputime);
+                long long delta = normalize_datapoint(model, idle_time, IDLE_TIME_OFFSET);
+                update_outlier_score(ctx, model, *req_id, dp, delta, ts);
             }
         }
-        long long delta = normalize_datapoint(copied, TCP_RCVD_OFFSET);
-        update_outlier_score(*req_id, delta, ts, dp->cputime);
+        long long delta = normalize_datapoint(model, copied, TCP_RCVD_OFFSET);
+        update_outlier_score(ctx, model, *req_id, dp, delta, ts);
     }
     return 0;
 }
 
 int probe_cache_miss(struct bpf_perf_event_data *ctx) {
+#ifdef FL_DP_CACHE_MISSES
+    if (!FL_TRACKED_CURRENT()) {
+        return 0;
+    }
     bpf_trace_printk("cache miss\n!");
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
     if (!req_id) {
         return 0;
     }
@@ -461,19 +940,26 @@ int probe_cache_miss(struct bpf_perf_event_data *ctx) {
         return 0;
     }
     dp->cache_misses += ctx->sample_period;
+    fl_trace(ctx, FL_TR_CACHE_MISS, pid, *req_id, ctx->sample_period, ts);
 
-    $DEBUG_PRINTK("RID: [%$REQ_TYPE_FORMAT] CACHE_MISSES: %d\n", *req_id, dp->cache_misses);
-    if (centroids_defined()) {
-        long long delta = normalize_datapoint(ctx->sample_period, CACHE_MISSES_OFFSET);
-        update_outlier_score(*req_id, delta, ts, dp->cputime);
+    $DEBUG_PRINTK("RID: [%llx] CACHE_MISSES: %d\n", *req_id, dp->cache_misses);
+    struct fl_model *model = current_model(*req_id);
+    if (model) {
+        long long delta = normalize_datapoint(model, ctx->sample_period, CACHE_MISSES_OFFSET);
+        update_outlier_score(ctx, model, *req_id, dp, delta, ts);
     }
+#endif
     return 0;
 }
 
 int probe_cache_ref(struct bpf_perf_event_data *ctx) {
+#ifdef FL_DP_CACHE_REFS
+    if (!FL_TRACKED_CURRENT()) {
+        return 0;
+    }
     bpf_trace_printk("cache ref\n!");
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
     if (!req_id) {
         return 0;
     }
@@ -484,15 +970,24 @@ int probe_cache_ref(struct bpf_perf_event_data *ctx) {
         return 0;
     }
     dp->cache_refs += ctx->sample_period;
+    fl_trace(ctx, FL_TR_CACHE_REF, pid, *req_id, ctx->sample_period, ts);
 
-    $DEBUG_PRINTK("RID: [%$REQ_TYPE_FORMAT] CACHE_REFS: %d\n", *req_id, dp->cache_refs);
-    if (centroids_defined()) {
-        long long delta = normalize_datapoint(ctx->sample_period, CACHE_REFS_OFFSET);
-        update_outlier_score(*req_id, delta, ts, dp->cputime);
+    $DEBUG_PRINTK("RID: [%llx] CACHE_REFS: %d\n", *req_id, dp->cache_refs);
+    struct fl_model *model = current_model(*req_id);
+    if (model) {
+        long long delta = normalize_datapoint(model, ctx->sample_period, CACHE_REFS_OFFSET);
+        update_outlier_score(ctx, model, *req_id, dp, delta, ts);
     }
+#endif
     return 0;
 }
 
+/**
+ * Request mappers. ebpf_rewriter emits one copy of each mapper an application uses,
+ * renamed <mapper>_<app id>, with the id, rid type and rid positions of that
+ * application substituted. Everything below this comment is only used as templates.
+ */
+// FL_REQUEST_MAPPERS
 void new_assoc_2(struct pt_regs *ctx) {
     u64 ts = bpf_ktime_get_ns();
 
@@ -503,19 +998,22 @@ void new_assoc_2(struct pt_regs *ctx) {
     }
     //u64 ts = bpf_ktime_get_ns();
 
-    u32 idx = 0;
-    $RID_TYPE *prev_rid = max_rid.lookup(&idx);
+    u32 idx = $APP_ID;
+    u64 *prev_rid = max_rid.lookup(&idx);
     if (prev_rid == NULL) {
         return;
     }
     (*prev_rid) += 1;
-    $RID_TYPE next_rid = *prev_rid;
+    u64 next_rid = fl_key($APP_ID, *prev_rid);
+    if (!fl_sampled(next_rid)) {
+        return;
+    }
 
     lookup_or_init_dp(next_rid, ts);
     assoc_to_rid.update(&assoc, &next_rid);
 
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Associated [%lu] to req [%$REQ_TYPE_FORMAT].\n", assoc, next_rid);
+    $DEBUG_PRINTK("Associated [%lu] to req [%llx].\n", assoc, next_rid);
     $DEBUG_PRINTK("=======================================================\n");
     //struct datapoint dp = {.first_ts = ts, .last_tcp_rcv_ts = ts};
     //datapoints.insert(&next_rid, &dp);
@@ -524,7 +1022,7 @@ void new_assoc_2(struct pt_regs *ctx) {
 void start_assoc_1(struct pt_regs *ctx) {
     u64 ts = bpf_ktime_get_ns();
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id_p = tid_to_rid.lookup(&pid);
+    u64 *req_id_p = tid_to_rid.lookup(&pid);
     if (!req_id_p) {
         $DEBUG_PRINTK("=======================================================\n");
         $DEBUG_PRINTK("No association for pid [%d].\n", pid);
@@ -538,19 +1036,19 @@ void start_assoc_1(struct pt_regs *ctx) {
         return;
     }
 
-    $RID_TYPE req_id = *req_id_p;
+    u64 req_id = *req_id_p;
     lookup_or_init_dp(req_id, ts);
     assoc_to_rid.update(&assoc, &req_id);
 
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Associated [%lu] to req [%$REQ_TYPE_FORMAT]..\n", assoc, req_id);
+    $DEBUG_PRINTK("Associated [%lu] to req [%llx]..\n", assoc, req_id);
     $DEBUG_PRINTK("=======================================================\n");
 }
 
 void start_assoc_1_and_unmap(struct pt_regs *ctx) {
 
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id_p = tid_to_rid.lookup(&pid);
+    u64 *req_id_p = tid_to_rid.lookup(&pid);
     if (!req_id_p) {
         $DEBUG_PRINTK("=======================================================\n");
         $DEBUG_PRINTK("No association for pid [%d].\n", pid);
@@ -565,25 +1063,26 @@ void start_assoc_1_and_unmap(struct pt_regs *ctx) {
     }
     u64 ts = bpf_ktime_get_ns();
 
-    $RID_TYPE req_id = *req_id_p;
+    u64 req_id = *req_id_p;
     lookup_or_init_dp(req_id, ts);
     assoc_to_rid.update(&assoc, &req_id);
 
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Associated [%lu] to req [%$REQ_TYPE_FORMAT]..\n", assoc, req_id);
+    $DEBUG_PRINTK("Associated [%lu] to req [%llx]..\n", assoc, req_id);
     $DEBUG_PRINTK("=======================================================\n");
 
     update_array(ctx, pid, ts, req_id);
+    mark_unmapped(ctx, req_id, ts);
     tid_to_rid.delete(&pid);
 
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Unmapped tid [%d] from req [%$REQ_TYPE_FORMAT] assoc [%lu]\n", pid, req_id);
+    $DEBUG_PRINTK("Unmapped tid [%d] from req [%llx] assoc [%lu]\n", pid, req_id);
     $DEBUG_PRINTK("=======================================================\n");
 }
 
 void start_assoc_2(struct pt_regs *ctx) {
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id_p = tid_to_rid.lookup(&pid);
+    u64 *req_id_p = tid_to_rid.lookup(&pid);
     if (!req_id_p) {
         return;
     }
@@ -596,12 +1095,12 @@ void start_assoc_2(struct pt_regs *ctx) {
         return;
     }
 
-    $RID_TYPE req_id = *req_id_p;
+    u64 req_id = *req_id_p;
     lookup_or_init_dp(req_id, ts);
     assoc_to_rid.update(&assoc, &req_id);
 
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Associated [%lu] to req [%$REQ_TYPE_FORMAT]...\n", assoc, req_id);
+    $DEBUG_PRINTK("Associated [%lu] to req [%llx]...\n", assoc, req_id);
     $DEBUG_PRINTK("=======================================================\n");
 }
 
@@ -611,7 +1110,7 @@ void map_tid_to_rid_3(struct pt_regs *ctx) {
     if (assoc == 0) {
         return;
     }
-    $RID_TYPE *req_id_p = assoc_to_rid.lookup(&assoc);
+    u64 *req_id_p = assoc_to_rid.lookup(&assoc);
     if (req_id_p == NULL) {
         $DEBUG_PRINTK("=======================================================\n");
         $DEBUG_PRINTK("No mapping for assoc %lu\n", assoc);
@@ -629,12 +1128,13 @@ void map_tid_to_rid_3(struct pt_regs *ctx) {
     }
 
 
-    $RID_TYPE req_id = *req_id_p;
+    u64 req_id = *req_id_p;
     tid_to_rid.insert(&pid, &req_id);
     u64 ts = bpf_ktime_get_ns();
     start.update(&pid, &ts);
+    fl_trace(ctx, FL_TR_MAP, pid, req_id, 0, ts);
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Mapped tid [%d] to req [%$REQ_TYPE_FORMAT] assoc [%lu]\n", pid, req_id, assoc);
+    $DEBUG_PRINTK("Mapped tid [%d] to req [%llx] assoc [%lu]\n", pid, req_id, assoc);
     $DEBUG_PRINTK("=======================================================\n");
 }
 
@@ -644,7 +1144,7 @@ void map_tid_to_rid_1(struct pt_regs *ctx) {
     if (assoc == 0) {
         return;
     }
-    $RID_TYPE *req_id_p = assoc_to_rid.lookup(&assoc);
+    u64 *req_id_p = assoc_to_rid.lookup(&assoc);
     if (req_id_p == NULL) {
         $DEBUG_PRINTK("=======================================================\n");
         $DEBUG_PRINTK("No mapping for assoc %lu\n", assoc);
@@ -662,12 +1162,13 @@ void map_tid_to_rid_1(struct pt_regs *ctx) {
     }
 
 
-    $RID_TYPE req_id = *req_id_p;
+    u64 req_id = *req_id_p;
     tid_to_rid.insert(&pid, &req_id);
     u64 ts = bpf_ktime_get_ns();
     start.update(&pid, &ts);
+    fl_trace(ctx, FL_TR_MAP, pid, req_id, 0, ts);
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Mapped tid [%d] to req [%$REQ_TYPE_FORMAT] assoc [%lu]\n", pid, req_id, assoc);
+    $DEBUG_PRINTK("Mapped tid [%d] to req [%llx] assoc [%lu]\n", pid, req_id, assoc);
     $DEBUG_PRINTK("=======================================================\n");
 }
 
@@ -680,17 +1181,20 @@ void ap_map_conn_to_rid(struct pt_regs *ctx) {
     }
     //u64 ts = bpf_ktime_get_ns();
 
-    u32 idx = 0;
-    $RID_TYPE *prev_rid = max_rid.lookup(&idx);
+    u32 idx = $APP_ID;
+    u64 *prev_rid = max_rid.lookup(&idx);
     if (prev_rid == NULL) {
         return;
     }
     (*prev_rid) += 1;
-    $RID_TYPE next_rid = *prev_rid;
+    u64 next_rid = fl_key($APP_ID, *prev_rid);
+    if (!fl_sampled(next_rid)) {
+        return;
+    }
 
     assoc_to_rid.update(&conn, &next_rid);
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Mapped conn [%lu] to req [%$REQ_TYPE_FORMAT]\n", conn, next_rid);
+    $DEBUG_PRINTK("Mapped conn [%lu] to req [%llx]\n", conn, next_rid);
     $DEBUG_PRINTK("=======================================================\n");
 
     //struct datapoint dp = {.first_ts = ts, .last_tcp_rcv_ts = ts};
@@ -707,7 +1211,7 @@ void ap_map_tid_to_rid(struct pt_regs *ctx) {
         return;
     }
 
-    $RID_TYPE *req_id_p = assoc_to_rid.lookup(&conn);
+    u64 *req_id_p = assoc_to_rid.lookup(&conn);
     if (req_id_p == NULL) {
         $DEBUG_PRINTK("=======================================================\n");
         $DEBUG_PRINTK("no rid mapped to conn [%lu]\n", conn);
@@ -715,23 +1219,25 @@ void ap_map_tid_to_rid(struct pt_regs *ctx) {
         return;
     }
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE req_id = *req_id_p;
+    u64 req_id = *req_id_p;
     tid_to_rid.insert(&pid, &req_id);
     u64 ts = bpf_ktime_get_ns();
     start.update(&pid, &ts);
+    fl_trace(ctx, FL_TR_MAP, pid, req_id, 0, ts);
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Mapped tid [%d] to req [%$REQ_TYPE_FORMAT]\n", pid, req_id);
+    $DEBUG_PRINTK("Mapped tid [%d] to req [%llx]\n", pid, req_id);
     $DEBUG_PRINTK("=======================================================\n");
 }
 
 void ap_unmap_tid_to_rid(struct pt_regs *ctx) {
     u64 ts = bpf_ktime_get_ns();
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
     if (!req_id) {
         return;
     }
     update_array(ctx, pid, ts, *req_id);
+    mark_unmapped(ctx, *req_id, ts);
     tid_to_rid.delete(&pid);
 
     /*
@@ -742,34 +1248,40 @@ void ap_unmap_tid_to_rid(struct pt_regs *ctx) {
     }*/
 
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Unmapped tid [%d] from req [%$REQ_TYPE_FORMAT]\n", pid, *req_id);
+    $DEBUG_PRINTK("Unmapped tid [%d] from req [%llx]\n", pid, *req_id);
     $DEBUG_PRINTK("=======================================================\n");
 }
 
 void map_tid_to_rid(struct pt_regs *ctx) {
-    $RID_TYPE req_id;
-    bpf_probe_read(&req_id, sizeof(req_id), (void *)&PT_REGS_PARM3(ctx));
-    if (req_id == 0) {
+    $RID_TYPE rid;
+    bpf_probe_read(&rid, sizeof(rid), (void *)&PT_REGS_PARM3(ctx));
+    if (rid == 0) {
+        return;
+    }
+    u64 req_id = fl_key($APP_ID, rid);
+    if (!fl_sampled(req_id)) {
         return;
     }
-    bpf_trace_printk("mapping req %d\n", req_id);
+    bpf_trace_printk("mapping req %llx\n", req_id);
     u32 pid = bpf_get_current_pid_tgid();
     tid_to_rid.insert(&pid, &req_id);
     u64 ts = bpf_ktime_get_ns();
     start.update(&pid, &ts);
+    fl_trace(ctx, FL_TR_MAP, pid, req_id, 0, ts);
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Mapped tid [%d] to req [%$REQ_TYPE_FORMAT]\n", pid, req_id);
+    $DEBUG_PRINTK("Mapped tid [%d] to req [%llx]\n", pid, req_id);
     $DEBUG_PRINTK("=======================================================\n");
 }
 
 void unmap_tid_to_rid(struct pt_regs *ctx) {
     u64 ts = bpf_ktime_get_ns();
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
     if (!req_id) {
         return;
     }
     update_array(ctx, pid, ts, *req_id);
+    mark_unmapped(ctx, *req_id, ts);
     tid_to_rid.delete(&pid);
 
     /*
@@ -780,34 +1292,40 @@ void unmap_tid_to_rid(struct pt_regs *ctx) {
     }*/
 
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Unmapped tid [%d] from req [%$REQ_TYPE_FORMAT]\n", pid, *req_id);
+    $DEBUG_PRINTK("Unmapped tid [%d] from req [%llx]\n", pid, *req_id);
     $DEBUG_PRINTK("=======================================================\n");
 }
 
 /****************************** DMTR request mappers *****************************/
 void dmtr_map_tid_to_iter(struct pt_regs *ctx) {
-    $RID_TYPE req_id;
-    bpf_probe_read(&req_id, sizeof(req_id), (void *)&PT_REGS_PARM$(dmtr_map_tid_to_iter)(ctx));
-    if (req_id == 0) {
+    $RID_TYPE rid;
+    bpf_probe_read(&rid, sizeof(rid), (void *)&PT_REGS_PARM$(dmtr_map_tid_to_iter)(ctx));
+    if (rid == 0) {
+        return;
+    }
+    u64 req_id = fl_key($APP_ID, rid);
+    if (!fl_sampled(req_id)) {
         return;
     }
     u32 pid = bpf_get_current_pid_tgid();
     tid_to_rid.insert(&pid, &req_id);
     u64 ts = bpf_ktime_get_ns();
     start.update(&pid, &ts);
+    fl_trace(ctx, FL_TR_MAP, pid, req_id, 0, ts);
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Mapped tid [%d] to req [%$REQ_TYPE_FORMAT]\n", pid, req_id);
+    $DEBUG_PRINTK("Mapped tid [%d] to req [%llx]\n", pid, req_id);
     $DEBUG_PRINTK("=======================================================\n");
 }
 
 void dmtr_unmap_tid_to_iter(struct pt_regs *ctx) {
     u64 ts = bpf_ktime_get_ns();
     u32 pid = bpf_get_current_pid_tgid();
-    $RID_TYPE *req_id = tid_to_rid.lookup(&pid);
+    u64 *req_id = tid_to_rid.lookup(&pid);
     if (!req_id) {
         return;
     }
     update_array(ctx, pid, ts, *req_id);
+    mark_unmapped(ctx, *req_id, ts);
     tid_to_rid.delete(&pid);
 
     /*
@@ -818,7 +1336,7 @@ void dmtr_unmap_tid_to_iter(struct pt_regs *ctx) {
     }*/
 
     $DEBUG_PRINTK("=======================================================\n");
-    $DEBUG_PRINTK("Unmapped tid [%d] from req [%$REQ_TYPE_FORMAT]\n", pid, *req_id);
+    $DEBUG_PRINTK("Unmapped tid [%d] from req [%llx]\n", pid, *req_id);
     $DEBUG_PRINTK("=======================================================\n");
 }
 /****************************** DMTR request mappers *****************************/
@@ -0,0 +1,57 @@
+/*
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+*/
+
+#include <uapi/linux/bpf.h>
+#include <linux/if_ether.h>
+#include <linux/ip.h>
+
+/**
+ * Drops IPv4 packets from the sources in FineLame's blocklist map, which the agent pins
+ * at $PIN_PATH. Entries map an address to its expiry (bpf_ktime_get_ns time, 0 for never).
+ */
+BPF_TABLE_PINNED("hash", u32, u64, blocklist, 65536, "$PIN_PATH");
+BPF_PERCPU_ARRAY(dropped, u64, 1);
+
+int xdp_blocklist(struct xdp_md *ctx) {
+    void *data = (void *)(long)ctx->data;
+    void *data_end = (void *)(long)ctx->data_end;
+
+    struct ethhdr *eth = data;
+    if ((void *)(eth + 1) > data_end || eth->h_proto != htons(ETH_P_IP)) {
+        return XDP_PASS;
+    }
+    struct iphdr *ip = (void *)(eth + 1);
+    if ((void *)(ip + 1) > data_end) {
+        return XDP_PASS;
+    }
+
+    u32 saddr = ip->saddr;
+    u64 *expiry = blocklist.lookup(&saddr);
+    if (!expiry || (*expiry != 0 && *expiry <= bpf_ktime_get_ns())) {
+        return XDP_PASS;
+    }
+
+    int zero = 0;
+    u64 *count = dropped.lookup(&zero);
+    if (count) {
+        (*count)++;
+    }
+    return XDP_DROP;
+}
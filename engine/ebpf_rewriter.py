@@ -18,28 +18,238 @@ START OF LICENSE STUB
 END OF LICENSE STUB
 '''
 
+import hashlib
+import json
 import os
+import re
 import sys
 
+MAPPERS_MARKER = '// FL_REQUEST_MAPPERS'
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                 'finelame')
+
+# Part of every cache key: bump when the layout of cached programs changes. The rewriter's
+# own source is hashed in too, so editing a substitution invalidates what it produced.
+CACHE_FORMAT = 1
+
+def rewriter_hash():
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+REWRITER_HASH = rewriter_hash()
+
 def sub_debug(src, debug):
     return src.replace("$DEBUG_PRINTK", "bpf_trace_printk" if debug else "IGNORE")
 
-def sub_k(src, detector):
-    return src.replace("$K", str(detector.k))
+def sub_k(src, k):
+    return src.replace("$K", str(k))
 
-def sub_mscale(src, detector):
+def sub_percpu(src, percpu):
+    return src.replace("$PERCPU", "#define FL_PERCPU 1" if percpu else "")
 
-    if detector.scale_method == 'exponent':
-        insertion = ' * %d ' % detector.m_scale
-    elif detector.scale_method == 'bitshift':
-        insertion = ' << %d ' % detector.m_scaler
+def sub_sampling(src, sampling):
+    return src.replace("$SAMPLING", "#define FL_SAMPLING 1" if sampling else "")
 
-    while '$MSCALE(' in src:
-        start = src.find("$MSCALE(")
-        endparens = src.find(')', start)
-        src = src[:endparens+1] + insertion + src[endparens+1:]
-        src = src.replace("$MSCALE", "", 1)
-    return src
+'''
+Fields struct datapoint can hold, as (name, C type, size, feature offset macro).
+Fields with an offset macro are counters the model can use as features.
+'''
+DATAPOINT_FIELDS = [
+    ('latest_ts_update', 'u64', 8, None),
+    ('first_ts', 'u64', 8, None),
+    ('last_unmap_ts', 'u64', 8, None),
+    ('cputime', 'u64', 8, 'CPUTIME'),
+    ('pgfaults', 'u64', 8, 'PGFAULT'),
+    ('mem_malloc', 'size_t', 8, 'MALLOC'),
+    ('tcp_sent', 'size_t', 8, 'TCP_SENT'),
+    ('tcp_rcvd', 'size_t', 8, 'TCP_RCVD'),
+    ('tcp_idle_time', 'u64', 8, 'IDLE_TIME'),
+    ('last_tcp_rcv_ts', 'u64', 8, None),
+    ('saddr', 'u32', 4, None),
+    ('n_cputime_updates', 'int', 4, None),
+    ('cache_misses', 'u32', 4, 'CACHE_MISSES'),
+    ('cache_refs', 'u32', 4, 'CACHE_REFS'),
+]
+# Fields every program holds: the drain and request timestamps rely on them
+REQUIRED_FIELDS = ('latest_ts_update', 'first_ts', 'last_unmap_ts')
+# Fields other fields are computed from
+FIELD_DEPENDENCIES = dict(cputime = ('n_cputime_updates',),
+                          tcp_idle_time = ('last_tcp_rcv_ts',))
+# Layout without a configuration: every field, and the historical feature order
+DEFAULT_FEATURE_FIELDS = ['cputime', 'mem_malloc', 'pgfaults', 'tcp_idle_time', 'tcp_sent', 'tcp_rcvd']
+
+def datapoint_layout(request_stats=None, feature_fields=None, extra_fields=()):
+    '''
+    Fields of struct datapoint and the datapoint field of each model feature, in order.
+    Holds the fields request_stats reads, the feature fields, extra_fields, and those
+    they depend on. Without request_stats, every field.
+    '''
+    if feature_fields is None:
+        feature_fields = DEFAULT_FEATURE_FIELDS
+    known = {name: offset for name, _, _, offset in DATAPOINT_FIELDS}
+    for field in feature_fields:
+        if known.get(field, None) is None:
+            raise Exception('Datapoint field {} cannot be a model feature'.format(field))
+
+    if request_stats is None:
+        wanted = set(known)
+    else:
+        wanted = set(REQUIRED_FIELDS) | set(feature_fields) | set(extra_fields)
+        wanted |= set(stat['datapoint'] for stat in request_stats.values())
+    for field in list(wanted):
+        if field not in known:
+            raise Exception('Unknown datapoint field {}'.format(field))
+        wanted.update(FIELD_DEPENDENCIES.get(field, ()))
+
+    return dict(fields = [name for name, _, _, _ in DATAPOINT_FIELDS if name in wanted],
+                features = list(feature_fields))
+
+def config_layout(cfg, features=None):
+    ''' Layout for an agent configuration; features are the model's, as request_stats names '''
+    request_stats = cfg['request_stats']
+    for feature in features or []:
+        if feature not in request_stats:
+            raise Exception('Feature {} is missing from request_stats'.format(feature))
+    # Mitigation acts on the source address of requests
+    return datapoint_layout(request_stats, [request_stats[f]['datapoint'] for f in features or []],
+                            extra_fields=('saddr',) if 'mitigation' in cfg else ())
+
+def datapoint_size(layout):
+    ''' sizeof(struct datapoint): 8-byte fields come first, so only the tail is padded '''
+    sizes = {name: size for name, _, size, _ in DATAPOINT_FIELDS}
+    size = sum(sizes[name] for name in layout['fields'])
+    return (size + 7) // 8 * 8
+
+def sub_datapoint_layout(src, layout):
+    ''' Generate struct datapoint, its FL_DP_* defines, N_FEATURES and the feature offsets '''
+    n_features = len(layout['features'])
+    lines = ['struct datapoint {']
+    for name, ctype, _, _ in DATAPOINT_FIELDS:
+        if name in layout['fields']:
+            lines.append('    {} {};'.format(ctype, name))
+    lines.append('};')
+    lines.append('')
+    for name in layout['fields']:
+        lines.append('#define FL_DP_{} 1'.format(name.upper()))
+    lines.append('')
+    # A model always has room for one feature, so that its arrays are never empty
+    lines.append('#define N_FEATURES {}'.format(max(n_features, 1)))
+    lines.append('#define FL_FOR_EACH_FEATURE(X) {}'.format(
+                 ' '.join('X({}, {})'.format(i, field) for i, field in enumerate(layout['features']))))
+    for name, _, _, offset in DATAPOINT_FIELDS:
+        if offset is not None:
+            idx = layout['features'].index(name) if name in layout['features'] else 'N_FEATURES'
+            lines.append('#define {}_OFFSET {}'.format(offset, idx))
+    return src.replace('$DATAPOINT_LAYOUT', '\n'.join(lines))
+
+# Kernel bookkeeping of a hash map element (struct htab_elem), roughly
+HTAB_ELEM_OVERHEAD = 48
+
+# Request and thread tracking maps: key and value sizes are filled in by map_footprint
+TRACKING_MAPS = ('datapoints', 'outlier_scores_m', 'assoc_to_rid', 'tid_to_rid', 'start')
+REQUEST_MAPS = ('datapoints', 'outlier_scores_m', 'assoc_to_rid')
+DEFAULT_MAX_REQUESTS = 4194304
+# bcc's default size for BPF_HASH
+DEFAULT_MAX_THREADS = 10240
+MIN_MAP_ENTRIES = 1024
+MAX_MAP_ENTRIES = 1 << 26
+DEFAULT_HEADROOM = 2
+
+def _pow2(n):
+    return 1 << max(int(n) - 1, 0).bit_length()
+
+def map_config(cfg):
+    '''
+    Type ('hash' or 'lru'), preallocation and size of every tracking map, from the maps
+    section of the configuration. Request maps are sized for requests_per_second times
+    the time requests stay in them (the harvest interval plus complete_age) times
+    headroom, rounded up to a power of two; max_entries sets a map's size directly.
+    '''
+    maps_cfg = cfg.get('maps') or {}
+    request_entries = DEFAULT_MAX_REQUESTS
+    rps = maps_cfg.get('requests_per_second', None)
+    if rps is not None:
+        if 'harvest' not in cfg:
+            raise Exception('Sizing maps from requests_per_second needs the harvest section, '
+                            'without it requests stay in the maps until the agent stops')
+        harvest = cfg['harvest'] or {}
+        retention = harvest.get('interval', 5) + harvest.get('complete_age', 1)
+        request_entries = rps * retention * maps_cfg.get('headroom', DEFAULT_HEADROOM)
+        request_entries = min(max(_pow2(request_entries), MIN_MAP_ENTRIES), MAX_MAP_ENTRIES)
+
+    maps = dict()
+    for name in TRACKING_MAPS:
+        map_cfg = maps_cfg.get(name) or {}
+        map_type = map_cfg.get('type', 'hash')
+        prealloc = map_cfg.get('prealloc', True)
+        if map_type not in ('hash', 'lru'):
+            raise Exception('Map {} has unknown type {}: use hash or lru'.format(name, map_type))
+        if map_type == 'lru' and not prealloc:
+            raise Exception('LRU map {} must be preallocated'.format(name))
+        default = request_entries if name in REQUEST_MAPS else DEFAULT_MAX_THREADS
+        maps[name] = dict(type = map_type, prealloc = prealloc,
+                          max_entries = int(map_cfg.get('max_entries', default)))
+    return maps
+
+def sub_maps(src, maps, percpu=False):
+    ''' Declare the tracking maps with the table type, size and flags of their configuration '''
+    lines = list()
+    for name, map_cfg in maps.items():
+        table_type = 'hash'
+        if name == 'datapoints' and percpu:
+            table_type = 'percpu_hash'
+        if map_cfg['type'] == 'lru':
+            table_type = 'lru_' + table_type
+        macro = 'FL_MAP_{}'.format(name.upper())
+        lines.append('#define {}_TYPE "{}"'.format(macro, table_type))
+        lines.append('#define {}_ENTRIES {}'.format(macro, map_cfg['max_entries']))
+        lines.append('#define {}_FLAGS {}'.format(macro, '0' if map_cfg['prealloc'] else 'BPF_F_NO_PREALLOC'))
+    return src.replace('$MAP_CONFIG', '\n'.join(lines))
+
+def map_footprint(layout, k, maps=None, percpu=False, n_cpus=None):
+    '''
+    Bytes used per entry and in total by the tracking maps at full capacity. Hash map
+    elements also carry about HTAB_ELEM_OVERHEAD bytes of kernel bookkeeping, and keys
+    and values are padded to 8 bytes; per-CPU maps store a value per possible CPU.
+    Preallocated maps use their total from the start, others as they fill up.
+    '''
+    maps = maps or map_config({})
+    n_cpus = n_cpus or os.cpu_count()
+    # struct outlier_score: distances[K], model_version, is_outlier (padded), three timestamps
+    sizes = dict(datapoints = (8, datapoint_size(layout), n_cpus if percpu else 1),
+                 outlier_scores_m = (8, 8 * k + 8 + 8 + 3 * 8, 1),
+                 assoc_to_rid = (8, 8, 1),
+                 tid_to_rid = (8, 8, 1),
+                 start = (8, 8, 1))
+    footprint = dict()
+    for name, map_cfg in maps.items():
+        key_size, value_size, copies = sizes[name]
+        entry = HTAB_ELEM_OVERHEAD + key_size + value_size * copies
+        footprint[name] = dict(value_size = value_size, entry_size = entry,
+                               max_entries = map_cfg['max_entries'], type = map_cfg['type'],
+                               prealloc = map_cfg['prealloc'], total = entry * map_cfg['max_entries'])
+    return footprint
+
+def sub_histograms(src, histograms):
+    ''' Compile in the feature histograms, and the cluster ones if asked to '''
+    defines = ''
+    if histograms is not None:
+        defines = '#define FL_HISTOGRAMS 1'
+        if histograms.get('clusters', False):
+            defines += '\n#define FL_HIST_CLUSTERS 1'
+    return src.replace('$HISTOGRAMS', defines)
+
+def sub_cascade(src, cascade):
+    ''' Compile in the verdicts map of the detection cascade '''
+    return src.replace('$CASCADE', '#define FL_CASCADE 1' if cascade else '')
+
+def sub_proc_filter(src, proc_filter):
+    ''' Compile in the process filter of system-wide probes, with its number of slots '''
+    defines = ''
+    if proc_filter is not None:
+        defines = '#define FL_PROC_FILTER 1\n#define FL_FILTER_SLOTS {}'.format(proc_filter['slots'])
+    return src.replace('$PROC_FILTER', defines)
 
 def sub_ridtype(src, application):
     rid_type = application['rid_type'] if 'rid_type' in application else 'u32'
@@ -58,27 +268,211 @@ def sub_ridtype(src, application):
     src = src.replace('$REQ_TYPE_FORMAT', str(rid_printf))
     return src
 
+def app_names(applications):
+    ''' Application names: their 'name' entry, or the name of their executable '''
+    names = []
+    for app_id, application in enumerate(applications):
+        name = application.get('name', os.path.basename(application['exec_path']))
+        if name in names:
+            name = '{}{}'.format(name, app_id)
+        names.append(name)
+    return names
+
+def app_fn_name(fn_name, app_id):
+    ''' Name of an application's copy of a request mapper '''
+    return '{}_{}'.format(fn_name, app_id)
+
+def split_mappers(src):
+    ''' Split the request mapper templates into a dict of name -> function source '''
+    mappers = dict()
+    for match in re.finditer(r'^void (\w+)\(struct pt_regs \*ctx\) \{\n.*?^\}\n', src,
+                             re.MULTILINE | re.DOTALL):
+        mappers[match.group(1)] = match.group(0)
+    return mappers
+
+def sub_app_mappers(mappers, app_id, application):
+    ''' Instantiate the mappers an application uses '''
+    src = ''
+    fn_names = []
+    for rm in application['monitors']:
+        for fn_name in (rm.get('in_fn_name'), rm.get('ret_fn_name')):
+            if fn_name is not None and fn_name not in fn_names:
+                fn_names.append(fn_name)
+
+    for fn_name in fn_names:
+        if fn_name not in mappers:
+            print("Unknown request mapper: %s" % fn_name)
+            sys.exit()
+        fn_src = mappers[fn_name].replace('void %s(' % fn_name,
+                                          'void %s(' % app_fn_name(fn_name, app_id), 1)
+        src += fn_src.replace('$APP_ID', str(app_id)) + '\n'
+
+    src = sub_ridtype(src, application)
+    for rm in application['monitors']:
+        src = sub_rmp(src, rm)
+    return src
+
 def sub_rmp(src, rm):
     rid_position = rm['rid_position'] if 'rid_position' in rm else '1'
     rm_var = '$(' + rm['in_fn_name'] + ')'
     return src.replace(rm_var, str(rid_position))
 
-def rewrite_ebpf(src_file, application, debug, detector=None, suffix="_rewritten"):
+def sub_events(src, events):
+    ''' Declare the event channel as a ring buffer or a perf buffer, or disable it '''
+    if events is None:
+        output = 'BPF_PERF_OUTPUT(fl_events);'
+        emit = ''
+    elif events['buffer'] == 'ringbuf':
+        output = 'BPF_RINGBUF_OUTPUT(fl_events, %d);' % events['pages']
+        emit = 'ret = fl_events.ringbuf_output(evt, sizeof(*evt), 0);'
+    elif events['buffer'] == 'perf':
+        output = 'BPF_PERF_OUTPUT(fl_events);'
+        emit = 'ret = fl_events.perf_submit(ctx, evt, sizeof(*evt));'
+    else:
+        print("Non handled event buffer (ringbuf/perf)")
+        sys.exit()
+
+    src = src.replace('$EVENTS_OUTPUT', output)
+    return src.replace('$EMIT_EVENT', emit)
+
+def sub_trace(src, trace):
+    ''' Declare the trace buffer and define FL_TRACE, or leave fl_trace() empty '''
+    if trace is None:
+        output = ''
+        emit = ''
+    elif trace['buffer'] == 'ringbuf':
+        output = '#define FL_TRACE 1\nBPF_RINGBUF_OUTPUT(fl_trace_records, %d);' % trace['pages']
+        emit = 'ret = fl_trace_records.ringbuf_output(&rec, sizeof(rec), 0);'
+    elif trace['buffer'] == 'perf':
+        output = '#define FL_TRACE 1\nBPF_PERF_OUTPUT(fl_trace_records);'
+        emit = 'ret = fl_trace_records.perf_submit(ctx, &rec, sizeof(rec));'
+    else:
+        print("Non handled trace buffer (ringbuf/perf)")
+        sys.exit()
+
+    src = src.replace('$TRACE_OUTPUT', output)
+    return src.replace('$EMIT_TRACE', emit)
+
+def kernel_id():
+    ''' Identify the running kernel and the headers programs are compiled against '''
+    uname = os.uname()
+    headers = '/lib/modules/{}/build'.format(uname.release)
+    autoconf = os.path.join(headers, 'include/generated/autoconf.h')
+    mtime = os.stat(autoconf).st_mtime if os.path.exists(autoconf) else None
+    return [uname.release, uname.version, os.path.realpath(headers), mtime]
+
+def cache_key(src, applications, debug, detectors, events, percpu=False, sampling=False, layout=None,
+              histograms=None, maps=None, trace=None, cascade=False, proc_filter=None):
+    ''' Hash of everything the rewritten program depends on '''
+    inputs = dict(applications = [dict(monitors = app['monitors'],
+                                       rid_type = app.get('rid_type', 'u32'))
+                                  for app in applications],
+                  layout = layout or datapoint_layout(),
+                  maps = maps or map_config({}),
+                  debug = bool(debug),
+                  percpu = bool(percpu),
+                  sampling = bool(sampling),
+                  cascade = bool(cascade),
+                  proc_filter = proc_filter and dict(slots = proc_filter['slots']),
+                  histograms = None if histograms is None else \
+                               dict(clusters = bool(histograms.get('clusters', False))),
+                  events = events and dict(buffer = events['buffer'], pages = events['pages']),
+                  trace = trace and dict(buffer = trace['buffer'], pages = trace['pages']),
+                  kernel = kernel_id(),
+                  format = CACHE_FORMAT,
+                  rewriter = REWRITER_HASH)
+    if detectors:
+        inputs.update(k = max(detector.k for detector in detectors))
+    h = hashlib.sha256(src.encode())
+    h.update(json.dumps(inputs, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:32]
+
+def rewrite_ebpf(src_file, applications, debug, detectors=None, events=None, percpu=False,
+                 sampling=False, layout=None, histograms=None, maps=None, trace=None,
+                 cascade=False, proc_filter=None, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Generate a single program for all applications. detectors holds the anomaly detector
+    of each application (None when not detecting): the kernel is built for the largest k
+    among them. Without detectors, the program
+    is built for a single, never loaded, cluster. percpu selects per-CPU datapoints, and
+    sampling makes request mappers track a share of requests set at run time. layout
+    (see datapoint_layout) picks the fields of struct datapoint, all of them by default.
+    histograms, if not None, enables the feature histograms (and cluster ones with its
+    clusters entry). maps (see map_config) sets the type and size of the tracking maps.
+    trace, if not None, makes probes push a record per accounted resource event
+    (see engine/trace). cascade compiles in the verdicts map of the detection cascade.
+    proc_filter, if not None, makes system-wide probes skip tasks outside the processes
+    the agent publishes, in up to its slots entry (see engine/proc_filter).
+    Rewritten programs are stored in cache_dir under a hash of their inputs, and reused as
+    long as neither the source, the substitution inputs, the rewriter nor the kernel change.
+    Only the rewrite is cached: bcc still compiles the program at every start.
+    Returns the path of the rewritten program and whether it came from the cache.
+    '''
     with open(src_file) as f:
         src = f.read()
 
-    src = sub_debug(src, debug)
-    if detector is not None:
-        src = sub_k(src, detector)
-        src = sub_mscale(src, detector)
-    src = sub_ridtype(src, application)
-    for rm in application['monitors']:
-        src = sub_rmp(src, rm)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, mode=0o700)
+    name = os.path.splitext(os.path.basename(src_file))[0]
+    dst_file = os.path.join(cache_dir, '{}_{}.c'.format(name, cache_key(src, applications, debug,
+                                                                        detectors, events, percpu,
+                                                                        sampling, layout, histograms,
+                                                                        maps, trace, cascade,
+                                                                        proc_filter)))
+    if os.path.exists(dst_file):
+        return dst_file, True
 
-    path, ext = os.path.splitext(src_file)
-    dst_file = path+suffix+ext
+    src, templates = src.split(MAPPERS_MARKER, 1)
+    mappers = split_mappers(templates)
+    for app_id, application in enumerate(applications):
+        src += sub_app_mappers(mappers, app_id, application)
 
-    with open(dst_file, 'w') as f:
+    src = sub_debug(src, debug)
+    src = sub_datapoint_layout(src, layout or datapoint_layout())
+    src = sub_percpu(src, percpu)
+    src = sub_maps(src, maps or map_config({}), percpu)
+    src = sub_sampling(src, sampling)
+    src = sub_histograms(src, histograms)
+    src = sub_cascade(src, cascade)
+    src = sub_proc_filter(src, proc_filter)
+    if detectors:
+        src = sub_k(src, max(detector.k for detector in detectors))
+    else:
+        src = sub_k(src, 1)
+    src = src.replace('$N_APPS', str(len(applications)))
+    src = sub_events(src, events)
+    src = sub_trace(src, trace)
+
+    tmp_file = '{}.{}.tmp'.format(dst_file, os.getpid())
+    with open(tmp_file, 'w') as f:
         f.write(src)
+    os.rename(tmp_file, dst_file)
+
+    return dst_file, False
+
+if __name__ == '__main__':
+    import argparse
+    import yaml
+    from .finelame import FinelameDetector, app_model_params
+
+    parser = argparse.ArgumentParser(description='Report the request maps footprint of a configuration')
+    parser.add_argument('config_file', help='config file')
+    parser.add_argument('--percpu', action='store_true', default=None, help='Per-CPU datapoints')
+    args = parser.parse_args()
+
+    with open(args.config_file) as f:
+        cfg = yaml.safe_load(f)
+    FDs = [FinelameDetector(app_model_params(cfg, application)) for application in cfg['applications']]
+    layout = config_layout(cfg, FDs[0].features)
+    percpu = args.percpu if args.percpu is not None else cfg.get('percpu', False)
+    footprint = map_footprint(layout, max(FD.k for FD in FDs), map_config(cfg), percpu)
 
-    return dst_file
+    full = datapoint_layout()
+    print('struct datapoint: {} bytes ({} with every field): {}'.format(
+          datapoint_size(layout), datapoint_size(full), ', '.join(layout['fields'])))
+    print('features: {}'.format(', '.join(layout['features'])))
+    for name, fp in footprint.items():
+        print('{}: {} {}, {} bytes per entry, {:.1f} MiB for {} entries{}'.format(
+              name, fp['type'], 'map' if fp['prealloc'] else 'map (not preallocated)',
+              fp['entry_size'], fp['total'] / 2**20, fp['max_entries'],
+              '' if fp['prealloc'] else ' at most'))
@@ -0,0 +1,175 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from logger import *
+from .metrics import METRICS
+
+NS_PER_S = 1000 * 1000 * 1000
+
+# Datapoint fields each resource probe of the eBPF program accounts. Probes that are not
+# listed (request mappers, application probes) are never detached.
+PROBE_FIELDS = dict(
+    sched_switch = ('cputime',),
+    update_cputime = ('cputime',),
+    handle_pg_fault = ('pgfaults',),
+    probe_malloc = ('mem_malloc',),
+    probe_realloc = ('mem_malloc',),
+    ap_probe_malloc = ('mem_malloc',),
+    probe_tcp_sendmsg = ('tcp_sent',),
+    probe_tcp_cleanup_rbuf = ('tcp_rcvd', 'tcp_idle_time', 'saddr'),
+    probe_cache_miss = ('cache_misses',),
+    probe_cache_ref = ('cache_refs',),
+)
+
+DEFAULT_MIN_IMPORTANCE = 0.001
+DEFAULT_SAMPLE = 100000
+
+class FeatureSelector():
+    '''
+    Rates the features of freshly trained models, and optionally prunes those that do
+    not contribute. The probes' run time over the training period, from the kernel's
+    per-program statistics, is attributed to the features their datapoint fields feed
+    (a probe feeding several features counts for each). When a model is trained,
+    FinelameDetector.feature_importance rates its features; with prune, those below
+    min_importance (except the keep list, and at least the most important feature) are
+    dropped and the model is trained again without them. Once every application is
+    trained, detach removes the monitors whose fields neither the models nor the agent
+    read anymore. Ratings and decisions are written to the features table.
+    '''
+
+    def __init__(self, bm, app_names, features, request_stats, prune=False,
+                 min_importance=DEFAULT_MIN_IMPORTANCE, keep=(), sample=DEFAULT_SAMPLE, needed=()):
+        self.BM = bm
+        self.app_names = app_names
+        self.features = features
+        self.fields = {f: request_stats[f]['datapoint'] for f in features}
+        # Fields read outside of the models: other request_stats, and what the agent needs
+        self.needed = set(needed) | {stat['datapoint'] for name, stat in request_stats.items()
+                                     if name not in features}
+        self.prune = prune
+        self.min_importance = min_importance
+        self.keep = set(keep)
+        self.sample = sample
+        self.n_cpus = os.cpu_count()
+
+        self.start_ts = None
+        self.baseline = None
+        self.costs = None
+        self.detached = list()
+        self.records = list()
+
+    def start(self):
+        ''' Enable BPF statistics and snapshot them, once the probes are attached '''
+        if not self.BM.enable_prog_stats():
+            log_warn('Probe costs of features will not be measured without BPF statistics')
+        self.start_ts = time.monotonic()
+        self.baseline = self.BM.prog_stats()
+
+    def measure(self):
+        '''
+        Run time and runs of every attached resource probe since start, summed per feature.
+        Measured once, at the end of the training period.
+        '''
+        if self.costs is not None:
+            return self.costs
+        elapsed = time.monotonic() - self.start_ts if self.start_ts is not None else 0
+        stats = self.BM.prog_stats()
+        probes = [fn for fn in self.BM.attached_probes() if fn in PROBE_FIELDS]
+        self.costs = dict()
+        for feature in self.features:
+            feeding = sorted({fn for fn in probes if self.fields[feature] in PROBE_FIELDS[fn]})
+            run_time = sum(stats.get(fn, {}).get('run_time_ns', 0)
+                           - self.baseline.get(fn, {}).get('run_time_ns', 0) for fn in feeding)
+            runs = sum(stats.get(fn, {}).get('run_cnt', 0)
+                       - self.baseline.get(fn, {}).get('run_cnt', 0) for fn in feeding)
+            overhead = run_time / (elapsed * NS_PER_S * self.n_cpus) if elapsed > 0 else 0.
+            self.costs[feature] = dict(probes = ' '.join(feeding), probe_time = run_time / NS_PER_S,
+                                       probe_runs = runs, probe_overhead = overhead)
+        return self.costs
+
+    def evaluate(self, app_id, FD, X_scaled, labels, centroids):
+        '''
+        Rate the features of an application's model, and decide which to drop.
+        Returns the features to drop, empty unless pruning.
+        '''
+        eval_start = time.time()
+        report = FD.feature_importance(X_scaled, labels, centroids, sample_size=self.sample)
+        costs = self.measure()
+
+        drop = list()
+        if self.prune:
+            active = report[~report.feature.isin(FD.dropped)]
+            # The most important feature stays, whatever its rating
+            best = active.feature[active.importance.idxmax()] if len(active) else None
+            drop = [row.feature for row in active.itertuples()
+                    if row.importance < self.min_importance
+                    and row.feature not in self.keep and row.feature != best]
+
+        name = self.app_names[app_id]
+        now = time.time()
+        for row in report.itertuples():
+            cost = costs[row.feature]
+            decision = 'dropped' if row.feature in drop or row.feature in FD.dropped else 'kept'
+            log_info('Feature {} of {}: importance {:.4f} (separation {:.3f}, assignments {:.4f}, '
+                     'decisions {:.4f}), probes {} ({:.3%} of CPU): {}'.format(
+                     row.feature, name, row.importance, row.separation, row.assignment_change,
+                     row.decision_change, cost['probes'] or 'none', cost['probe_overhead'], decision))
+            METRICS.set('finelame_feature_importance', row.importance, app=name, feature=row.feature)
+            METRICS.set('finelame_feature_probe_overhead', cost['probe_overhead'], app=name, feature=row.feature)
+            self.records.append(dict(ts = now, app = name, feature = row.feature,
+                                     separation = row.separation, assignment_change = row.assignment_change,
+                                     decision_change = row.decision_change, importance = row.importance,
+                                     decision = decision, **cost))
+        log_info('Rated the features of {} in {:.2f} seconds'.format(name, time.time() - eval_start))
+        return drop
+
+    def detach(self, FDs):
+        '''
+        Detach the monitors that only feed features every model dropped, and fields
+        nothing else reads. Returns the features no probe feeds anymore.
+        '''
+        needed = set(self.needed)
+        for FD in FDs:
+            needed.update(self.fields[f] for f in FD.features if f not in FD.dropped)
+        unused = [fn for fn in self.BM.attached_probes()
+                  if fn in PROBE_FIELDS and not needed.intersection(PROBE_FIELDS[fn])]
+        if not unused:
+            return []
+        fed = self._fed_fields()
+        n_detached = self.BM.detach_monitors(set(unused))
+        self.detached += unused
+        log_info('Detached {} monitors no model uses: {}'.format(n_detached, ', '.join(sorted(set(unused)))))
+        still_fed = self._fed_fields()
+        return [f for f in self.features if self.fields[f] in fed and self.fields[f] not in still_fed]
+
+    def _fed_fields(self):
+        return {field for fn in self.BM.attached_probes() if fn in PROBE_FIELDS for field in PROBE_FIELDS[fn]}
+
+    def take_records(self):
+        ''' Feature ratings since the last call, one row per application and feature '''
+        records, self.records = self.records, list()
+        return pd.DataFrame(records, columns=['ts', 'app', 'feature', 'separation', 'assignment_change',
+                                              'decision_change', 'importance', 'probes', 'probe_time',
+                                              'probe_runs', 'probe_overhead', 'decision'])
@@ -30,33 +30,97 @@ import ctypes as ct
 import signal
 import sys
 import shutil
+import functools
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 #Finelame libs
 from logger import *
 from .bcc_monitor import BCCMonitor as BM, Monitor
-from .notification import open_notify_buffer, poll_notification
-from .ebpf_rewriter import rewrite_ebpf
+from .notification import EventChannel, EVENT_SINKS, events_config
+from .trace import TraceFileSink, TRACE_DTYPE, trace_config
+from .ebpf_rewriter import rewrite_ebpf, app_names, config_layout, map_config, map_footprint
+from .drainer import RequestDrainer
+from .retrainer import Retrainer
+from .fixed_point import scale_factors, norm_factors, reciprocals, normalization_error
+from .output import Outputs
+from .reservoir import Reservoir
+from .sampler import SamplingController
+from .metrics import METRICS, MetricsServer
+from .mitigation import Mitigator
+from .cascade import Cascade
+from .feature_selection import FeatureSelector
+from .fleet import CollectorClient
+from .drift import DriftMonitor
+from .model_store import ModelStore
+from .thread_sweeper import ThreadSweeper
+from .proc_filter import ProcessFilter, proc_filter_config
 
 #ML libs
 from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
 from sklearn.preprocessing import StandardScaler
 
 
+def fit_kmeans(X, k, sample_size, seed=0):
+    '''
+    Fit KMeans for one candidate k and rate it with the silhouette score of a sample.
+    Module-level so that it can run in a worker process.
+    '''
+    fit_start = time.time()
+    model = KMeans(n_clusters = k).fit(X)
+    fit_time = time.time() - fit_start
+    sample_size = min(sample_size, len(X))
+    score = silhouette_score(X, model.labels_, sample_size=sample_size, random_state=seed) \
+            if len(set(model.labels_)) > 1 else -1
+    return dict(k = k, model = model, silhouette = score, fit_time = fit_time)
+
+
+def app_model_params(cfg, application):
+    '''
+    Model parameters of an application: the global ones, possibly with its own k.
+    Features and scale settings are compiled into the shared eBPF program.
+    '''
+    model_params = dict(cfg['model_params'])
+    for key, value in application.get('model_params', {}).items():
+        if key != 'k' and value != model_params.get(key):
+            raise Exception('Only k can be set per application, not {}'.format(key))
+        model_params[key] = value
+    return model_params
+
+
 class FinelameDetector():
 
     PCT_TRAIN_CLEAN = 99.99
     DEFAULT_M_SCALE = 10
     DEFAULT_S_SCALE = 6
+    DEFAULT_TRAIN_SAMPLES = 1000000
+    DEFAULT_K_CANDIDATES = list(range(2, 9))
+    DEFAULT_K_SAMPLE = 10000
+    THRESHOLD_SIGMAS = 5
 
     def __init__(self, model_params):
         log_info("Configuring Finelame anomaly detector")
         if 'k' not in model_params or 'features' not in model_params:
             raise Exception('FinelameDetector needs features description and model params (k for kmeans)')
         self.outlier_scores = dict()
-        self.k = model_params['k']
-        self.model = KMeans(n_clusters = model_params['k'])
+        # With k: auto, k is picked at train time among k_candidates. Until then, it is
+        # the largest candidate, which is what the eBPF program must be built for.
+        self.auto_k = model_params['k'] == 'auto'
+        if self.auto_k:
+            self.k_candidates = sorted(model_params.get('k_candidates', self.DEFAULT_K_CANDIDATES))
+            self.k_workers = model_params.get('k_workers', None)
+            self.k_sample = model_params.get('k_sample', self.DEFAULT_K_SAMPLE)
+            self.k = self.k_candidates[-1]
+        else:
+            self.k = model_params['k']
+        self.model = KMeans(n_clusters = self.k)
+        # Bounded uniform sample of the requests seen during training
+        self.reservoir = Reservoir(model_params.get('train_samples', self.DEFAULT_TRAIN_SAMPLES))
         self.features = model_params['features']
+        # Features left out of the model (see drop_features): the kernel still computes them
+        self.dropped = list()
         self.X_train_columns = ['req_id', "origin_ip", 'origin_ts', 'completion_ts'] + self.features
         self.X_train = None
         self.X_test = None
@@ -65,63 +129,272 @@ class FinelameDetector():
         self.m_scaler = model_params.get('m_scale', self.DEFAULT_M_SCALE)
         self.s_scaler = model_params.get('s_scale', self.DEFAULT_S_SCALE)
 
-        if self.scale_method == 'exponent':
-            self.m_scale = 10 ** self.m_scaler
-            self.s_scale = 10 ** self.s_scaler
-        elif self.scale_method == 'bitshift':
-            self.m_scale = 1 << self.m_scaler
-            self.s_scale = 1 << self.s_scaler
-        else:
-            raise Exception("Unknown scale method: %s" % scale_method)
+        self.m_scale, self.s_scale = scale_factors(self.scale_method, self.m_scaler, self.s_scaler)
+
+    def add_train_data(self, datapoints):
+        ''' Stream requests into the training sample '''
+        self.reservoir.add(datapoints)
 
     def set_train_data(self, x_train, do_clean=True):
         self.X_train = x_train
 
         if do_clean:
-            for col in self.features:
-                self.X_train = self.X_train[self.X_train[col] <=
-                                            np.percentile(self.X_train[col], self.PCT_TRAIN_CLEAN)]
+            # One pass: every feature is cut at its percentile over the whole set
+            X = self.X_train[self.features].to_numpy()
+            thresholds = np.percentile(X, self.PCT_TRAIN_CLEAN, axis=0)
+            self.X_train = self.X_train[np.all(X <= thresholds, axis=1)].copy()
+
+    def drop_features(self, features):
+        ''' Leave features out of the next models trained, or bring them back with [] '''
+        self.dropped = [f for f in self.features if f in features]
+
+    def active_mask(self):
+        ''' Which features the model uses, in configuration order '''
+        return np.array([f not in self.dropped for f in self.features], dtype=bool)
+
+    def mask_scaled(self, X_scaled):
+        ''' Standardized rows (or centroids) with the dropped features zeroed '''
+        X_scaled = np.array(X_scaled, dtype=np.float64)
+        X_scaled[:, ~self.active_mask()] = 0
+        return X_scaled
+
+    def select_k(self, X):
+        ''' Fit every candidate k in parallel and keep the one with the best silhouette '''
+        select_start = time.time()
+        candidates = [k for k in self.k_candidates if k < len(X)] or [1]
+        with ProcessPoolExecutor(max_workers = self.k_workers) as pool:
+            fits = list(pool.map(fit_kmeans, [X] * len(candidates), candidates,
+                                 [self.k_sample] * len(candidates)))
+        for fit in fits:
+            log_info('k={}: silhouette {:.3f}, fitted in {:.2f} seconds'.format(
+                     fit['k'], fit['silhouette'], fit['fit_time']))
+        best = max(fits, key = lambda fit: fit['silhouette'])
+        log_info('Picked k={} in {:.2f} seconds'.format(best['k'], time.time() - select_start))
+        self.k = best['k']
+        self.model = best['model']
 
     def train_model(self, x_train=None):
         if x_train is None:
-            self.model.fit(self.X_train)
+            x_train = self.X_train
+        train_start = time.time()
+        if self.auto_k:
+            self.select_k(x_train)
         else:
             self.model.fit(x_train)
+        METRICS.observe('finelame_phase_duration_seconds', time.time() - train_start, phase='train')
 
         self.X_train['cluster_label'] = self.model.labels_
         log_info('Trained KMeans model')
 
+    def fit(self):
+        '''
+        Standardize the training set, train k-means on it and return the model's kernel
+        parameters. Normalization errors of the fixed-point parameters are logged.
+        '''
+        cols = self.features
+        self.scaler = StandardScaler()
+        X_train = self.mask_scaled(self.scaler.fit_transform(self.X_train[cols]))
+        self.train_model(x_train=X_train)
+
+        params = self.kernel_params(self.scaler, X_train, self.model.labels_, self.model.cluster_centers_)
+        report = normalization_error(self.X_train[cols].to_numpy(dtype=np.int64), self.scaler.scale_,
+                                     self.m_scale, self.s_scale, params['norm_mult'], params['norm_shift'])
+        for i, feature in enumerate(cols):
+            log_info('Normalization error of {} (1/c_scale units): mean {:.3g}, max {:.3g}, max relative {:.3g}'.format(
+                     feature, report['reciprocal']['mean_abs'][i], report['reciprocal']['max_abs'][i],
+                     report['reciprocal']['max_rel'][i]))
+        return params
+
+    @classmethod
+    def l1_thresholds(cls, X_scaled, labels, k):
+        ''' Cluster thresholds on the L1 norm of standardized rows, 0 for empty clusters '''
+        thresholds = np.zeros(k)
+        for c in range(k):
+            cluster_l1s = np.sum(X_scaled[labels == c], axis=1)
+            if len(cluster_l1s):
+                thresholds[c] = abs(cluster_l1s.mean() + cls.THRESHOLD_SIGMAS * cluster_l1s.std())
+        return thresholds
+
+    @staticmethod
+    def l1_decide(X_scaled, centroids, thresholds):
+        ''' Floating-point counterpart of kernel_decide: closest cluster and decision of each row '''
+        distances = X_scaled.sum(axis=1)[:, None] - centroids.sum(axis=1)[None, :]
+        valid = thresholds != 0
+        closest = np.argmin(np.where(valid, np.abs(distances), np.inf), axis=1)
+        min_dist = distances[np.arange(len(distances)), closest]
+        return closest, valid.any() & (min_dist > 0) & (min_dist > thresholds[closest])
+
+    def feature_importance(self, X_scaled, labels, centroids, sample_size=None, seed=0):
+        '''
+        Contribution of each feature to the model, over (a sample of) its standardized,
+        masked training set: the share of the feature's variance explained by the clusters
+        (separation), and the share of requests whose closest cluster (assignment_change)
+        or outlier decision (decision_change) changes when the feature is left out, with
+        thresholds recomputed without it. importance is the share of requests with either
+        change. Dropped features contribute nothing.
+        '''
+        if sample_size is not None and len(X_scaled) > sample_size:
+            idx = np.random.RandomState(seed).choice(len(X_scaled), sample_size, replace=False)
+            X_scaled, labels = X_scaled[idx], labels[idx]
+        k = len(centroids)
+        closest, is_outlier = self.l1_decide(X_scaled, centroids, self.l1_thresholds(X_scaled, labels, k))
+
+        rows = list()
+        for i, feature in enumerate(self.features):
+            row = dict(feature = feature, separation = 0., assignment_change = 0.,
+                       decision_change = 0., importance = 0.)
+            if feature not in self.dropped and len(X_scaled):
+                column = X_scaled[:, i]
+                total_ss = np.sum((column - column.mean()) ** 2)
+                within_ss = sum(np.sum((column[labels == c] - column[labels == c].mean()) ** 2)
+                                for c in range(k) if np.any(labels == c))
+                X_without = X_scaled.copy()
+                X_without[:, i] = 0
+                centroids_without = np.array(centroids, dtype=np.float64)
+                centroids_without[:, i] = 0
+                closest_without, is_outlier_without = self.l1_decide(
+                    X_without, centroids_without, self.l1_thresholds(X_without, labels, k))
+                moved = closest_without != closest
+                flipped = is_outlier_without != is_outlier
+                row.update(separation = 1 - within_ss / total_ss if total_ss > 0 else 0.,
+                           assignment_change = float(moved.mean()),
+                           decision_change = float(flipped.mean()),
+                           importance = float((moved | flipped).mean()))
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def kernel_params(self, scaler, X_scaled, labels, centroids):
+        '''
+        Fixed-point model parameters, as the eBPF program uses them.
+        X_scaled and centroids are in the scaler's standardized space. Dropped features
+        get a null normalization, so the probes leave them out of the distances.
+        '''
+        X_scaled = self.mask_scaled(X_scaled)
+        centroids = self.mask_scaled(centroids)
+        active = self.active_mask()
+        train_set_params = list()
+        for i, feature in enumerate(self.features):
+            mean = scaler.mean_[i]
+            std = scaler.scale_[i]
+            log_info('Appending mean {} and std {} for feature {}'.format(mean, std, feature))
+            train_set_params += [int(mean * self.m_scale), int(std * self.s_scale)]
+
+        c_scale = self.m_scale / self.s_scale
+
+        #Scale the centroids for the eBPF programs
+        centroids = centroids * c_scale
+        log_info('Scaled centroids:')
+        log_info(centroids)
+        thresholds = list()
+        centroid_l1s = list()
+        for k, threshold in enumerate(self.l1_thresholds(X_scaled, labels, len(centroids))):
+            precise_threshold = threshold * c_scale
+            log_info('Scaled [{}] threshold: {}'.format(k, precise_threshold))
+            thresholds.append(int(precise_threshold))
+            log_info('Centroid l1: {}'.format(sum(centroids[k])))
+            centroid_l1s.append(int(sum(centroids[k])))
+
+        # The kernel normalizes with a multiply and a shift instead of dividing by std
+        norm_mult, norm_shift = reciprocals(norm_factors(scaler.scale_, self.m_scale, self.s_scale))
+        norm_mult[~active] = 0
+
+        return dict(train_set_params = train_set_params,
+                    norm_mult = norm_mult.tolist(),
+                    norm_shift = norm_shift.tolist(),
+                    cluster_thresholds = thresholds,
+                    centroid_l1s = centroid_l1s,
+                    centroid_offset = int(sum((scaler.mean_ / scaler.scale_)[active]) * c_scale))
+
 class Finelame():
     def __init__(self, cfg_file, run_label, outdir,
-                 train_time=None, debug=False, ano_detect=False):
+                 train_time=None, debug=False, ano_detect=False, ebpf=None):
         self.outdir = outdir
         if not os.path.isdir(outdir):
             os.makedirs(outdir)
 
         self.cfg_file = cfg_file
         with open(cfg_file, 'r') as f:
-            self.cfg = yaml.load(f)
+            self.cfg = yaml.safe_load(f)
         self.run_label = run_label
 
-        self.FD = None
+        self.applications = self.cfg['applications']
+        self.app_names = app_names(self.applications)
+
+        self.FDs = None
         self.train_time = None
         if ano_detect:
-            ''' Anomaly detector params '''
-            self.FD = FinelameDetector(model_params=self.cfg['model_params'])
-
-            if train_time is not None and 'train_time' in self.cfg:
-                log_warn("Warning: Ignoring config train time in favor of argument")
-                self.train_time = train_time
+            ''' Anomaly detector params, one detector per application '''
+            self.FDs = [FinelameDetector(model_params=app_model_params(self.cfg, application))
+                        for application in self.applications]
+
+            if 'collector' in self.cfg and 'harvest' not in self.cfg:
+                log_warn('The collector needs the harvest section to receive requests, training locally')
+            if 'collector' in self.cfg and 'harvest' in self.cfg:
+                # Detection starts with the first model the collector pushes
+                log_info('Models come from the collector at %s', self.cfg['collector'].get('path'))
+                self.mode = 'monitoring'
             else:
-                self.train_time = self.cfg.get('train_time', train_time)
-            log_info("Setting train time to %d", self.train_time)
-            self.mode = 'train'
-        self.mode = 'monitoring'
-
-        ''' Data collection params '''
-        #XXX Finelame is made mostly for a single application as of now (hence the [0])
-        ebpf_prog = rewrite_ebpf(self.cfg['ebpf_prog'], self.cfg['applications'][0], debug, detector=self.FD)
-        self.BM = BM(ebpf_prog, self.cfg['request_stats'])
+                if train_time is not None and 'train_time' in self.cfg:
+                    log_warn("Warning: Ignoring config train time in favor of argument")
+                    self.train_time = train_time
+                else:
+                    self.train_time = self.cfg.get('train_time', train_time)
+                log_info("Setting train time to %d", self.train_time)
+                self.mode = 'train'
+        else:
+            self.mode = 'monitoring'
+
+        ''' Data collection params: a single program serves all applications '''
+        events = events_config(self.cfg.get('events', None))
+        trace = trace_config(self.cfg.get('trace', None), self.outdir, self.run_label)
+        proc_filter = proc_filter_config(self.cfg.get('proc_filter', None))
+        percpu = self.cfg.get('percpu', False)
+        sampling = self.cfg.get('sampling', None)
+        drift = self.cfg.get('drift', None) if self.FDs is not None else None
+        cascade = self.cfg.get('cascade', None) if self.FDs is not None else None
+        if drift is not None and percpu:
+            log_warn('Per-CPU datapoints cannot be tracked by histograms, disabling drift detection')
+            drift = None
+        # struct datapoint only holds the fields the configuration uses
+        layout = config_layout(self.cfg, self.FDs[0].features if self.FDs else None)
+        maps = map_config(self.cfg)
+        self.startup_timings = dict()
+        phase_start = time.time()
+        ebpf_prog, cached = rewrite_ebpf(self.cfg['ebpf_prog'], self.applications, debug,
+                                         detectors=self.FDs, events=events, percpu=percpu,
+                                         sampling=sampling is not None, layout=layout,
+                                         histograms=drift, maps=maps, trace=trace,
+                                         cascade=cascade is not None, proc_filter=proc_filter,
+                                         **self.cfg.get('ebpf_cache', {}))
+        self.startup_timings['rewrite'] = time.time() - phase_start
+        log_info('%s eBPF program %s in %.3f seconds', 'Reused' if cached else 'Rewrote',
+                 ebpf_prog, self.startup_timings['rewrite'])
+        footprint = map_footprint(layout, max(FD.k for FD in self.FDs) if self.FDs else 1, maps, percpu)
+        log_info('Datapoints hold %s', ', '.join(layout['fields']))
+        for name, fp in footprint.items():
+            log_info('%s: %s map of %d entries, %d bytes per entry, %s %.1f MiB', name, fp['type'],
+                     fp['max_entries'], fp['entry_size'], 'allocated' if fp['prealloc'] else 'up to',
+                     fp['total'] / 2**20)
+
+        phase_start = time.time()
+        self.BM = BM(ebpf_prog, self.cfg['request_stats'], percpu=percpu, ebpf=ebpf, maps=maps)
+        self.startup_timings['compile'] = time.time() - phase_start
+        log_info('Compiled and loaded eBPF program in %.3f seconds', self.startup_timings['compile'])
+
+        ''' Kernel events channel (optional) '''
+        self.events = None
+        if events is not None:
+            self.events = EventChannel(self.BM.ebpf, events['buffer'], events['pages'])
+            for sink in events['sinks']:
+                self.events.add_sink(EVENT_SINKS[sink](self.outdir, self.run_label))
+
+        ''' Raw probe event recording (optional) '''
+        self.trace = None
+        if trace is not None:
+            self.trace = EventChannel(self.BM.ebpf, trace['buffer'], trace['pages'],
+                                      table='fl_trace_records', dtype=TRACE_DTYPE, drops='trace_drops')
+            self.trace_file = TraceFileSink(trace['path'])
+            self.trace.add_sink(self.trace_file)
 
         self.resource_monitors = {}
         if 'resource_monitors' in self.cfg:
@@ -135,88 +408,436 @@ class Finelame():
             log_error("Finelame needs events to monitor")
             sys.exit()
 
-        self.applications = self.cfg['applications']
+        ''' Output tables (train, test, data, scores) '''
+        self.outputs = Outputs(self.outdir, self.run_label, **self.cfg.get('output', {}))
+
+        ''' Streaming drain of completed requests (optional) '''
+        self.drainer = None
+        if 'harvest' in self.cfg:
+            self.drainer = RequestDrainer(self.BM, **self.cfg['harvest'])
+            self.drainer.add_sink(self._drain_sink)
+
+        ''' Removal of the thread map entries of exited threads (sweep_interval 0 disables it) '''
+        self.sweeper = None
+        sweep_interval = (self.cfg.get('maps') or {}).get('sweep_interval', ThreadSweeper.DEFAULT_INTERVAL)
+        if sweep_interval:
+            self.sweeper = ThreadSweeper(self.BM, sweep_interval)
+
+        ''' Scoping of system-wide probes to the applications' processes (optional) '''
+        self.proc_filter = None
+        if proc_filter is not None:
+            self.proc_filter = ProcessFilter(self.BM, self.applications, self.app_names, **proc_filter)
+
+        ''' Fleet-wide models trained by a collector (optional) '''
+        self.collector = None
+        if self.FDs is not None and 'collector' in self.cfg and self.drainer is not None:
+            collector_cfg = dict(self.cfg['collector'])
+            collector_cfg.pop('train', None)
+            self.collector = CollectorClient(self.app_names, self.FDs, self._on_fleet_model, **collector_cfg)
+
+        ''' Distribution drift detection from in-kernel histograms (optional) '''
+        self.drift = None
+        if drift is not None:
+            self.drift = DriftMonitor(self.BM, self.app_names, self.FDs[0].features,
+                                      max(FD.k for FD in self.FDs), on_drift=self._on_drift, **drift)
+
+        ''' Request sampling under a probe CPU budget (optional) '''
+        self.sampler = None
+        if sampling is not None:
+            self.sampler = SamplingController(self.BM, len(self.applications), **sampling)
+
+        ''' Metrics endpoint (optional) '''
+        self.metrics_server = None
+        if 'metrics' in self.cfg:
+            metrics_cfg = dict(self.cfg['metrics'])
+            self.metrics_prog_stats = metrics_cfg.pop('prog_stats', True)
+            METRICS.add_collector(functools.partial(self.BM.collect_metrics, app_names=self.app_names,
+                                                    footprint=footprint))
+            if self.events is not None:
+                METRICS.add_collector(lambda metrics: metrics.set(
+                    'finelame_event_drops_total', self.events.kernel_drops()))
+            if self.trace is not None:
+                METRICS.add_collector(lambda metrics: metrics.set(
+                    'finelame_trace_drops_total', self.trace.kernel_drops()))
+            self.metrics_server = MetricsServer(**metrics_cfg)
+
+        ''' Second-stage scoring of the requests the probes flag (optional) '''
+        self.cascade = None
+        if cascade is not None:
+            self.cascade = Cascade(self.BM, self.FDs[0].features, self.app_names,
+                                   on_confirm=self._on_confirmed, **cascade)
+
+        ''' Rating, and optional pruning, of the model features after training (optional) '''
+        self.selector = None
+        if self.FDs is not None and 'feature_selection' in self.cfg:
+            if self.mode == 'monitoring':
+                log_warn('Features are only rated when models are trained locally')
+            # Mitigation blocks the source addresses the TCP probes record
+            needed = ('saddr',) if 'mitigation' in self.cfg else ()
+            self.selector = FeatureSelector(self.BM, self.app_names, self.FDs[0].features,
+                                            self.cfg['request_stats'], needed=needed,
+                                            **self.cfg['feature_selection'])
+
+        ''' Mitigation of flagged requests (optional) '''
+        self.mitigator = None
+        if ano_detect and 'mitigation' in self.cfg:
+            mitigation = dict(self.cfg['mitigation'])
+            self.mitigator = Mitigator(self.BM, mitigation.pop('actions', ['log']),
+                                       flagged=self.cascade is None, **mitigation)
+            if self.events is None:
+                log_warn('Without events, flagged requests are only mitigated on sweeps of the flagged map')
+
+        ''' Periodic background retraining (optional) '''
+        self.retrainers = dict()
+        if ano_detect and 'retrain' in self.cfg:
+            if self.collector is not None:
+                log_warn('The collector retrains the models, ignoring the retrain section')
+            elif self.drainer is None:
+                log_warn('Retraining needs the harvest section to collect fresh data, disabling it')
+            else:
+                for app_id, FD in enumerate(self.FDs):
+                    self.retrainers[app_id] = Retrainer(FD, functools.partial(self._load_model, app_id),
+                                                        **self.cfg['retrain'])
+
+        ''' Models saved by earlier runs, loaded before the probes are attached (optional) '''
+        self.model_store = None
+        if self.FDs is not None and 'model_store' in self.cfg:
+            self.model_store = ModelStore(self.app_names, **self.cfg['model_store'])
+            if self.model_store.warm_start:
+                self._warm_start()
+
         self.start_ts = time.time() # in sec
         self.outlier_reports = list()
 
-        ''' Register SIGINT handler '''
-        signal.signal(signal.SIGINT, self._stop)
+        ''' Event loop (see _run). Agent work runs off the loop, one job at a time. '''
+        self.loop = None
+        self.stop_requested = None
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fl-worker')
+        self.retrain_pool = None
+        if self.retrainers:
+            self.retrain_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fl-retrain')
         self.is_running = False
 
-    def _train_and_share_model(self):
-        log_info('Training and sharing the model...')
-
-        # Standardize data
-        cols = self.FD.features
-        scaler = StandardScaler()
-        X_train = scaler.fit_transform(self.FD.X_train[cols])
-        for i, feature in enumerate(cols):
-            mean = scaler.mean_[i]
-            std = scaler.scale_[i]
-            log_info('Appending mean {} and std {} for feature {}'.format(mean, std, feature))
-            mean *= self.FD.m_scale
-            std *= self.FD.s_scale
-            self.BM.ebpf['train_set_params'][i*2] = ct.c_ulonglong(int(mean))
-            self.BM.ebpf['train_set_params'][i*2+1] = ct.c_ulonglong(int(std))
-
-        c_scale = self.FD.m_scale / self.FD.s_scale
-
-        #Train kmeans
-        self.FD.train_model(x_train=X_train)
-
-        #Share the (scaled) centroids with  the eBPF programs
-        model = self.FD.model
-        centroids = model.cluster_centers_
-        centroids *= c_scale
-        log_info('Scaled centroids:')
-        log_info(centroids)
-        thresholds = list()
-        centroid_l1s = list()
-
-        self.BM.ebpf['centroid_offset'][0] = ct.c_ulonglong(int(sum(scaler.mean_ / scaler.scale_) * c_scale))
-        for k in range(0, len(centroids)):
-            cluster_l1s = np.sum(X_train[model.labels_ == k], axis=1)
-            precise_threshold = abs(cluster_l1s.mean() + 5 * cluster_l1s.std()) * c_scale
-            threshold = ct.c_ulonglong(int(precise_threshold))
-            log_info('Scaled [{}] threshold: {}'.format(k, precise_threshold))
-            log_info('Shared [{}] threshold: {}'.format(k, threshold))
-            centroid_l1 = ct.c_longlong(int(sum(centroids[k])))
-            log_info('Centroid l1: {}'.format(sum(centroids[k])))
-            thresholds.append(threshold)
-            centroid_l1s.append(centroid_l1)
+    def _app_label(self, app_id):
+        ''' Label of an application's model files '''
+        if len(self.applications) == 1:
+            return self.run_label
+        return '{}_{}'.format(self.run_label, self.app_names[app_id])
+
+    def _load_model(self, app_id, params):
+        ''' Load a model into the kernel; with the cascade, its thresholds only screen for candidates '''
+        if self.cascade is not None:
+            self.cascade.set_kernel_model(app_id, params)
+            params = self.cascade.screen_params(params)
+        return self.BM.load_model(params, app=app_id)
+
+    def _train_and_share_model(self, app_id):
+        log_info('Training and sharing the model of %s...', self.app_names[app_id])
+        FD = self.FDs[app_id]
+        params = FD.fit()
+        if self.selector is not None:
+            X_scaled = FD.mask_scaled(FD.scaler.transform(FD.X_train[FD.features]))
+            drop = self.selector.evaluate(app_id, FD, X_scaled, FD.model.labels_, FD.model.cluster_centers_)
+            if drop:
+                log_info('Training %s again without %s', self.app_names[app_id], ', '.join(drop))
+                FD.drop_features(FD.dropped + drop)
+                params = FD.fit()
+        version, swap_latency = self._load_model(app_id, params)
+        log_info('Loaded model v{} of {} into the kernel in {:.3f} ms'.format(
+                 version, self.app_names[app_id], swap_latency * 1e3))
+        if self.cascade is not None:
+            self.cascade.set_model(app_id, FD.scaler, FD.model.cluster_centers_,
+                                   FD.X_train[FD.features].to_numpy(dtype=np.float64), FD.model.labels_,
+                                   FD.active_mask())
+        if self.drift is not None:
+            self.drift.set_reference(app_id, FD.X_train[FD.features].to_numpy(), FD.model.labels_)
+
+        if app_id in self.retrainers:
+            self.retrainers[app_id].seed(FD.X_train[FD.features].to_numpy(dtype=np.float64),
+                                         FD.scaler, FD.model.cluster_centers_)
+        if self.model_store is not None:
+            self.model_store.save(app_id, FD, params, version, FD.scaler, FD.model.cluster_centers_)
+
+    def _warm_start(self):
+        '''
+        Load the saved model of every application into the kernel. Detection starts at
+        once if they all have one; otherwise the training period runs as usual.
+        '''
+        kernel_k = len(self.BM.get_model(0)['cluster_thresholds'])
+        n_loaded = 0
+        for app_id, FD in enumerate(self.FDs):
+            artifact = self.model_store.load(app_id, FD, kernel_k)
+            if artifact is None:
+                continue
+            version, swap_latency = self._load_model(app_id, artifact['kernel'])
+            log_info('Loaded saved model revision {} of {} into the kernel in {:.3f} ms'.format(
+                     artifact['revision'], self.app_names[app_id], swap_latency * 1e3))
+            if app_id in self.retrainers and artifact['centroids'] is not None:
+                # Recent datapoints fill the scaler window again as they are drained
+                self.retrainers[app_id].seed(np.empty((0, len(FD.features))), FD.scaler,
+                                             FD.model.cluster_centers_)
+            n_loaded += 1
+        if n_loaded == len(self.FDs):
+            log_info('Every application has a saved model, skipping the training period')
+            self.mode = 'detection'
+        elif n_loaded:
+            log_warn('Only {} of {} applications have a saved model, training them all'.format(
+                     n_loaded, len(self.FDs)))
+
+    def _drain_sink(self, datapoints, scores):
+        if self.mode == 'train':
+            self._add_train_data(datapoints)
+            return
+        for app_id, retrainer in self.retrainers.items():
+            retrainer.submit(datapoints[datapoints.app == app_id], scores[scores.app == app_id])
+        if self.cascade is not None:
+            self.cascade.recheck(datapoints)
+        if self.collector is not None:
+            self._send_to_collector(datapoints, scores)
+        self.outputs.write('test' if self.mode == 'detection' else 'data', datapoints)
+        self.outputs.write('scores', scores)
+
+    def _send_to_collector(self, datapoints, scores):
+        ''' Stream requests to the collector, leaving out those flagged as outliers '''
+        for app_id, FD in enumerate(self.FDs):
+            app_dps = datapoints[datapoints.app == app_id]
+            if not scores.empty:
+                app_scores = scores[scores.app == app_id]
+                app_dps = app_dps[~app_dps.req_id.isin(app_scores.req_id[app_scores.is_outlier != 0])]
+            self.collector.submit(app_id, app_dps[FD.features].to_numpy(dtype=np.float64))
+
+    def _on_fleet_model(self, app_id, params):
+        self._submit(self._load_fleet_model, app_id, params)
+
+    def _load_fleet_model(self, app_id, params):
+        version, swap_latency = self._load_model(app_id, params)
+        self.mode = 'detection'
+        log_info('Loaded model v{} of {} from the collector in {:.3f} ms'.format(
+                 version, self.app_names[app_id], swap_latency * 1e3))
+        if self.model_store is not None:
+            self.model_store.save(app_id, self.FDs[app_id], params, version)
+
+    def _add_train_data(self, datapoints):
+        for app_id, FD in enumerate(self.FDs):
+            FD.add_train_data(datapoints[datapoints.app == app_id])
+
+    def _end_training(self):
+        '''
+        Train the model of every application on the requests recorded so far.
+        Returns False if there were none, in which case the training period restarts.
+        '''
+        self._add_train_data(self.BM.get_request_stats())
+
+        if all(len(FD.reservoir) == 0 for FD in self.FDs):
+            log_info('Did not record any data. Resetting timer')
+            self.start_ts = time.time()
+            return False
+
+        self.mode = 'detection'
+        for app_id, FD in enumerate(self.FDs):
+            log_info('Training %s on %d of %d requests', self.app_names[app_id],
+                     len(FD.reservoir), FD.reservoir.n_seen)
+            app_train = FD.reservoir.frame()
+            FD.reservoir.clear()
+            if app_train.empty:
+                log_warn('No training data for %s, it will not be protected', self.app_names[app_id])
+                continue
+            FD.set_train_data(app_train)
+            self._train_and_share_model(app_id)
+            self.outputs.write('train', FD.X_train)
+        if self.selector is not None:
+            self.outputs.write('features', self.selector.take_records())
+            if self.selector.prune:
+                self._detach_unused()
+        self.outputs.checkpoint()
+        return True
+
+    def _detach_unused(self):
+        ''' Detach the monitors of features every model dropped '''
+        unfed = self.selector.detach(self.FDs)
+        if unfed and self.drift is not None:
+            self.drift.ignore(unfed)
+
+    def _retrain(self, app_id, drifted=False):
+        ''' Periodic retraining is skipped while drift detection sees no shift '''
+        if not drifted and self.drift is not None and self.drift.retrain and self.drift.stable(app_id):
+            log_info('No drift on {}, deferring retraining'.format(self.app_names[app_id]))
+            return
+        try:
+            retrainer = self.retrainers[app_id]
+            if not retrainer.retrain():
+                return
+            if self.drift is not None:
+                self.drift.set_reference(app_id, *retrainer.reference)
+            if self.cascade is not None:
+                FD = self.FDs[app_id]
+                self.cascade.set_model(app_id, FD.scaler, FD.scaler.transform(retrainer.centers),
+                                       *retrainer.reference, FD.active_mask())
+            if self.model_store is not None:
+                FD = self.FDs[app_id]
+                self.model_store.save(app_id, FD, retrainer.params, retrainer.stats['version'],
+                                      FD.scaler, FD.scaler.transform(retrainer.centers))
+        except Exception as e:
+            log_error('Retraining of {} failed: {}'.format(self.app_names[app_id], e))
+
+    def _submit(self, fn, *args):
+        ''' Queue a job on the worker without waiting for it; failures are logged '''
+        future = self.loop.run_in_executor(self.worker, fn, *args)
+        future.add_done_callback(self._log_failure)
+
+    def _log_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log_error('Agent job failed: {!r}'.format(future.exception()))
+            self.stop_requested.set()
+
+    async def _every(self, interval, fn, executor=None):
+        ''' Run fn every interval seconds, counted from the end of its previous run '''
+        while True:
+            await asyncio.sleep(interval)
+            await self.loop.run_in_executor(executor or self.worker, fn)
+
+    async def _training_deadline(self):
+        while True:
+            await asyncio.sleep(max(0, self.start_ts + self.train_time - time.time()))
+            if await self.loop.run_in_executor(self.worker, self._end_training):
+                return
 
-        log_info('Setting centroid L1 & cluster thresholds')
-        for k in range(len(centroids)):
-            self.BM.ebpf['cluster_thresholds'][k] = thresholds[k]
-            self.BM.ebpf['centroid_l1s'][k] = centroid_l1s[k]
+    def _on_events(self):
+        ''' The event buffer is readable: copy records now, decode them in the worker '''
+        self.events.consume()
+        self._take_records()
 
-    '''
-    Periodically pull data from eBPF map
-    '''
-    def _loop_iteration(self):
-        if self.mode == 'train' \
-           and time.time() - self.start_ts > self.train_time:
+    def _on_trace(self):
+        ''' The trace buffer is readable: copy records now, append them to the file in the worker '''
+        self.trace.consume()
+        self._take_records()
 
-            self.mode = 'detection'
-            x_train = self.BM.get_request_stats()
-
-            if x_train.empty:
-                log_info('Did not record any data. Resetting timer')
-                self.mode = 'train'
-                self.start_ts = time.time()
-                return
+    def _take_records(self):
+        '''
+        Hand the records copied so far to their consumers. Consuming a buffer also copies
+        the records waiting in the others of its type, so both channels are taken whichever
+        one was readable.
+        '''
+        if self.events is not None:
+            batch = self.events.take()
+            if batch:
+                self._route_events(batch)
+                self._submit(self.events.dispatch, batch)
+        if self.trace is not None:
+            batch = self.trace.take()
+            if batch:
+                self._submit(self.trace.dispatch, batch)
+
+    def _route_events(self, batch):
+        ''' Mitigation (or the cascade, which feeds it) does not wait for the worker '''
+        if self.cascade is not None:
+            self.cascade.on_events(self.events.decode(batch))
+        elif self.mitigator is not None:
+            self.mitigator.on_events(self.events.decode(batch))
+
+    def _update_drift(self):
+        self.drift.update()
+        self.outputs.write('drift', self.drift.take_records())
+
+    def _on_drift(self, app_id):
+        ''' Retrain a drifting application without waiting for its next round '''
+        if self.drift.retrain and app_id in self.retrainers:
+            self.retrain_pool.submit(self._retrain, app_id, True)
+
+    def _sweep_flagged(self):
+        self.mitigator.sweep()
+        self.outputs.write('mitigation', self.mitigator.take_records())
+
+    def _on_confirmed(self, flags):
+        if self.mitigator is not None:
+            self.mitigator.on_flags(flags)
+
+    def _sweep_candidates(self):
+        self.cascade.sweep()
+        self.outputs.write('cascade', self.cascade.take_records())
+
+    def _on_signal(self):
+        log_info('Stopping Finelame')
+        # A second signal interrupts the shutdown
+        self.loop.remove_signal_handler(signal.SIGINT)
+        self.loop.remove_signal_handler(signal.SIGTERM)
+        self.stop_requested.set()
 
-            self.FD.set_train_data(x_train)
+    def stop(self):
+        ''' Ask a running agent to shut down, from any thread '''
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_requested.set)
 
-            self._train_and_share_model()
+    async def _run(self):
+        '''
+        Schedule the training deadline, periodic jobs and event buffer reads on a single
+        event loop, until SIGINT/SIGTERM or a failed job. Blocking work runs in executors;
+        shutdown waits for the jobs in flight, then dumps the results.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.stop_requested = asyncio.Event()
+        self.loop.add_signal_handler(signal.SIGINT, self._on_signal)
+        self.loop.add_signal_handler(signal.SIGTERM, self._on_signal)
+
+        jobs = list()
+        if self.mode == 'train':
+            jobs.append(self._training_deadline())
+        if self.drainer is not None:
+            jobs.append(self._every(self.drainer.interval, self.drainer.drain))
+        if self.sampler is not None:
+            jobs.append(self._every(self.sampler.interval, self.sampler.adjust))
+        if self.mitigator is not None:
+            jobs.append(self._every(self.mitigator.sweep_interval, self._sweep_flagged))
+        if self.cascade is not None:
+            jobs.append(self._every(self.cascade.interval, self.cascade.process))
+            jobs.append(self._every(self.cascade.sweep_interval, self._sweep_candidates))
+        if self.drift is not None:
+            jobs.append(self._every(self.drift.interval, self._update_drift))
+        if self.sweeper is not None:
+            jobs.append(self._every(self.sweeper.interval, self.sweeper.sweep))
+        if self.proc_filter is not None:
+            jobs.append(self._every(self.proc_filter.interval, self.proc_filter.update))
+        if self.collector is not None:
+            jobs.append(self.collector.run())
+        jobs.append(self._every(self.outputs.checkpoint_interval, self.outputs.checkpoint))
+        for app_id, retrainer in self.retrainers.items():
+            jobs.append(self._every(retrainer.interval, functools.partial(self._retrain, app_id),
+                                    self.retrain_pool))
+        tasks = [asyncio.ensure_future(job) for job in jobs]
+        for task in tasks:
+            task.add_done_callback(self._log_failure)
+
+        if self.events is not None:
+            for fd in self.events.fds():
+                self.loop.add_reader(fd, self._on_events)
+        if self.trace is not None:
+            for fd in self.trace.fds():
+                self.loop.add_reader(fd, self._on_trace)
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
 
-    def _loop(self):
         self.is_running = True
-        while self.is_running:
-            time.sleep(1)
-            self._loop_iteration()
+        await self.stop_requested.wait()
         log_info('Shutting down')
 
+        if self.events is not None:
+            for fd in self.events.fds():
+                self.loop.remove_reader(fd)
+        if self.trace is not None:
+            for fd in self.trace.fds():
+                self.loop.remove_reader(fd)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Jobs already handed to the executors complete before the shutdown job runs
+        if self.retrain_pool is not None:
+            await self.loop.run_in_executor(None, self.retrain_pool.shutdown)
+        await self.loop.run_in_executor(self.worker, self._shutdown)
+        self.worker.shutdown()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        self.is_running = False
+
     '''
     Load config and start Finelame in training mode
     Initially we only know if sock_loc
@@ -224,6 +845,18 @@ class Finelame():
     def start(self):
         log_info('Starting Finelame!')
         ''' Configure and deploy a monitor per statistic '''
+        phase_start = time.time()
+
+        # Sample rates must be set before the mappers run, or no request would be tracked
+        if self.sampler is not None:
+            self.sampler.start()
+
+        if self.metrics_server is not None and self.metrics_prog_stats:
+            self.BM.enable_prog_stats()
+
+        # Until the filter is first published, system-wide probes account for no process
+        if self.proc_filter is not None:
+            self.proc_filter.update()
 
         for monitor in self.resource_monitors:
             self.BM.attach_resource_monitor(monitor)
@@ -231,15 +864,72 @@ class Finelame():
         for monitor in self.hardware_monitors:
             self.BM.attach_hardware_monitor(monitor)
 
-        for application in self.applications:
+        for app_id, application in enumerate(self.applications):
             for monitor in application['monitors']:
-                self.BM.attach_application_monitor(application['exec_path'], monitor)
-
-        self._loop()
-
-    def _stop(self, signal, frame):
-        log_info('Stopping Finelame')
+                self.BM.attach_application_monitor(application['exec_path'], monitor, app_id)
+
+        if self.selector is not None:
+            # Saved models may have dropped features already
+            if self.selector.prune and self.mode == 'detection':
+                self._detach_unused()
+            self.selector.start()
+
+        if self.events is not None:
+            self.events.open()
+        if self.trace is not None:
+            self.trace.open()
+        self.startup_timings['attach'] = time.time() - phase_start
+        log_info('Startup timings (seconds): {}'.format(
+                 ', '.join('{} {:.3f}'.format(phase, t) for phase, t in self.startup_timings.items())))
+
+        asyncio.run(self._run())
+
+    def _shutdown(self):
+        ''' Detach the probes and write out everything still held in the kernel or in memory '''
         self.BM.detach_all_monitors()
+        self.BM.restore_prog_stats()
+
+        if self.sampler is not None:
+            self.sampler.record()
+            for app_id in range(len(self.applications)):
+                seen, sampled = self.BM.get_sample_counts(app_id)
+                log_info('Tracked {} of {} requests of {}'.format(sampled, seen, self.app_names[app_id]))
+            self.outputs.write('sampling', self.sampler.counts())
+
+        for channel in (self.events, self.trace):
+            if channel is not None:
+                channel.consume()
+        if self.events is not None:
+            batch = self.events.take()
+            self._route_events(batch)
+            self.events.dispatch(batch)
+            log_info('Event channel stats: {}'.format(self.events.stats()))
+
+        if self.trace is not None:
+            self.trace.flush()
+            self.trace_file.close()
+            log_info('Trace channel stats: {}'.format(self.trace.stats()))
+
+        if self.collector is not None:
+            log_info('Collector stats: {}'.format(self.collector.stats))
+
+        if self.sweeper is not None:
+            log_info('Removed entries of exited threads: {}'.format(self.sweeper.n_removed))
+        if self.proc_filter is not None:
+            log_info('Process filter: {}'.format(self.proc_filter.stats))
+        if any(self.BM.n_evicted.values()):
+            log_warn('LRU maps evicted requests before they were drained: {}'.format(self.BM.n_evicted))
+
+        if self.cascade is not None:
+            self._sweep_candidates()
+            self.cascade.process()
+            self.outputs.write('cascade', self.cascade.take_records())
+            log_info('Cascade: {}'.format(self.cascade.stats()))
+
+        if self.mitigator is not None:
+            self._sweep_flagged()
+            self.mitigator.close()
+            log_info('Mitigation: {}'.format(self.mitigator.latency_summary()))
 
         '''
         #Check cache data
@@ -250,18 +940,21 @@ class Finelame():
 
         #Retrieve request data if we are in monitoring mode only
         if self.mode == 'monitoring':
-            data = self.BM.get_request_stats()
-            if data.empty:
-                log_info('Did not record any data. Resetting timer')
-            #XXX dump those data to file
+            if self.drainer is not None:
+                self.drainer.drain(force=True)
+            else:
+                data = self.BM.get_request_stats()
+                if data.empty:
+                    log_info('Did not record any data. Resetting timer')
+                #XXX dump those data to file
 
         # We might have training data if we are in either of those modes
         if self.mode == 'train' or self.mode == 'detection':
-            #Dump training data to csv
-            if self.FD.X_train is not None:
-                fname = os.path.join(self.outdir, 'train_{}.csv'.format(self.run_label))
-                log_info('Dumping train data into {}...'.format(fname))
-                self.FD.X_train.to_csv(fname, index=False)
+            #Dump training data, unless it was written when the model was trained
+            if all(FD.X_train is None for FD in self.FDs):
+                log_info('Dumping train data...')
+                for FD in self.FDs:
+                    self.outputs.write('train', FD.reservoir.frame())
 
         #If we are in detection mode, we might have some AD data
         if self.mode == 'detection':
@@ -269,53 +962,53 @@ class Finelame():
             log_info('Gathering test datapoints...')
             #Collect datapoints
 
-            x_test = self.BM.get_request_stats()
-            if not x_test.empty:
-                fname = os.path.join(self.outdir, 'test_{}.csv'.format(self.run_label))
-                log_info('Dumping test data into {}...'.format(fname))
-                x_test.to_csv(fname, index=False)
-
-            fname = os.path.join(self.outdir, 'scores_{}.csv'.format(self.run_label))
-            log_info('Gathering outlier scores into {}...'.format(fname))
-            with open(fname, 'w') as f:
-                cols = "req_id,score,detection_ts,detection_cputime,last_ts,is_outlier,"
-                cols += ','.join(['score_%d' % i for i in range(self.FD.k)])
-                f.write(cols + '\n')
-                for k, v in self.BM.ebpf['outlier_scores_m'].items():
-                    dists = v.distances
-                    abs_dists = np.array([abs(d) for d in dists])
-                    idx = np.where(abs_dists == min(abs_dists))[0][0]
-                    min_dist = dists[idx]
-
-                    f.write(','.join([str(x) for x in
-                        [int(k.value), min_dist, v.detection_ts,v.detection_cputime,v.last_ts, v.is_outlier] + list(dists)
-                    ]) + '\n')
-
-            fname = os.path.join(self.outdir, 'normalization_{}.csv'.format(self.run_label))
-            log_info("Gathering normalization data into {}".format(fname))
-            with open(fname, 'w') as f:
-                f.write("feature,mean,std\n")
-                mean_std = [v.value for v in self.BM.ebpf['train_set_params'].values()]
-                for i, ft_name in enumerate(self.FD.features):
-                    f.write('{},{},{}\n'.format(ft_name, mean_std[i*2], mean_std[i*2+1]))
-
-            fname =os.path.join(self.outdir, "clusters_{}.csv".format(self.run_label))
-            log_info("Gathering cluster data into {}".format(fname))
-            with open(fname, 'w') as f:
-                f.write('l1,threshold\n')
-                for thresh, l1 in zip(self.BM.ebpf['cluster_thresholds'].values(),
-                                      self.BM.ebpf['centroid_l1s'].values()):
-                    f.write('{},{}\n'.format(l1.value, thresh.value))
-
-            fname = os.path.join(self.outdir, 'model_params_{}.csv'.format(self.run_label))
-            log_info('Gathering model parameters into {}...'.format(fname))
-            with open(fname, 'w') as f:
-                mean_std = [v.value for v in self.BM.ebpf['train_set_params'].values()]
-                f.write('{}\n'.format(mean_std))
-                for k, v in self.BM.ebpf['cluster_thresholds'].items():
-                    f.write('[k{}] {}\n'.format(k, v))
+            if self.drainer is not None:
+                # Whatever is left in the maps joins the already drained test data and scores
+                self.drainer.drain(force=True)
+            else:
+                log_info('Dumping test data and outlier scores...')
+                self.outputs.write('test', self.BM.get_request_stats())
+                self.outputs.write('scores', self.BM.get_outlier_scores())
+
+            for app_id, FD in enumerate(self.FDs):
+                self._dump_model(app_id, FD)
 
             shutil.copyfile(self.cfg_file,
                             os.path.join(self.outdir, 'fl_cfg_{}.yml'.format(self.run_label)))
 
-        self.is_running = False
+        self.outputs.close()
+
+    def _dump_model(self, app_id, FD):
+        model = self.BM.get_model(app_id)
+        if model['version'] == 0:
+            log_info('No model was loaded for {}'.format(self.app_names[app_id]))
+            return
+        mean_std = model['train_set_params']
+        # The kernel is built for the largest k, only this application's clusters matter
+        thresholds = model['cluster_thresholds'][:FD.k]
+        centroid_l1s = model['centroid_l1s'][:FD.k]
+        label = self._app_label(app_id)
+
+        fname = os.path.join(self.outdir, 'normalization_{}.csv'.format(label))
+        log_info("Gathering normalization data into {}".format(fname))
+        with open(fname, 'w') as f:
+            f.write("feature,mean,std,mult,shift\n")
+            for i, ft_name in enumerate(FD.features):
+                f.write('{},{},{},{},{}\n'.format(ft_name, mean_std[i*2], mean_std[i*2+1],
+                                                 model['norm_mult'][i], model['norm_shift'][i]))
+
+        fname =os.path.join(self.outdir, "clusters_{}.csv".format(label))
+        log_info("Gathering cluster data into {}".format(fname))
+        with open(fname, 'w') as f:
+            f.write('l1,threshold\n')
+            for thresh, l1 in zip(thresholds, centroid_l1s):
+                f.write('{},{}\n'.format(l1, thresh))
+
+        fname = os.path.join(self.outdir, 'model_params_{}.csv'.format(label))
+        log_info('Gathering model parameters into {}...'.format(fname))
+        with open(fname, 'w') as f:
+            f.write('{}\n'.format(mean_std))
+            for k, v in enumerate(thresholds):
+                f.write('[k{}] {}\n'.format(k, v))
+            f.write('version {}\n'.format(model['version']))
+            f.write('centroid_offset {}\n'.format(model['centroid_offset']))
@@ -0,0 +1,136 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import math
+import numpy as np
+
+'''
+Fixed-point arithmetic shared by the agent and the eBPF program.
+Raw datapoints are normalized as x * m_scale / (std * s_scale), so normalized values and
+centroid distances are expressed in units of 1 / c_scale, with c_scale = m_scale / s_scale.
+The kernel does not divide: each feature's factor m_scale / (std * s_scale) is shared as a
+multiplier below 2^32 and a shift, and normalization is (x * mult) >> shift.
+'''
+
+RECIPROCAL_BITS = 32
+NULL_STD = 10000 # Scaled std used when a feature's std rounds to 0
+
+def scale_factors(scale_method, m_scaler, s_scaler):
+    ''' Return (m_scale, s_scale) for a scale method and its exponents '''
+    if scale_method == 'exponent':
+        return 10 ** m_scaler, 10 ** s_scaler
+    elif scale_method == 'bitshift':
+        return 1 << m_scaler, 1 << s_scaler
+    raise Exception("Unknown scale method: %s" % scale_method)
+
+def norm_factors(std, m_scale, s_scale):
+    ''' Per-feature normalization factors m_scale / (std * s_scale), from float stds '''
+    std_s = np.asarray(std, dtype=np.float64) * s_scale
+    std_s = np.where(std_s.astype(np.int64) == 0, NULL_STD, std_s)
+    return m_scale / std_s
+
+def reciprocal(factor):
+    '''
+    (mult, shift) such that mult / 2^shift is the closest approximation of factor with
+    mult < 2^32, so that both halves of the kernel's split product fit in 64 bits.
+    '''
+    if factor <= 0:
+        return 0, 0
+    shift = RECIPROCAL_BITS - 1 - math.floor(math.log2(factor))
+    shift = min(max(shift, 0), 63)
+    mult = int(round(factor * 2 ** shift))
+    if mult >= 1 << RECIPROCAL_BITS:
+        if shift > 0:
+            shift -= 1
+            mult = int(round(factor * 2 ** shift))
+        mult = min(mult, (1 << RECIPROCAL_BITS) - 1)
+    return mult, shift
+
+def reciprocals(factors):
+    ''' Vector version of reciprocal(): returns (mults, shifts) arrays '''
+    pairs = [reciprocal(float(f)) for f in factors]
+    return (np.array([p[0] for p in pairs], dtype=np.uint64),
+            np.array([p[1] for p in pairs], dtype=np.uint64))
+
+def kernel_normalize(values, mult, shift):
+    '''
+    Vectorized normalize_datapoint(): mul_shift() on the absolute value, with the kernel's
+    32-bit split and u64 wrapping, sign restored afterwards.
+    values: (n, F) integers, mult and shift: (F,).
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    mult = np.asarray(mult, dtype=np.uint64)
+    shift = np.asarray(shift, dtype=np.uint64) & np.uint64(63)
+    x = np.abs(values).astype(np.uint64)
+    with np.errstate(over='ignore'):
+        lo = ((x & np.uint64(0xffffffff)) * mult) >> shift
+        hi = (x >> np.uint64(32)) * mult
+        down = np.where(shift >= 32, shift - np.uint64(32), np.uint64(0))
+        up = np.where(shift < 32, np.uint64(32) - shift, np.uint64(0))
+        hi = np.where(shift >= 32, hi >> down, hi << up)
+        normalized = (hi + lo).astype(np.int64)
+    return np.where(values < 0, -normalized, normalized)
+
+def division_normalize(values, m_scale, std_s):
+    '''
+    Former kernel normalization, x * m_scale (wrapping like a long long) divided by the
+    truncated scaled std. Kept as a reference for normalization_error().
+    '''
+    std_s = np.asarray(std_s, dtype=np.int64)
+    std_s = np.where(std_s == 0, NULL_STD, std_s)
+    with np.errstate(over='ignore'):
+        scaled = np.asarray(values, dtype=np.int64) * np.int64(m_scale)
+    return np.sign(scaled) * (np.abs(scaled) // std_s)
+
+def normalization_error(values, std, m_scale, s_scale, mult, shift):
+    '''
+    Precision of the kernel's normalization against the float scaler, per feature: mean and
+    max absolute error (in 1 / c_scale units) and max relative error, for the multiply-shift
+    normalization and for the former division.
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    exact = values * norm_factors(std, m_scale, s_scale)
+    std_s = (np.asarray(std, dtype=np.float64) * s_scale).astype(np.int64)
+    report = dict()
+    for name, approx in (('reciprocal', kernel_normalize(values, mult, shift)),
+                         ('division', division_normalize(values, m_scale, std_s))):
+        err = np.abs(approx - exact)
+        rel = err / np.maximum(np.abs(exact), 1)
+        report[name] = dict(mean_abs = err.mean(axis=0).tolist() if len(err) else [],
+                            max_abs = err.max(axis=0).tolist() if len(err) else [],
+                            max_rel = rel.max(axis=0).tolist() if len(err) else [])
+    return report
+
+def kernel_decide(distances, thresholds):
+    '''
+    Vectorized decision loop of update_outlier_score(): the closest cluster (first one
+    on ties) among those with a threshold set, and whether the request is past it.
+    Returns (min_dist, is_outlier).
+    '''
+    thresholds = np.asarray(thresholds, dtype=np.int64)
+    valid = thresholds != 0
+    abs_dist = np.where(valid, np.abs(distances), np.iinfo(np.int64).max)
+    closest = np.argmin(abs_dist, axis=1)
+    rows = np.arange(len(distances))
+    min_dist = distances[rows, closest]
+    is_outlier = (min_dist > 0) & (min_dist > thresholds[closest])
+    if not valid.any():
+        is_outlier[:] = False
+    return min_dist, is_outlier
@@ -0,0 +1,158 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Agent side of fleet-wide training, and the protocol agents and the collector speak.
+Messages are frames on a Unix stream socket: two big-endian u32 lengths, then a JSON
+header and a binary payload. Agents send:
+    hello: {type, host, pid, apps: {name: {features, k}}}
+    batch: {type, app, rows}, with rows x features float64 values as payload
+The collector sends:
+    model: {type, app, version, params}, params as BCCMonitor.load_model takes them
+    error: {type, message}, before closing the connection
+'''
+
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+import numpy as np
+
+from logger import *
+
+DEFAULT_PATH = '/run/finelame/collector.sock'
+DEFAULT_SAMPLE_RATE = 0.1
+DEFAULT_INTERVAL = 5
+DEFAULT_MAX_PENDING = 100000
+DEFAULT_RECONNECT = 5
+
+FRAME_HEADER = struct.Struct('!II')
+
+async def read_msg(reader):
+    ''' Next message as (header, payload), or (None, None) once the peer closed '''
+    try:
+        sizes = await reader.readexactly(FRAME_HEADER.size)
+        header_size, payload_size = FRAME_HEADER.unpack(sizes)
+        header = json.loads(await reader.readexactly(header_size))
+        payload = await reader.readexactly(payload_size)
+    except asyncio.IncompleteReadError:
+        return None, None
+    return header, payload
+
+def write_msg(writer, header, payload=b''):
+    header = json.dumps(header).encode()
+    writer.write(FRAME_HEADER.pack(len(header), len(payload)) + header + payload)
+
+class CollectorClient():
+    '''
+    Streams a sample of an agent's drained requests to the collector, and hands the
+    models it pushes back to on_model(app_id, params), on the agent's event loop.
+    submit may be called from any thread. Requests are buffered while disconnected,
+    up to max_pending per application, and sent every interval seconds.
+    '''
+    def __init__(self, app_names, detectors, on_model, path=DEFAULT_PATH,
+                 sample_rate=DEFAULT_SAMPLE_RATE, interval=DEFAULT_INTERVAL,
+                 max_pending=DEFAULT_MAX_PENDING, reconnect=DEFAULT_RECONNECT, seed=None):
+        self.app_names = app_names
+        self.FDs = detectors
+        self.on_model = on_model
+        self.path = path
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_pending = max_pending
+        self.reconnect = reconnect
+        self.rng = np.random.default_rng(seed)
+
+        self.lock = threading.Lock()
+        self.pending = {app_id: list() for app_id in range(len(app_names))}
+        self.stats = dict(sent = 0, dropped = 0, models = 0, connections = 0)
+
+    def submit(self, app_id, X):
+        ''' Queue a sample of an application's requests (rows of feature values) '''
+        X = X[self.rng.random(len(X)) < self.sample_rate]
+        if not len(X):
+            return
+        with self.lock:
+            pending = self.pending[app_id]
+            pending.append(X)
+            n_pending = sum(len(x) for x in pending)
+            while n_pending > self.max_pending:
+                n_pending -= len(pending[0])
+                self.stats['dropped'] += len(pending.pop(0))
+
+    def _take(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {app_id: list() for app_id in pending}
+        return {app_id: np.concatenate(xs) for app_id, xs in pending.items() if xs}
+
+    def _hello(self):
+        apps = {name: dict(features = FD.features, k = FD.k) for name, FD in zip(self.app_names, self.FDs)}
+        return dict(type = 'hello', host = socket.gethostname(), pid = os.getpid(), apps = apps)
+
+    async def _receive(self, reader):
+        while True:
+            header, _ = await read_msg(reader)
+            if header is None:
+                return
+            if header['type'] == 'error':
+                log_error('Collector refused this agent: {}'.format(header['message']))
+                return
+            if header['type'] == 'model' and header['app'] in self.app_names:
+                self.stats['models'] += 1
+                self.on_model(self.app_names.index(header['app']), header['params'])
+
+    async def _send(self, writer):
+        while True:
+            await asyncio.sleep(self.interval)
+            for app_id, X in self._take().items():
+                X = np.ascontiguousarray(X, dtype=np.float64)
+                write_msg(writer, dict(type = 'batch', app = self.app_names[app_id], rows = len(X)),
+                          X.tobytes())
+                self.stats['sent'] += len(X)
+            await writer.drain()
+
+    async def run(self):
+        ''' Stay connected to the collector until cancelled '''
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                log_warn('Could not reach the collector at {}: {}'.format(self.path, e))
+                await asyncio.sleep(self.reconnect)
+                continue
+            self.stats['connections'] += 1
+            log_info('Connected to the collector at {}'.format(self.path))
+            write_msg(writer, self._hello())
+            receive = asyncio.ensure_future(self._receive(reader))
+            send = asyncio.ensure_future(self._send(writer))
+            try:
+                await asyncio.wait([receive, send], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                receive.cancel()
+                send.cancel()
+                writer.close()
+            if send.done() and not send.cancelled() and send.exception() is not None:
+                log_warn('Lost the collector: {}'.format(send.exception()))
+            else:
+                log_warn('The collector closed the connection')
+            await asyncio.sleep(self.reconnect)
@@ -0,0 +1,206 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import ctypes as ct
+import errno
+import os
+import numpy as np
+
+from logger import *
+
+try:
+    from bcc.libbcc import lib as libbcc
+except ImportError:
+    libbcc = None
+
+'''
+Columnar readers for eBPF hash maps.
+Tables are read in chunks of raw Key/Leaf bytes which are then viewed as NumPy
+structured arrays, so no Python object is built per map entry. Any object
+exposing the bcc table interface (Key, Leaf and items()) can be harvested;
+batch lookups are only attempted on tables backed by a map file descriptor.
+'''
+
+DEFAULT_CHUNK_SIZE = 65536
+
+# Request keys hold the application id in their top byte (see fl_key() in the eBPF program)
+APP_SHIFT = 56
+RID_MASK = (1 << APP_SHIFT) - 1
+
+def split_keys(keys):
+    ''' Split request keys into (application ids, application request ids) '''
+    keys = np.asarray(keys, dtype=np.uint64)
+    return (keys >> np.uint64(APP_SHIFT)).astype(np.uint32), keys & np.uint64(RID_MASK)
+
+def ctypes_dtype(ctype):
+    ''' Translate a ctypes scalar, array or structure into a NumPy dtype with the same layout '''
+    if issubclass(ctype, (ct.Structure, ct.Union)):
+        names, formats, offsets = [], [], []
+        for field in ctype._fields_:
+            name, ftype = field[0], field[1]
+            names.append(name)
+            formats.append(ctypes_dtype(ftype))
+            offsets.append(getattr(ctype, name).offset)
+        return np.dtype({'names': names, 'formats': formats,
+                         'offsets': offsets, 'itemsize': ct.sizeof(ctype)})
+    if issubclass(ctype, ct.Array):
+        return np.dtype((ctypes_dtype(ctype._type_), (ctype._length_,)))
+    return np.dtype(ctype)
+
+def _empty(dtype):
+    return np.empty(0, dtype=dtype)
+
+def reduce_percpu(values, max_fields=(), min_fields=()):
+    '''
+    Combine the per-CPU copies of per-CPU map values, shaped (entries, cpus), into one
+    value per entry: fields are summed, except max_fields (latest of the CPUs) and
+    min_fields (earliest non-zero value of the CPUs).
+    '''
+    if values.ndim == 1:
+        return values
+    reduced = np.zeros(len(values), dtype=values.dtype)
+    for name in values.dtype.names:
+        field = values[name]
+        if name in max_fields:
+            reduced[name] = field.max(axis=1)
+        elif name in min_fields:
+            fmax = np.iinfo(field.dtype).max
+            earliest = np.where(field == 0, fmax, field).min(axis=1)
+            reduced[name] = np.where(earliest == fmax, 0, earliest)
+        else:
+            reduced[name] = field.sum(axis=1, dtype=field.dtype)
+    return reduced
+
+class MapHarvester():
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        # None until the first batch lookup tells us whether the kernel supports it
+        self.batch_supported = None if libbcc is not None \
+                               and hasattr(libbcc, 'bpf_lookup_batch') else False
+
+    def _read_batched(self, table, key_dtype, leaf_dtype):
+        '''
+        Read the map with BPF_MAP_LOOKUP_BATCH, chunk_size entries per syscall.
+        Returns None if the kernel does not implement batch operations.
+        '''
+        chunk_size = self.chunk_size
+        cursor = ct.c_uint32(0)
+        count = ct.c_uint32(0)
+        keys, values = [], []
+        first = True
+        while True:
+            ct_keys = (table.Key * chunk_size)()
+            ct_values = (table.Leaf * chunk_size)()
+            count.value = chunk_size
+            res = libbcc.bpf_lookup_batch(table.map_fd,
+                                          None if first else ct.byref(cursor),
+                                          ct.byref(cursor),
+                                          ct.byref(ct_keys),
+                                          ct.byref(ct_values),
+                                          ct.byref(count))
+            err = ct.get_errno()
+            if res != 0 and err in (errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS) \
+               and first:
+                return None
+            if res != 0 and err == errno.ENOSPC and count.value == 0:
+                # A single hash bucket does not fit in the chunk
+                chunk_size *= 2
+                continue
+            if count.value:
+                keys.append(np.frombuffer(ct_keys, dtype=key_dtype, count=count.value).copy())
+                values.append(np.frombuffer(ct_values, dtype=leaf_dtype, count=count.value).copy())
+            if res != 0:
+                if err == errno.ENOENT:
+                    break
+                raise OSError(err, 'bpf_lookup_batch failed: %s' % os.strerror(err))
+            first = False
+
+        if not keys:
+            return _empty(key_dtype), _empty(leaf_dtype)
+        return np.concatenate(keys), np.concatenate(values)
+
+    def _read_iter(self, table, key_dtype, leaf_dtype):
+        ''' Chunked fallback: walk the map with get_next_key and pack the raw bytes per chunk '''
+        key_size = ct.sizeof(table.Key)
+        leaf_size = ct.sizeof(table.Leaf)
+        keys, values = [], []
+        kbuf, vbuf = bytearray(), bytearray()
+        n = 0
+        for k, v in table.items():
+            kbuf += ct.string_at(ct.addressof(k), key_size)
+            vbuf += ct.string_at(ct.addressof(v), leaf_size)
+            n += 1
+            if n == self.chunk_size:
+                keys.append(np.frombuffer(bytes(kbuf), dtype=key_dtype))
+                values.append(np.frombuffer(bytes(vbuf), dtype=leaf_dtype))
+                kbuf, vbuf = bytearray(), bytearray()
+                n = 0
+        if n:
+            keys.append(np.frombuffer(bytes(kbuf), dtype=key_dtype))
+            values.append(np.frombuffer(bytes(vbuf), dtype=leaf_dtype))
+
+        if not keys:
+            return _empty(key_dtype), _empty(leaf_dtype)
+        return np.concatenate(keys), np.concatenate(values)
+
+    def harvest(self, table):
+        '''
+        Return (keys, values) of a map as NumPy arrays whose dtypes mirror the
+        table's Key and Leaf types.
+        '''
+        key_dtype = ctypes_dtype(table.Key)
+        leaf_dtype = ctypes_dtype(table.Leaf)
+
+        if self.batch_supported is not False and hasattr(table, 'map_fd'):
+            out = self._read_batched(table, key_dtype, leaf_dtype)
+            if out is not None:
+                self.batch_supported = True
+                return out
+            log_info('Kernel does not support batch map lookups, falling back to chunked iteration')
+            self.batch_supported = False
+
+        return self._read_iter(table, key_dtype, leaf_dtype)
+
+    def delete(self, table, keys):
+        ''' Delete the given keys (as returned by harvest) from the map '''
+        n = len(keys)
+        if n == 0:
+            return 0
+        raw = np.ascontiguousarray(keys).tobytes()
+        start = 0
+
+        if self.batch_supported and hasattr(libbcc, 'bpf_delete_batch'):
+            ct_keys = (table.Key * n).from_buffer_copy(raw)
+            count = ct.c_uint32(n)
+            res = libbcc.bpf_delete_batch(table.map_fd, ct.byref(ct_keys), ct.byref(count))
+            if res == 0:
+                return count.value
+            # A key was already gone, which stops the batch: finish one by one
+            start = count.value
+
+        key_size = ct.sizeof(table.Key)
+        deleted = start
+        for i in range(start, n):
+            try:
+                del table[table.Key.from_buffer_copy(raw, i * key_size)]
+                deleted += 1
+            except KeyError:
+                pass
+        return deleted
@@ -0,0 +1,213 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Agent metrics, served in the Prometheus text format.
+Code paths record durations and counts in the module-level METRICS registry, which only
+costs a dict update. Values that live in the kernel (program statistics, map counters)
+are read by collectors when the endpoint is scraped, so nothing is polled in between.
+'''
+
+import asyncio
+import threading
+
+from logger import *
+
+DEFAULT_ADDRESS = '127.0.0.1'
+DEFAULT_PORT = 9464
+
+# name: (type, help)
+DESCRIPTIONS = dict(
+    finelame_prog_run_count_total = ('counter', 'Runs of an eBPF program'),
+    finelame_prog_run_time_seconds_total = ('counter', 'Time spent running an eBPF program'),
+    finelame_map_entries = ('gauge', 'Entries in an eBPF map'),
+    finelame_map_capacity = ('gauge', 'Maximum number of entries of an eBPF map'),
+    finelame_map_insert_failures_total = ('counter', 'Entries the eBPF program could not insert in a full map'),
+    finelame_map_evictions_total = ('counter', 'Entries an LRU map evicted before the agent drained them (lower bound)'),
+    finelame_map_stale_entries_total = ('counter', 'Thread map entries of exited threads removed by the agent'),
+    finelame_map_memory_bytes = ('gauge', 'Memory used by an eBPF map, estimated from its entry size'),
+    finelame_phase_duration_seconds = ('summary', 'Duration of agent phases (harvest, train, swap, ...)'),
+    finelame_outliers_total = ('counter', 'Requests flagged as outliers, per application'),
+    finelame_model_version = ('gauge', 'Version of the model the probes use, per application'),
+    finelame_requests_drained_total = ('counter', 'Requests drained from the eBPF maps'),
+    finelame_event_drops_total = ('counter', 'Kernel events dropped because the buffer was full'),
+    finelame_trace_drops_total = ('counter', 'Trace records dropped because the buffer was full'),
+    finelame_sample_rate = ('gauge', 'Share of new requests the mappers track'),
+    finelame_feature_drift = ('gauge', 'Population stability index of recent requests against the training set'),
+    finelame_drift_window_requests = ('gauge', 'Requests in the drift detection window'),
+    finelame_drift_alarms_total = ('counter', 'Times an application drifted from its training distribution'),
+    finelame_mitigation_latency_seconds = ('histogram', 'Time from detection in the kernel to a mitigation action'),
+    finelame_mitigation_actions_total = ('counter', 'Mitigation actions applied'),
+    finelame_mitigation_suppressed_total = ('counter', 'Mitigations skipped by the rate limit or cooldown'),
+    finelame_filter_processes = ('gauge', 'Processes of an application the system-wide probes account for'),
+    finelame_feature_importance = ('gauge', 'Share of training requests whose cluster or decision depends on a feature'),
+    finelame_feature_probe_overhead = ('gauge', 'Share of CPU time spent in the probes feeding a feature during training'),
+    finelame_cascade_candidates_total = ('counter', 'Requests the probes flagged as candidates for the second stage'),
+    finelame_cascade_verdicts_total = ('counter', 'Second-stage verdicts on candidates (outlier, cleared, expired)'),
+    finelame_cascade_candidate_rate = ('gauge', 'Share of drained requests that were candidates'),
+    finelame_cascade_throughput = ('gauge', 'Candidates scored per second by the last second-stage batch'),
+    finelame_cascade_latency_seconds = ('histogram', 'Time from a candidate being flagged in the kernel to its verdict'),
+)
+
+# Upper bounds of histogram buckets: 1us to 1s, four per decade
+DEFAULT_BUCKETS = tuple(10 ** (e / 4) for e in range(-24, 1))
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+class Metrics():
+    '''
+    A registry of counters, gauges, summaries (sum and count, no quantiles) and
+    histograms with fixed buckets
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = dict()
+        self.collectors = list()
+        self.buckets = dict()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series = self.values.setdefault(name, dict())
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values.setdefault(name, dict())[_labels(labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            series = self.values.setdefault(name, dict())
+            key = _labels(labels)
+            total, count = series.get(key, (0., 0))
+            series[key] = (total + value, count + 1)
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS):
+        ''' Declare the buckets of a histogram, before observing it with observe_hist '''
+        self.buckets[name] = tuple(sorted(buckets))
+
+    def observe_hist(self, name, value, **labels):
+        buckets = self.buckets.get(name, DEFAULT_BUCKETS)
+        with self.lock:
+            series = self.values.setdefault(name, dict())
+            key = _labels(labels)
+            if key not in series:
+                series[key] = ([0] * len(buckets), 0., 0)
+            counts, total, count = series[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[key] = (counts, total + value, count + 1)
+
+    def add_collector(self, collector):
+        ''' collector(metrics) is called on every scrape, to set values read elsewhere '''
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                log_warn('Metrics collector failed: {}'.format(e))
+
+        lines = list()
+        with self.lock:
+            for name in sorted(self.values):
+                mtype, help = DESCRIPTIONS.get(name, ('untyped', name))
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} {}'.format(name, mtype))
+                for labels, value in sorted(self.values[name].items()):
+                    if mtype == 'histogram':
+                        lines.extend(self._render_histogram(name, labels, value))
+                    elif mtype == 'summary':
+                        lines.append('{}_sum{} {}'.format(name, _format_labels(labels), value[0]))
+                        lines.append('{}_count{} {}'.format(name, _format_labels(labels), value[1]))
+                    else:
+                        lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def _render_histogram(self, name, labels, value):
+        counts, total, count = value
+        buckets = self.buckets.get(name, DEFAULT_BUCKETS)
+        cumulative = 0
+        for bound, n in zip(buckets, counts):
+            cumulative += n
+            yield '{}_bucket{} {}'.format(name, _format_labels(labels + (('le', '{:g}'.format(bound)),)),
+                                          cumulative)
+        yield '{}_bucket{} {}'.format(name, _format_labels(labels + (('le', '+Inf'),)), count)
+        yield '{}_sum{} {}'.format(name, _format_labels(labels), total)
+        yield '{}_count{} {}'.format(name, _format_labels(labels), count)
+
+METRICS = Metrics()
+
+class MetricsServer():
+    '''
+    Serves a registry on http://address:port/metrics from the agent's event loop.
+    Collectors run in the loop's default executor.
+    '''
+
+    REQUEST_TIMEOUT = 5
+
+    def __init__(self, metrics=METRICS, address=DEFAULT_ADDRESS, port=DEFAULT_PORT):
+        self.metrics = metrics
+        self.address = address
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.address, self.port)
+        log_info('Serving metrics on http://{}:{}/metrics'.format(self.address, self.port))
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _read_request(self, reader):
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        return request.split()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(self._read_request(reader), self.REQUEST_TIMEOUT)
+            if len(request) < 2 or request[0] != b'GET' or request[1].split(b'?')[0] != b'/metrics':
+                writer.write(b'HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            else:
+                body = await asyncio.get_running_loop().run_in_executor(None, self.metrics.render)
+                body = body.encode()
+                writer.write('HTTP/1.0 200 OK\r\n'
+                             'Content-Type: text/plain; version=0.0.4\r\n'
+                             'Content-Length: {}\r\n\r\n'.format(len(body)).encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
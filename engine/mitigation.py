@@ -0,0 +1,301 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Mitigation of flagged requests.
+The eBPF program records requests in the flagged map when it first flags them, and emits
+an outlier event. The agent reacts to the events as soon as it reads them, on its event
+loop, and periodically sweeps the flagged map for records whose event was lost. Actions
+are applied within a global rate limit, and at most once per source per cooldown.
+'''
+
+import collections
+import importlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from logger import *
+from .harvest import split_keys
+from .metrics import METRICS
+from .notification import EVT_OUTLIER
+
+DEFAULT_RATE = 100
+DEFAULT_COOLDOWN = 10
+DEFAULT_SWEEP_INTERVAL = 1
+DEFAULT_PIN_PATH = '/sys/fs/bpf/finelame/blocklist'
+
+NS_PER_S = 1000 * 1000 * 1000
+
+def format_addr(saddr):
+    ''' Dotted quad of an IPv4 address as the kernel stores it (network order in a u32) '''
+    if not saddr:
+        return None
+    return socket.inet_ntoa(int(saddr).to_bytes(4, sys.byteorder))
+
+'''
+Actions are callables receiving a flag, a dict with the app, rid, saddr, addr, score,
+cputime (None if unknown) and detection_ts (bpf_ktime_get_ns time) of a request.
+They return whether they acted, and are closed when the agent stops.
+'''
+class LogAction():
+    def __init__(self, bm):
+        pass
+
+    def __call__(self, flag):
+        log_warn('Mitigating request %d of application %d from %s (score %d)',
+                 flag['rid'], flag['app'], flag['addr'], flag['score'])
+        return True
+
+    def close(self):
+        pass
+
+class CallbackAction():
+    ''' Call function, given as 'module:function', with the flag '''
+    def __init__(self, bm, function):
+        module, name = function.split(':')
+        self.function = getattr(importlib.import_module(module), name)
+
+    def __call__(self, flag):
+        return self.function(flag) is not False
+
+    def close(self):
+        pass
+
+class UnixSocketAction():
+    '''
+    Send the flag as a JSON datagram to a Unix socket. Sends never block: the flag is
+    dropped if nothing listens or the receiver lags behind.
+    '''
+    def __init__(self, bm, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.n_dropped = 0
+
+    def __call__(self, flag):
+        try:
+            self.sock.sendto(json.dumps(flag).encode(), self.path)
+        except OSError as e:
+            self.n_dropped += 1
+            log_debug('Could not push flag to {}: {}'.format(self.path, e))
+            return False
+        return True
+
+    def close(self):
+        if self.n_dropped:
+            log_warn('Dropped {} flags not accepted by {}'.format(self.n_dropped, self.path))
+        self.sock.close()
+
+class BlocklistAction():
+    '''
+    Add the source address to the blocklist map for ttl seconds (0 for ever). The map is
+    pinned at pin_path, where a packet filter such as xdp_blocklist can open it.
+    Expired entries are removed on sweeps; the map is unpinned when the agent stops.
+    '''
+    def __init__(self, bm, ttl=60, pin_path=DEFAULT_PIN_PATH):
+        self.BM = bm
+        self.ttl = ttl
+        self.pin_path = None
+        if pin_path:
+            self._pin(pin_path)
+
+    def _pin(self, pin_path):
+        from bcc import libbcc
+        os.makedirs(os.path.dirname(pin_path), exist_ok=True)
+        if os.path.exists(pin_path):
+            os.remove(pin_path)
+        fd = self.BM.ebpf['blocklist'].map_fd
+        if libbcc.lib.bpf_obj_pin(fd, pin_path.encode()) < 0:
+            log_warn('Could not pin the blocklist map at {}'.format(pin_path))
+            return
+        self.pin_path = pin_path
+        log_info('Blocklist map pinned at {}'.format(pin_path))
+
+    def __call__(self, flag):
+        if not flag['saddr']:
+            return False
+        expiry = time.monotonic_ns() + int(self.ttl * NS_PER_S) if self.ttl else 0
+        self.BM.block_source(flag['saddr'], expiry)
+        return True
+
+    def sweep(self):
+        now = time.monotonic_ns()
+        expired = [saddr for saddr, expiry in self.BM.blocked_sources().items() if 0 < expiry <= now]
+        self.BM.unblock_sources(expired)
+
+    def close(self):
+        if self.pin_path is not None:
+            os.remove(self.pin_path)
+            self.pin_path = None
+
+MITIGATION_ACTIONS = {
+    'log': LogAction,
+    'callback': CallbackAction,
+    'unix_socket': UnixSocketAction,
+    'blocklist': BlocklistAction,
+}
+
+def make_actions(bm, cfg):
+    ''' Actions are listed by name, or as {name: {parameters}} '''
+    actions = dict()
+    for entry in cfg:
+        if isinstance(entry, str):
+            name, params = entry, dict()
+        else:
+            (name, params), = entry.items()
+        if name not in MITIGATION_ACTIONS:
+            raise Exception('Unknown mitigation action {}'.format(name))
+        actions[name] = MITIGATION_ACTIONS[name](bm, **(params or dict()))
+    return actions
+
+class Mitigator():
+    '''
+    Applies the actions to flagged requests, from outlier events (on_events) or from
+    the flagged map (sweep). rate limits actions per second, with bursts of up to
+    burst; a source (address, or request if the address is unknown) is acted upon at
+    most once per cooldown seconds. With flagged False, the flagged map is left to
+    another reader (the detection cascade), which hands confirmed flags to on_flags.
+    '''
+
+    def __init__(self, bm, actions, rate=DEFAULT_RATE, burst=None,
+                 cooldown=DEFAULT_COOLDOWN, sweep_interval=DEFAULT_SWEEP_INTERVAL, flagged=True):
+        self.BM = bm
+        self.flagged = flagged
+        self.actions = make_actions(bm, actions)
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.cooldown = cooldown
+        self.sweep_interval = sweep_interval
+
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.last_action = dict()
+        self.handled = dict()
+        self.latencies = collections.deque(maxlen=100000)
+        self.records = list()
+        METRICS.histogram('finelame_mitigation_latency_seconds')
+
+    def _take_token(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def _mitigate(self, flag, key, path):
+        now = time.monotonic()
+        self.handled[key] = now
+        source = flag['saddr'] or key
+        if now - self.last_action.get(source, -self.cooldown) < self.cooldown:
+            METRICS.inc('finelame_mitigation_suppressed_total', reason='cooldown')
+            return
+        if not self._take_token(now):
+            METRICS.inc('finelame_mitigation_suppressed_total', reason='rate')
+            return
+        self.last_action[source] = now
+
+        applied = list()
+        for name, action in self.actions.items():
+            try:
+                if action(flag):
+                    applied.append(name)
+                    METRICS.inc('finelame_mitigation_actions_total', action=name)
+            except Exception as e:
+                log_error('Mitigation action {} failed: {}'.format(name, e))
+        latency = (time.monotonic_ns() - flag['detection_ts']) / NS_PER_S
+        self.latencies.append(latency)
+        METRICS.observe_hist('finelame_mitigation_latency_seconds', latency, path=path)
+        self.records.append(dict(flag, path = path, latency = latency, actions = ','.join(applied)))
+
+    def on_events(self, events):
+        ''' Act on the outlier events of a decoded batch '''
+        outliers = events[events['type'] == EVT_OUTLIER]
+        if not len(outliers):
+            return
+        apps, rids = split_keys(outliers['req_id'])
+        with self.lock:
+            for app, rid, evt in zip(apps, rids, outliers):
+                flag = dict(app = int(app), rid = int(rid), saddr = int(evt['saddr']),
+                            addr = format_addr(evt['saddr']), score = int(evt['score']),
+                            cputime = int(evt['cputime']), detection_ts = int(evt['ts']))
+                self._mitigate(flag, int(evt['req_id']), 'event')
+
+    def on_flags(self, flags, path='cascade'):
+        ''' Act on (request key, flag) pairs confirmed outside the kernel '''
+        with self.lock:
+            for key, flag in flags:
+                if key not in self.handled:
+                    self._mitigate(flag, key, path)
+
+    def _sweep_flagged(self):
+        keys, values = self.BM.harvest_flagged()
+        apps, rids = split_keys(keys)
+        for key, app, rid, value in zip(keys, apps, rids, values):
+            if int(key) in self.handled:
+                continue
+            flag = dict(app = int(app), rid = int(rid), saddr = int(value['saddr']),
+                        addr = format_addr(value['saddr']), score = int(value['score']),
+                        cputime = None, detection_ts = int(value['detection_ts']))
+            self._mitigate(flag, int(key), 'sweep')
+        self.BM.delete_flagged(keys)
+
+    def sweep(self):
+        '''
+        Act on flagged requests no event was received for, then clear the flagged map,
+        expired blocklist entries and stale cooldowns
+        '''
+        with self.lock:
+            if self.flagged:
+                self._sweep_flagged()
+
+            now = time.monotonic()
+            horizon = max(self.cooldown, 2 * self.sweep_interval)
+            self.handled = {k: t for k, t in self.handled.items() if now - t < horizon}
+            self.last_action = {s: t for s, t in self.last_action.items() if now - t < self.cooldown}
+            for action in self.actions.values():
+                if hasattr(action, 'sweep'):
+                    action.sweep()
+
+    def take_records(self):
+        ''' Mitigations applied since the last call, one row per request '''
+        with self.lock:
+            records, self.records = self.records, list()
+        return pd.DataFrame(records, columns=['app', 'rid', 'saddr', 'addr', 'score', 'cputime',
+                                              'detection_ts', 'path', 'latency', 'actions'])
+
+    def latency_summary(self):
+        if not self.latencies:
+            return 'no mitigation applied'
+        latencies = np.array(self.latencies) * 1e6
+        return '{} mitigations, latency p50 {:.0f}us p99 {:.0f}us max {:.0f}us'.format(
+               len(latencies), np.percentile(latencies, 50), np.percentile(latencies, 99),
+               latencies.max())
+
+    def close(self):
+        for action in self.actions.values():
+            action.close()
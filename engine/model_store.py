@@ -0,0 +1,159 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Model artifacts, saved every time a model is loaded into the kernel and loaded back when
+the agent starts. An artifact is a JSON file per application, model_[app].json:
+    format: version of this layout (MODEL_FORMAT)
+    app, revision (incremented by every save), created (UNIX time), kernel_version
+    features, k, scale_method, m_scale, s_scale: what the model was trained with
+    dropped: features left out of the model (see FinelameDetector.drop_features)
+    scaler: {mean, scale} of the features, or None for models from the collector
+    centroids: k-means centroids in the scaler's standardized space, or None
+    kernel: the fixed-point parameters, as BCCMonitor.load_model takes them
+'''
+
+import json
+import os
+import socket
+import time
+import numpy as np
+
+from logger import *
+
+#ML libs
+from sklearn.cluster import KMeans
+from sklearn.preprocessing import StandardScaler
+
+MODEL_FORMAT = 1
+DEFAULT_PATH = '/var/lib/finelame/models'
+
+KERNEL_PARAMS = ['train_set_params', 'norm_mult', 'norm_shift', 'cluster_thresholds',
+                 'centroid_l1s', 'centroid_offset']
+
+class ModelStore():
+    '''
+    Saves the models of an agent's applications under path, and loads them back at
+    startup when warm_start is set. Files are replaced atomically, so a crash leaves
+    the previous model in place.
+    '''
+
+    def __init__(self, app_names, path=DEFAULT_PATH, warm_start=True):
+        self.app_names = app_names
+        self.path = path
+        self.warm_start = warm_start
+        self.revisions = dict()
+        os.makedirs(path, exist_ok=True)
+
+    def model_file(self, app_id):
+        return os.path.join(self.path, 'model_{}.json'.format(self.app_names[app_id]))
+
+    def _read(self, app_id):
+        fname = self.model_file(app_id)
+        if not os.path.exists(fname):
+            return None
+        with open(fname, 'r') as f:
+            return json.load(f)
+
+    def save(self, app_id, FD, params, version, scaler=None, centroids=None):
+        ''' Write an application's model, as loaded into the kernel '''
+        if app_id not in self.revisions:
+            try:
+                previous = self._read(app_id)
+            except ValueError:
+                previous = None
+            self.revisions[app_id] = previous['revision'] if previous else 0
+        self.revisions[app_id] += 1
+
+        artifact = dict(format = MODEL_FORMAT,
+                        app = self.app_names[app_id],
+                        revision = self.revisions[app_id],
+                        created = time.time(),
+                        host = socket.gethostname(),
+                        kernel_version = version,
+                        features = FD.features,
+                        dropped = FD.dropped,
+                        k = len(params['cluster_thresholds']),
+                        scale_method = FD.scale_method,
+                        m_scale = FD.m_scaler,
+                        s_scale = FD.s_scaler,
+                        scaler = None if scaler is None else \
+                                 dict(mean = scaler.mean_.tolist(), scale = scaler.scale_.tolist()),
+                        centroids = None if centroids is None else np.asarray(centroids).tolist(),
+                        kernel = {name: params[name] for name in KERNEL_PARAMS})
+        fname = self.model_file(app_id)
+        tmp = '{}.tmp'.format(fname)
+        with open(tmp, 'w') as f:
+            json.dump(artifact, f)
+        os.replace(tmp, fname)
+        log_info('Saved model revision {} of {} to {}'.format(artifact['revision'], artifact['app'], fname))
+
+    def check(self, artifact, FD, kernel_k):
+        ''' Reason an artifact cannot be loaded into the running program, if any '''
+        if artifact.get('format') != MODEL_FORMAT:
+            return 'unsupported format {}'.format(artifact.get('format'))
+        if artifact['features'] != FD.features:
+            return 'trained on features {}, the program computes {}'.format(artifact['features'], FD.features)
+        settings = (artifact['scale_method'], artifact['m_scale'], artifact['s_scale'])
+        if settings != (FD.scale_method, FD.m_scaler, FD.s_scaler):
+            return 'scaled with {}, the configuration sets {}'.format(
+                   settings, (FD.scale_method, FD.m_scaler, FD.s_scaler))
+        if artifact['k'] > kernel_k:
+            return '{} clusters, the program holds {}'.format(artifact['k'], kernel_k)
+        if not FD.auto_k and artifact['k'] != FD.k:
+            return '{} clusters, the configuration sets {}'.format(artifact['k'], FD.k)
+        kernel = artifact['kernel']
+        if any(name not in kernel for name in KERNEL_PARAMS) \
+           or len(kernel['norm_mult']) != len(FD.features) \
+           or len(kernel['train_set_params']) != 2 * len(FD.features):
+            return 'incomplete kernel parameters'
+        return None
+
+    def load(self, app_id, FD, kernel_k):
+        '''
+        An application's saved model, if it fits the running program (built for
+        kernel_k clusters). The detector's k, scaler and centroids are restored from it.
+        '''
+        try:
+            artifact = self._read(app_id)
+        except ValueError as e:
+            log_warn('Could not read the model of {}: {}'.format(self.app_names[app_id], e))
+            return None
+        if artifact is None:
+            log_info('No saved model for {}'.format(self.app_names[app_id]))
+            return None
+        error = self.check(artifact, FD, kernel_k)
+        if error is not None:
+            log_warn('Ignoring the saved model of {}: {}'.format(self.app_names[app_id], error))
+            return None
+        self.revisions[app_id] = artifact['revision']
+
+        FD.k = artifact['k']
+        FD.drop_features(artifact.get('dropped', []))
+        if artifact['scaler'] is not None:
+            FD.scaler = StandardScaler()
+            FD.scaler.mean_ = np.array(artifact['scaler']['mean'])
+            FD.scaler.scale_ = np.array(artifact['scaler']['scale'])
+            FD.scaler.var_ = FD.scaler.scale_ ** 2
+            FD.scaler.n_features_in_ = len(FD.features)
+        if artifact['centroids'] is not None:
+            FD.model = KMeans(n_clusters = FD.k)
+            FD.model.cluster_centers_ = np.array(artifact['centroids'])
+        return artifact
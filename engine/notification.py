@@ -19,31 +19,204 @@ END OF LICENSE STUB
 '''
 
 import ctypes as ct
+import os
+import time
+import numpy as np
+import pandas as pd
 
-class NoteLoad(ct.Union):
-    _fields_ =[("load_i", ct.c_int64),
-              ("load_d", ct.c_double)];
-
-class Notify(ct.Structure):
-    _fields_ =[("type", ct.c_int),
-                ("msg_size", ct.c_size_t),
-                ("msg", ct.c_char * 32),
-                ("load", NoteLoad)];
-
-def print_notification(cpu, data, size):
-    event = ct.cast(data, ct.POINTER(Notify)).contents
-
-    if event.type == 0:
-        print("Str Notification: ", event.msg)
-    elif event.type == 1:
-        print("Int Notification: ", event.msg, event.load.load_i)
-    elif event.type == 2:
-        print("Dou Notification: ", event.msg, event.load.load_d)
-    else:
-        print("??? Notification: ", event.msg)
-
-def open_notify_buffer(bpf):
-    bpf['notification_evt'].open_perf_buffer(print_notification)
-
-def poll_notification(bpf):
-    bpf.perf_buffer_poll()
+from logger import *
+from .harvest import ctypes_dtype, split_keys
+
+# Must match struct fl_event in the eBPF program
+EVT_REQ_DONE = 1
+EVT_OUTLIER = 2
+
+class FLEvent(ct.Structure):
+    _fields_ = [("req_id", ct.c_uint64),
+                ("ts", ct.c_uint64),
+                ("cputime", ct.c_uint64),
+                ("score", ct.c_int64),
+                ("type", ct.c_uint32),
+                ("is_outlier", ct.c_uint32),
+                ("saddr", ct.c_uint32),
+                ("pad", ct.c_uint32)]
+
+EVENT_SIZE = ct.sizeof(FLEvent)
+EVENT_DTYPE = ctypes_dtype(FLEvent)
+
+DEFAULT_PAGES = 64
+
+def ringbuf_supported():
+    ''' BPF ring buffers appeared in Linux 5.8 '''
+    try:
+        from bcc import BPF
+    except ImportError:
+        return False
+    if not hasattr(BPF, 'ring_buffer_poll'):
+        return False
+    release = os.uname().release.split('-')[0].split('.')
+    try:
+        major, minor = int(release[0]), int(release[1])
+    except (IndexError, ValueError):
+        return False
+    return (major, minor) >= (5, 8)
+
+def perf_reader_fd(reader):
+    ''' File descriptor of one of bcc's per-CPU perf readers '''
+    from bcc.libbcc import lib
+    return lib.perf_reader_fd(reader)
+
+def events_config(cfg):
+    ''' Resolve the 'events' configuration object, picking a buffer type if asked to '''
+    if cfg is None:
+        return None
+    events = dict(cfg)
+    events.setdefault('pages', DEFAULT_PAGES)
+    events.setdefault('sinks', ['log'])
+    buffer = events.get('buffer', 'auto')
+    if buffer == 'auto':
+        buffer = 'ringbuf' if ringbuf_supported() else 'perf'
+    events['buffer'] = buffer
+    log_info('Using a %s buffer for events', buffer)
+    return events
+
+'''
+Event sinks are callables receiving a batch of events as a NumPy array of EVENT_DTYPE
+'''
+class LogEventSink():
+    def __init__(self, outdir, run_label):
+        pass
+
+    def __call__(self, events):
+        outliers = events[events['type'] == EVT_OUTLIER]
+        apps, rids = split_keys(outliers['req_id'])
+        for app, rid, evt in zip(apps, rids, outliers):
+            log_info('Request %d of application %d flagged as outlier (score %d, cputime %d)',
+                     rid, app, evt['score'], evt['cputime'])
+
+class CsvEventSink():
+    def __init__(self, outdir, run_label):
+        self.fname = os.path.join(outdir, 'events_{}.csv'.format(run_label))
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def __call__(self, events):
+        df = pd.DataFrame(events).drop(columns='pad')
+        apps, rids = split_keys(events['req_id'])
+        df.insert(0, 'app', apps)
+        df['req_id'] = rids
+        df.to_csv(self.fname, mode='a', index=False, header=not os.path.exists(self.fname))
+
+EVENT_SINKS = {
+    'log': LogEventSink,
+    'csv': CsvEventSink,
+}
+
+class EventChannel():
+    '''
+    Receives fixed-size records from the eBPF program, fl_event ones by default. The
+    per-record callbacks only copy raw bytes; records are decoded and dispatched to the
+    sinks once per poll. table names the buffer, dtype the records it carries, and drops
+    the per-CPU counter of records the program could not push.
+    '''
+    def __init__(self, bpf, buffer, pages=DEFAULT_PAGES, table='fl_events', dtype=EVENT_DTYPE,
+                 drops='event_drops'):
+        self.bpf = bpf
+        self.buffer = buffer
+        self.pages = pages
+        self.table = table
+        self.dtype = dtype
+        self.record_size = dtype.itemsize
+        self.drops = drops
+        self.sinks = []
+        self.pending = bytearray()
+        self.n_events = 0
+        self.n_batches = 0
+        self.lost = 0
+        self.last_lag_ns = 0
+        self.max_lag_ns = 0
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def _on_perf_event(self, cpu, data, size):
+        self.pending += ct.string_at(data, self.record_size)
+
+    def _on_ringbuf_event(self, ctx, data, size):
+        self.pending += ct.string_at(data, self.record_size)
+        return 0
+
+    def _on_lost(self, lost):
+        self.lost += lost
+
+    def open(self):
+        table = self.bpf[self.table]
+        if self.buffer == 'ringbuf':
+            table.open_ring_buffer(self._on_ringbuf_event)
+        else:
+            table.open_perf_buffer(self._on_perf_event, page_cnt=self.pages, lost_cb=self._on_lost)
+
+    def fds(self):
+        ''' File descriptors that become readable when records are waiting '''
+        table = self.bpf[self.table]
+        if self.buffer == 'ringbuf':
+            return [table.map_fd]
+        # perf_buffers maps (id(table), cpu) to the reader of that CPU's buffer
+        return [perf_reader_fd(reader) for (table_id, cpu), reader in self.bpf.perf_buffers.items()
+                if table_id == id(table)]
+
+    def consume(self):
+        ''' Copy the records waiting in the buffer, without blocking '''
+        if self.buffer == 'ringbuf':
+            self.bpf.ring_buffer_consume()
+        else:
+            self.bpf.perf_buffer_consume()
+
+    def poll(self, timeout_ms=1000):
+        ''' Wait up to timeout_ms for events, then dispatch everything received '''
+        if self.buffer == 'ringbuf':
+            self.bpf.ring_buffer_poll(timeout_ms)
+        else:
+            self.bpf.perf_buffer_poll(timeout_ms)
+        return self.flush()
+
+    def take(self):
+        ''' Records received so far, as raw bytes to hand to dispatch '''
+        batch = bytes(self.pending)
+        self.pending = bytearray()
+        return batch
+
+    def decode(self, batch):
+        return np.frombuffer(batch, dtype=self.dtype)
+
+    def dispatch(self, batch):
+        ''' Decode a batch of records and hand them to the sinks '''
+        if not batch:
+            return 0
+        events = self.decode(batch)
+
+        # Consumer lag: time between the probe emitting a record and its dispatch
+        lag = time.monotonic_ns() - events['ts'].astype(np.int64)
+        self.last_lag_ns = int(lag.max())
+        self.max_lag_ns = max(self.max_lag_ns, self.last_lag_ns)
+        self.n_events += len(events)
+        self.n_batches += 1
+
+        for sink in self.sinks:
+            sink(events)
+        return len(events)
+
+    def flush(self):
+        return self.dispatch(self.take())
+
+    def kernel_drops(self):
+        ''' Records the eBPF program could not push because the buffer was full '''
+        return int(self.bpf[self.drops].sum(0).value)
+
+    def stats(self):
+        return dict(events = self.n_events,
+                    batches = self.n_batches,
+                    lost = self.lost,
+                    kernel_drops = self.kernel_drops(),
+                    last_lag_ms = self.last_lag_ns / 1e6,
+                    max_lag_ms = self.max_lag_ns / 1e6)
@@ -0,0 +1,192 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import glob
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+
+from logger import *
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+'''
+Output writers for the tables the agent produces (train, test, data, scores).
+Columnar writers buffer rows and write them out as rotated, append-only chunk
+files in a [name]_[label]/ directory; each chunk is written to a temporary file
+and renamed, so a crash never leaves a partial chunk behind. The CSV writer keeps
+the historical single [name]_[label].csv file.
+'''
+
+DEFAULT_CHUNK_ROWS = 1 << 20
+
+class OutputWriter():
+    ext = None
+
+    def __init__(self, outdir, name, run_label, chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.name = name
+        self.chunk_rows = chunk_rows
+        self.path = os.path.join(outdir, '{}_{}'.format(name, run_label))
+        self.pending = list()
+        self.n_pending = 0
+        self.n_chunks = 0
+        self.n_rows = 0
+        # Start from a clean slate, whatever format a previous run with this label used
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        if os.path.exists(self.path + '.csv'):
+            os.remove(self.path + '.csv')
+
+    def write(self, df):
+        if df.empty:
+            return
+        self.pending.append(df)
+        self.n_pending += len(df)
+        if self.n_pending >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        ''' Write out buffered rows as a new chunk '''
+        if not self.pending:
+            return
+        df = pd.concat(self.pending, ignore_index=True)
+        self.pending = list()
+        self.n_pending = 0
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fname = os.path.join(self.path, 'chunk_{:06d}{}'.format(self.n_chunks, self.ext))
+        tmp_fname = fname + '.tmp'
+        write_start = time.time()
+        self._write_chunk(df, tmp_fname)
+        os.rename(tmp_fname, fname)
+        self.n_chunks += 1
+        self.n_rows += len(df)
+        log_info('Wrote %d %s rows to %s (%.1f KB) in %.3f seconds', len(df), self.name, fname,
+                 os.path.getsize(fname) / 1024, time.time() - write_start)
+
+    def close(self):
+        self.flush()
+
+class ParquetWriter(OutputWriter):
+    ext = '.parquet'
+
+    def _write_chunk(self, df, fname):
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), fname)
+
+class NpyWriter(OutputWriter):
+    ''' Chunks are NumPy structured arrays, loadable with np.load(mmap_mode='r') '''
+    ext = '.npy'
+
+    def _write_chunk(self, df, fname):
+        with open(fname, 'wb') as f:
+            np.save(f, df.to_records(index=False))
+
+class CsvWriter(OutputWriter):
+    ext = '.csv'
+
+    def __init__(self, outdir, name, run_label, chunk_rows=DEFAULT_CHUNK_ROWS):
+        OutputWriter.__init__(self, outdir, name, run_label, chunk_rows)
+        self.path += self.ext
+
+    def flush(self):
+        if not self.pending:
+            return
+        df = pd.concat(self.pending, ignore_index=True)
+        self.pending = list()
+        self.n_pending = 0
+        write_start = time.time()
+        df.to_csv(self.path, mode='a', index=False, header=not os.path.exists(self.path))
+        self.n_chunks += 1
+        self.n_rows += len(df)
+        log_info('Appended %d %s rows to %s in %.3f seconds', len(df), self.name, self.path,
+                 time.time() - write_start)
+
+OUTPUT_WRITERS = {
+    'parquet': ParquetWriter,
+    'npy': NpyWriter,
+    'csv': CsvWriter,
+}
+
+def output_format(fmt):
+    if fmt == 'auto':
+        return 'parquet' if pa is not None else 'npy'
+    if fmt == 'parquet' and pa is None:
+        log_warn('pyarrow is not available, writing NumPy chunks instead of Parquet')
+        return 'npy'
+    if fmt not in OUTPUT_WRITERS:
+        raise Exception('Unknown output format: %s' % fmt)
+    return fmt
+
+def read_output(outdir, name, run_label):
+    ''' Load a table written by any of the writers back into a DataFrame '''
+    path = os.path.join(outdir, '{}_{}'.format(name, run_label))
+    if os.path.exists(path + '.csv'):
+        return pd.read_csv(path + '.csv')
+
+    frames = list()
+    for fname in sorted(glob.glob(os.path.join(path, 'chunk_*'))):
+        if fname.endswith('.parquet'):
+            frames.append(pd.read_parquet(fname))
+        elif fname.endswith('.npy'):
+            frames.append(pd.DataFrame(np.load(fname)))
+    if not frames:
+        raise FileNotFoundError('No {} output for run {} in {}'.format(name, run_label, outdir))
+    return pd.concat(frames, ignore_index=True)
+
+class Outputs():
+    ''' One writer per table, created on first use '''
+
+    DEFAULT_CHECKPOINT_INTERVAL = 30
+
+    def __init__(self, outdir, run_label, format='csv', chunk_rows=DEFAULT_CHUNK_ROWS,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.outdir = outdir
+        self.run_label = run_label
+        self.format = output_format(format)
+        self.chunk_rows = chunk_rows
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.time()
+        self.writers = dict()
+
+    def write(self, name, df):
+        if name not in self.writers:
+            self.writers[name] = OUTPUT_WRITERS[self.format](self.outdir, name, self.run_label,
+                                                              self.chunk_rows)
+        self.writers[name].write(df)
+
+    def checkpoint_due(self):
+        return time.time() - self.last_checkpoint >= self.checkpoint_interval
+
+    def checkpoint(self):
+        ''' Write out everything buffered so far '''
+        self.last_checkpoint = time.time()
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
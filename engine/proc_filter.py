@@ -0,0 +1,142 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import os
+import time
+
+from logger import *
+from .metrics import METRICS
+
+DEFAULT_SLOTS = 32
+DEFAULT_INTERVAL = 1
+
+DELETED_SUFFIX = ' (deleted)'
+
+def proc_filter_config(cfg):
+    ''' Resolve the 'proc_filter' configuration object '''
+    if cfg is None:
+        return None
+    proc_filter = dict(cfg)
+    proc_filter.setdefault('slots', DEFAULT_SLOTS)
+    proc_filter.setdefault('interval', DEFAULT_INTERVAL)
+    if proc_filter['slots'] < 1:
+        raise Exception('proc_filter slots must be at least 1, not {}'.format(proc_filter['slots']))
+    return proc_filter
+
+class ProcessFilter():
+    '''
+    Keeps the process filter of the system-wide probes up to date. The processes of an
+    application are those running its exec_path, or, if it sets a cgroup (a directory of
+    the cgroup filesystem), those in that cgroup or below it, e.g. for applications whose
+    exec_path is a library. Every interval seconds, their thread group ids are resolved
+    from /proc (or cgroup.procs) and, if they changed, published into the proc_filter
+    map. More processes than slots turn the filter off until they fit again. Events of a
+    process started since the last update are not accounted until the next one.
+    '''
+
+    def __init__(self, bm, applications, app_names, slots=DEFAULT_SLOTS, interval=DEFAULT_INTERVAL,
+                 proc='/proc'):
+        self.BM = bm
+        self.app_names = app_names
+        self.slots = slots
+        self.interval = interval
+        self.proc = proc
+        # Applications by the real path of their executable
+        self.exec_paths = dict()
+        for app, name in zip(applications, app_names):
+            if 'cgroup' not in app:
+                self.exec_paths.setdefault(os.path.realpath(app['exec_path']), list()).append(name)
+        self.cgroups = {app['cgroup']: name for app, name in zip(applications, app_names) if 'cgroup' in app}
+
+        self.tgids = None
+        self.overflow = False
+        self.stats = dict(updates = 0, publications = 0, last_resolve_duration = 0.)
+
+    def _exec_tgids(self):
+        ''' Processes running one of the exec_paths, by application '''
+        tgids = {name: set() for names in self.exec_paths.values() for name in names}
+        if not self.exec_paths:
+            return tgids
+        for entry in os.listdir(self.proc):
+            if not entry.isdigit():
+                continue
+            try:
+                exe = os.readlink(os.path.join(self.proc, entry, 'exe'))
+            except OSError:
+                # Kernel threads, exited processes, or no permission
+                continue
+            if exe.endswith(DELETED_SUFFIX):
+                # The binary was replaced while the process kept running
+                exe = exe[:-len(DELETED_SUFFIX)]
+            for name in self.exec_paths.get(exe, ()):
+                tgids[name].add(int(entry))
+        return tgids
+
+    def _cgroup_tgids(self):
+        ''' Processes in each cgroup and its descendants, by application '''
+        tgids = {name: set() for name in self.cgroups.values()}
+        for path, name in self.cgroups.items():
+            if not os.path.isdir(path):
+                log_warn('cgroup {} of {} does not exist'.format(path, name))
+                continue
+            for dirpath, _, filenames in os.walk(path):
+                if 'cgroup.procs' not in filenames:
+                    continue
+                try:
+                    with open(os.path.join(dirpath, 'cgroup.procs')) as f:
+                        tgids[name].update(int(line) for line in f if line.strip())
+                except OSError:
+                    # Removed while walking
+                    continue
+        return tgids
+
+    def resolve(self):
+        ''' Thread group ids of every application's processes '''
+        resolve_start = time.time()
+        tgids = self._exec_tgids()
+        tgids.update(self._cgroup_tgids())
+        self.stats['last_resolve_duration'] = time.time() - resolve_start
+        return tgids
+
+    def update(self):
+        ''' Resolve the processes again, and publish them if they changed '''
+        by_app = self.resolve()
+        self.stats['updates'] += 1
+        for name, app_tgids in by_app.items():
+            METRICS.set('finelame_filter_processes', len(app_tgids), app=name)
+        tgids = sorted(set().union(*by_app.values()))
+        if tgids == self.tgids:
+            return
+        if self.tgids is not None:
+            log_info('Process filter: {} processes added, {} gone'.format(
+                     len(set(tgids) - set(self.tgids)), len(set(self.tgids) - set(tgids))))
+        else:
+            log_info('Process filter: {}'.format(', '.join('{} {}'.format(name, sorted(app_tgids))
+                                                           for name, app_tgids in by_app.items())))
+        overflow = len(tgids) > self.slots
+        if overflow and not self.overflow:
+            log_warn('{} processes to track, more than the {} slots of the filter: filtering is off'.format(
+                     len(tgids), self.slots))
+        elif not overflow and self.overflow:
+            log_info('Tracked processes fit in the filter again')
+        self.overflow = overflow
+        self.BM.set_proc_filter(tgids, self.slots)
+        self.tgids = tgids
+        self.stats['publications'] += 1
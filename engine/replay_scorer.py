@@ -0,0 +1,255 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Offline replay of the in-kernel scoring over the files an agent run leaves behind.
+
+Usage (from the repository root):
+    python3 -m engine.replay_scorer --out nodejs test
+    python3 -m engine.replay_scorer --out nodejs test --scale-method bitshift --m-scale 20 --s-scale 10
+    python3 -m engine.replay_scorer --out multi test --app node
+
+The kernel accumulates truncated per-event deltas while the replay normalizes each
+request's totals, so distances can differ by a few units per resource event;
+--tolerance sets how much difference is still counted as a match.
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+import yaml
+import numpy as np
+import pandas as pd
+
+from logger import *
+from .fixed_point import scale_factors, norm_factors, reciprocals, kernel_normalize, kernel_decide
+from .output import read_output
+from .ebpf_rewriter import app_names
+
+class ReplayModel():
+    '''
+    A kernel model, kept in floating point (standardized units) so it can be
+    re-quantized with other scale settings.
+    '''
+    def __init__(self, features, mean, std, centroid_l1s, thresholds,
+                 scale_method='exponent', m_scaler=10, s_scaler=6):
+        self.features = list(features)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.centroid_l1s = np.asarray(centroid_l1s, dtype=np.float64)
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.set_scale(scale_method, m_scaler, s_scaler)
+
+    def set_scale(self, scale_method, m_scaler, s_scaler):
+        self.scale_method = scale_method
+        self.m_scaler = m_scaler
+        self.s_scaler = s_scaler
+        self.m_scale, self.s_scale = scale_factors(scale_method, m_scaler, s_scaler)
+        self.c_scale = self.m_scale / self.s_scale
+        # Exact centroid_offset and normalization multipliers of the run, when recorded
+        # (and the scale is unchanged)
+        self.recorded_offset = None
+        self.recorded_norm = None
+
+    @classmethod
+    def from_output(cls, outdir, label, scale_method='exponent', m_scaler=10, s_scaler=6):
+        ''' Rebuild the model from normalization_*.csv and clusters_*.csv '''
+        m_scale, s_scale = scale_factors(scale_method, m_scaler, s_scaler)
+        c_scale = m_scale / s_scale
+        norm = pd.read_csv(os.path.join(outdir, 'normalization_{}.csv'.format(label)))
+        clusters = pd.read_csv(os.path.join(outdir, 'clusters_{}.csv'.format(label)))
+        model = cls(norm.feature,
+                    norm['mean'].to_numpy() / m_scale,
+                    norm['std'].to_numpy() / s_scale,
+                    clusters.l1.to_numpy() / c_scale,
+                    clusters.threshold.to_numpy() / c_scale,
+                    scale_method, m_scaler, s_scaler)
+        if 'mult' in norm:
+            model.recorded_norm = (norm['mult'].to_numpy(dtype=np.uint64),
+                                   norm['shift'].to_numpy(dtype=np.uint64))
+
+        fname = os.path.join(outdir, 'model_params_{}.csv'.format(label))
+        if os.path.exists(fname):
+            with open(fname) as f:
+                for line in f:
+                    if line.startswith('centroid_offset '):
+                        model.recorded_offset = int(line.split()[1])
+        return model
+
+    @classmethod
+    def from_params(cls, features, params, scale_method='exponent', m_scaler=10, s_scaler=6):
+        ''' Rebuild the model from kernel parameters, as kernel_params returns them '''
+        m_scale, s_scale = scale_factors(scale_method, m_scaler, s_scaler)
+        c_scale = m_scale / s_scale
+        train_set_params = np.asarray(params['train_set_params'], dtype=np.float64)
+        model = cls(features,
+                    train_set_params[0::2] / m_scale,
+                    train_set_params[1::2] / s_scale,
+                    np.asarray(params['centroid_l1s'], dtype=np.float64) / c_scale,
+                    np.asarray(params['cluster_thresholds'], dtype=np.float64) / c_scale,
+                    scale_method, m_scaler, s_scaler)
+        model.recorded_norm = (np.asarray(params['norm_mult'], dtype=np.uint64),
+                               np.asarray(params['norm_shift'], dtype=np.uint64))
+        model.recorded_offset = int(params['centroid_offset'])
+        return model
+
+    @classmethod
+    def from_artifact(cls, fname):
+        ''' Rebuild the model from a saved model artifact (see engine/model_store) '''
+        with open(fname) as f:
+            artifact = json.load(f)
+        return cls.from_params(artifact['features'], artifact['kernel'], artifact['scale_method'],
+                               artifact['m_scale'], artifact['s_scale'])
+
+    def fixed_point(self):
+        ''' Integer parameters, as _train_and_share_model would share them '''
+        if self.recorded_norm is not None:
+            mult, shift = self.recorded_norm
+        else:
+            mult, shift = reciprocals(norm_factors(self.std, self.m_scale, self.s_scale))
+        return dict(mean = (self.mean * self.m_scale).astype(np.int64),
+                    std = (self.std * self.s_scale).astype(np.int64),
+                    mult = mult,
+                    shift = shift,
+                    centroid_l1s = (self.centroid_l1s * self.c_scale).astype(np.int64),
+                    thresholds = (self.thresholds * self.c_scale).astype(np.int64),
+                    centroid_offset = self.recorded_offset if self.recorded_offset is not None
+                                      else int(np.sum(self.mean / self.std) * self.c_scale))
+
+    def score(self, data):
+        '''
+        Score every request of a DataFrame holding the model's feature columns.
+        Returns a DataFrame with the per-cluster distances, the closest one and the decision.
+        '''
+        params = self.fixed_point()
+        X = data[self.features].to_numpy(dtype=np.int64)
+        normalized = kernel_normalize(X, params['mult'], params['shift']).sum(axis=1)
+        distances = normalized[:, None] - params['centroid_l1s'][None, :] - params['centroid_offset']
+        min_dist, is_outlier = kernel_decide(distances, params['thresholds'])
+
+        columns = dict()
+        if 'app' in data:
+            columns['app'] = data.app.to_numpy()
+        columns.update(req_id = data.req_id.to_numpy(),
+                       score = min_dist,
+                       is_outlier = is_outlier.astype(np.uint8))
+        for i in range(distances.shape[1]):
+            columns['score_%d' % i] = distances[:, i]
+        return pd.DataFrame(columns)
+
+def compare_scores(replayed, recorded, tolerance=0):
+    ''' Join replayed and recorded scores on (app,) req_id and report disagreements '''
+    on = [c for c in ('app', 'req_id') if c in replayed and c in recorded]
+    merged = replayed.merge(recorded, on=on, suffixes=('', '_kernel'))
+    k = len([c for c in replayed.columns if c.startswith('score_')])
+    diffs = np.abs(np.stack([merged['score_%d' % i] - merged['score_%d_kernel' % i]
+                             for i in range(k)], axis=1))
+    max_diff = diffs.max(axis=1) if len(merged) else np.zeros(0)
+    merged['max_diff'] = max_diff
+    mismatch = (max_diff > tolerance) | (merged.is_outlier != merged.is_outlier_kernel)
+
+    report = dict(compared = len(merged),
+                  distance_mismatches = int((max_diff > tolerance).sum()),
+                  decision_mismatches = int((merged.is_outlier != merged.is_outlier_kernel).sum()),
+                  max_distance_diff = int(max_diff.max()) if len(merged) else 0)
+    return report, merged[mismatch]
+
+def _load_cfg(outdir, label):
+    ''' The configuration copy the agent leaves behind, if any '''
+    fname = os.path.join(outdir, 'fl_cfg_{}.yml'.format(label))
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as f:
+        return yaml.safe_load(f)
+
+def _scale_from_cfg(cfg):
+    ''' Scale settings of the run '''
+    params = cfg.get('model_params', {})
+    return params.get('scale_method', 'exponent'), params.get('m_scale', 10), params.get('s_scale', 6)
+
+def _app_id_from_cfg(cfg, name):
+    names = app_names(cfg.get('applications', []))
+    if name not in names:
+        raise Exception('No application named {} in the run configuration'.format(name))
+    return names.index(name)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay in-kernel outlier scoring on recorded data')
+    parser.add_argument('run_label', help='label of the run to replay')
+    parser.add_argument('--out', default='.', help='Output directory of the run')
+    parser.add_argument('--data', default='test', help='Which datapoints to score (test or train)')
+    parser.add_argument('--scale-method', default=None, help='Re-quantize with this scale method')
+    parser.add_argument('--m-scale', default=None, type=int, help='Re-quantize with this m_scale')
+    parser.add_argument('--s-scale', default=None, type=int, help='Re-quantize with this s_scale')
+    parser.add_argument('--threshold-factor', default=None, type=float,
+                        help='Multiply every cluster threshold by this factor')
+    parser.add_argument('--tolerance', default=0, type=int, help='Allowed distance difference')
+    parser.add_argument('--app', default=None,
+                        help='Application to replay, for runs monitoring several applications')
+    args = parser.parse_args()
+
+    cfg = _load_cfg(args.out, args.run_label)
+    scale_method, m_scaler, s_scaler = _scale_from_cfg(cfg)
+    model_label = args.run_label
+    if args.app is not None:
+        model_label = '{}_{}'.format(args.run_label, args.app)
+    model = ReplayModel.from_output(args.out, model_label, scale_method, m_scaler, s_scaler)
+    rescaled = args.scale_method or args.m_scale is not None or args.s_scale is not None
+    requantized = rescaled or args.threshold_factor is not None
+    if args.threshold_factor is not None:
+        model.thresholds *= args.threshold_factor
+    if rescaled:
+        model.set_scale(args.scale_method or scale_method,
+                        args.m_scale if args.m_scale is not None else m_scaler,
+                        args.s_scale if args.s_scale is not None else s_scaler)
+
+    data = read_output(args.out, args.data, args.run_label)
+    app_id = None
+    if args.app is not None:
+        app_id = _app_id_from_cfg(cfg, args.app)
+        data = data[data.app == app_id]
+    replay_start = time.time()
+    replayed = model.score(data)
+    elapsed = time.time() - replay_start
+    log_info('Replayed %d requests in %.3f seconds (%.0f rows/s), %d outliers',
+             len(replayed), elapsed, len(replayed) / elapsed if elapsed > 0 else 0,
+             int(replayed.is_outlier.sum()))
+
+    fname = os.path.join(args.out, 'replay_{}_{}.csv'.format(args.data, model_label))
+    replayed.to_csv(fname, index=False)
+    log_info('Replayed scores written to {}'.format(fname))
+
+    if requantized or args.data != 'test':
+        sys.exit(0)
+    try:
+        recorded = read_output(args.out, 'scores', args.run_label)
+    except FileNotFoundError:
+        sys.exit(0)
+    if app_id is not None:
+        recorded = recorded[recorded.app == app_id]
+
+    report, mismatches = compare_scores(replayed, recorded, args.tolerance)
+    log_info('Comparison with kernel scores: {}'.format(report))
+    if not mismatches.empty:
+        fname = os.path.join(args.out, 'replay_mismatches_{}.csv'.format(model_label))
+        mismatches.to_csv(fname, index=False)
+        log_info('Mismatching requests written to {}'.format(fname))
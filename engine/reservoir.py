@@ -0,0 +1,69 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import numpy as np
+import pandas as pd
+
+class Reservoir():
+    '''
+    Fixed-size uniform sample of a stream of DataFrames (Algorithm R, applied one batch
+    at a time). Columns are kept as preallocated NumPy arrays, so memory stays bounded
+    by capacity whatever the number of rows seen.
+    '''
+    def __init__(self, capacity, seed=None):
+        self.capacity = int(capacity)
+        self.rng = np.random.default_rng(seed)
+        self.columns = None
+        self.n_seen = 0
+
+    def __len__(self):
+        return min(self.n_seen, self.capacity)
+
+    def add(self, df):
+        if df.empty:
+            return
+        if self.columns is None:
+            self.columns = {name: np.empty(self.capacity, dtype=df[name].dtype) for name in df.columns}
+
+        n = len(df)
+        # Rows that fit in the free slots are always kept
+        n_fill = max(0, min(n, self.capacity - self.n_seen))
+        for name, column in self.columns.items():
+            column[self.n_seen:self.n_seen + n_fill] = df[name].to_numpy()[:n_fill]
+
+        # Row i of the stream replaces a random slot with probability capacity / (i + 1).
+        # Assignments follow stream order, so a slot picked twice keeps the latest row.
+        if n_fill < n:
+            positions = np.arange(self.n_seen + n_fill, self.n_seen + n, dtype=np.int64)
+            slots = (self.rng.random(len(positions)) * (positions + 1)).astype(np.int64)
+            accepted = slots < self.capacity
+            rows = np.flatnonzero(accepted) + n_fill
+            for name, column in self.columns.items():
+                column[slots[accepted]] = df[name].to_numpy()[rows]
+        self.n_seen += n
+
+    def frame(self):
+        if self.columns is None:
+            return pd.DataFrame()
+        return pd.DataFrame({name: column[:len(self)] for name, column in self.columns.items()})
+
+    def clear(self):
+        self.columns = None
+        self.n_seen = 0
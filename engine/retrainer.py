@@ -0,0 +1,137 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import queue
+import time
+import numpy as np
+
+from logger import *
+from .metrics import METRICS
+
+#ML libs
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+
+class Retrainer():
+    '''
+    Periodically refreshes the model with drained datapoints. The agent's event loop
+    calls retrain every interval seconds, in a thread of its own.
+    Centroids are kept in raw feature space between rounds. Each round refits the
+    scaler on a sliding window of recent datapoints, warm-starts mini-batch k-means
+    from the previous centroids and runs it over the datapoints drained since the
+    last round. The result is published through publish(params), which is expected
+    to swap it into the kernel atomically.
+    '''
+
+    DEFAULT_INTERVAL = 3600
+    DEFAULT_WINDOW = 200000
+    DEFAULT_MIN_SAMPLES = 1000
+    DEFAULT_BATCH_SIZE = 4096
+
+    def __init__(self, detector, publish, interval=DEFAULT_INTERVAL, window=DEFAULT_WINDOW,
+                 min_samples=DEFAULT_MIN_SAMPLES, batch_size=DEFAULT_BATCH_SIZE):
+        self.FD = detector
+        self.publish = publish
+        self.interval = interval
+        self.window_size = window
+        self.min_samples = min_samples
+        self.batch_size = batch_size
+
+        self.queue = queue.Queue()
+        self.fresh = list()
+        self.window = None
+        self.centers = None
+        self.reference = None
+        self.params = None
+        self.stats = dict(retrains = 0,
+                          version = 0,
+                          last_retrain_duration = 0.,
+                          last_swap_latency = 0.)
+
+    def seed(self, x_train, scaler, centers):
+        ''' Start from the initial training set and the (standardized) KMeans centroids '''
+        self.window = x_train[-self.window_size:]
+        self.centers = scaler.inverse_transform(centers)
+
+    def submit(self, datapoints, scores):
+        ''' Queue drained datapoints, leaving out requests flagged as outliers '''
+        if datapoints.empty:
+            return
+        if not scores.empty:
+            outliers = scores.req_id[scores.is_outlier != 0]
+            datapoints = datapoints[~datapoints.req_id.isin(outliers)]
+        self.queue.put(datapoints[self.FD.features].to_numpy(dtype=np.float64))
+
+    def seeded(self):
+        return self.centers is not None
+
+    def _clean(self, X):
+        thresholds = np.percentile(X, self.FD.PCT_TRAIN_CLEAN, axis=0)
+        return X[np.all(X <= thresholds, axis=1)]
+
+    def retrain(self):
+        ''' Returns whether a new model was published '''
+        if not self.seeded():
+            return False
+        while True:
+            try:
+                self.fresh.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        n_fresh = sum(len(x) for x in self.fresh)
+        if n_fresh < self.min_samples:
+            log_info('Only {} new datapoints, deferring retraining'.format(n_fresh))
+            return False
+
+        retrain_start = time.time()
+        X_new = np.concatenate(self.fresh)
+        self.fresh = list()
+        window = np.concatenate([self.window, X_new])[-self.window_size:]
+        X_clean = self._clean(window)
+
+        scaler = StandardScaler().fit(X_clean)
+        kmeans = MiniBatchKMeans(n_clusters=len(self.centers), init=self.FD.mask_scaled(scaler.transform(self.centers)),
+                                 n_init=1, batch_size=self.batch_size)
+        # Features dropped from the model stay out of the clusters
+        X_new_scaled = self.FD.mask_scaled(scaler.transform(self._clean(X_new)))
+        for i in range(0, len(X_new_scaled), self.batch_size):
+            kmeans.partial_fit(X_new_scaled[i:i+self.batch_size])
+
+        X_scaled = self.FD.mask_scaled(scaler.transform(X_clean))
+        labels = kmeans.predict(X_scaled)
+        params = self.FD.kernel_params(scaler, X_scaled, labels, kmeans.cluster_centers_)
+        retrain_duration = time.time() - retrain_start
+        METRICS.observe('finelame_phase_duration_seconds', retrain_duration, phase='retrain')
+
+        version, swap_latency = self.publish(params)
+
+        self.window = window
+        # What the new model was fitted on: the reference distribution of drift detection
+        self.reference = (X_clean, labels)
+        self.params = params
+        self.centers = scaler.inverse_transform(kmeans.cluster_centers_)
+        self.FD.scaler = scaler
+        self.stats['retrains'] += 1
+        self.stats['version'] = version
+        self.stats['last_retrain_duration'] = retrain_duration
+        self.stats['last_swap_latency'] = swap_latency
+        log_info('Retrained model v{} on {} new datapoints in {:.2f} seconds, swapped in {:.3f} ms'.format(
+                 version, n_fresh, retrain_duration, swap_latency * 1e3))
+        return True
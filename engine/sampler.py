@@ -0,0 +1,114 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import os
+import time
+import pandas as pd
+
+from logger import *
+from .metrics import METRICS
+
+NS_PER_S = 1000 * 1000 * 1000
+
+class SamplingController():
+    '''
+    Keeps the CPU time spent in the eBPF probes under cpu_budget, a fraction of the
+    host's CPU time, by adjusting the share of new requests the mappers track.
+    Every interval seconds, the probes' run time since the last adjustment is read from
+    the kernel's per-program statistics. Probe cost is taken as proportional to the
+    sample rate: the overhead per unit of rate is smoothed over adjustments, and the
+    rate set to the budget divided by it. Rates are cut at once when over budget but
+    raised by at most max_step per adjustment, and kept within [min_rate, 1].
+    The same rate applies to all applications, since they share the probes.
+    '''
+
+    DEFAULT_INTERVAL = 5
+    DEFAULT_MIN_RATE = 0.01
+    DEFAULT_MAX_STEP = 2
+    DEFAULT_SMOOTHING = 0.5
+
+    def __init__(self, bm, n_apps, cpu_budget, interval=DEFAULT_INTERVAL,
+                 min_rate=DEFAULT_MIN_RATE, max_step=DEFAULT_MAX_STEP, smoothing=DEFAULT_SMOOTHING):
+        if not 0 < cpu_budget <= 1:
+            raise Exception('sampling cpu_budget must be in (0, 1], not {}'.format(cpu_budget))
+        self.BM = bm
+        self.n_apps = n_apps
+        self.cpu_budget = cpu_budget
+        self.interval = interval
+        self.min_rate = min_rate
+        self.max_step = max_step
+        self.smoothing = smoothing
+        self.n_cpus = os.cpu_count()
+
+        self.rate = 1.0
+        self.cost = None
+        self.last_ts = None
+        self.last_run_time = 0
+        self.history = list()
+
+    def _run_time_ns(self):
+        return sum(stats['run_time_ns'] for stats in self.BM.prog_stats().values())
+
+    def start(self):
+        ''' Track every request until the first measurement, and enable BPF statistics '''
+        for app in range(self.n_apps):
+            self.BM.set_sample_rate(self.rate, app)
+        METRICS.set('finelame_sample_rate', self.rate)
+        if not self.BM.enable_prog_stats():
+            log_warn('Sampling will not adapt without BPF statistics')
+        self.last_ts = time.monotonic()
+        self.last_run_time = self._run_time_ns()
+
+    def adjust(self):
+        ''' Measure the probes' overhead, update the sample rate and record the counts '''
+        now = time.monotonic()
+        run_time = self._run_time_ns()
+        overhead = (run_time - self.last_run_time) / ((now - self.last_ts) * NS_PER_S * self.n_cpus)
+        self.last_ts, self.last_run_time = now, run_time
+
+        # Overhead per unit of sample rate, smoothed over adjustments
+        previous = self.rate
+        cost = overhead / previous
+        if self.cost is None:
+            self.cost = cost
+        else:
+            self.cost = self.smoothing * cost + (1 - self.smoothing) * self.cost
+
+        target = self.cpu_budget / self.cost if self.cost > 0 else 1.0
+        self.rate = min(1.0, previous * self.max_step, max(self.min_rate, target))
+        if self.rate != previous:
+            for app in range(self.n_apps):
+                self.BM.set_sample_rate(self.rate, app)
+            METRICS.set('finelame_sample_rate', self.rate)
+
+        log_info('Probe overhead {:.3%} of CPU (budget {:.3%}), sample rate {:.3f} -> {:.3f}'.format(
+                 overhead, self.cpu_budget, previous, self.rate))
+        self.record(overhead)
+
+    def record(self, overhead=None):
+        ''' Append the cumulative seen and tracked request counts of every application '''
+        for app in range(self.n_apps):
+            seen, sampled = self.BM.get_sample_counts(app)
+            self.history.append(dict(ts = time.time(), app = app, rate = self.rate,
+                                     overhead = overhead, seen = seen, sampled = sampled))
+
+    def counts(self):
+        ''' Seen and tracked request counts over time, one row per application and adjustment '''
+        return pd.DataFrame(self.history, columns=['ts', 'app', 'rate', 'overhead', 'seen', 'sampled'])
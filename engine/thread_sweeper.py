@@ -0,0 +1,62 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+import os
+import time
+import numpy as np
+
+from logger import *
+from .metrics import METRICS
+
+THREAD_MAPS = ('tid_to_rid', 'start')
+
+class ThreadSweeper():
+    '''
+    Removes the tid_to_rid and start entries of threads that exited while mapped to a
+    request: mappers only delete them when a request is unmapped, so they otherwise
+    stay until the map is full. Every interval seconds, the thread ids of both maps are
+    read, and those with no /proc entry left are deleted. A thread id reused between the
+    check and the deletion loses its mapping, which only affects the request it serves.
+    '''
+
+    DEFAULT_INTERVAL = 10
+
+    def __init__(self, bm, interval=DEFAULT_INTERVAL, proc='/proc'):
+        self.BM = bm
+        self.interval = interval
+        self.proc = proc
+        self.n_removed = {name: 0 for name in THREAD_MAPS}
+
+    def _exited(self, tids):
+        return np.array([not os.path.exists(os.path.join(self.proc, str(int(tid)))) for tid in tids],
+                        dtype=bool)
+
+    def sweep(self):
+        sweep_start = time.time()
+        for name in THREAD_MAPS:
+            tids = self.BM.harvest_threads(name)
+            exited = self._exited(tids)
+            if not exited.any():
+                continue
+            n_removed = self.BM.delete_threads(name, tids[exited])
+            self.n_removed[name] += n_removed
+            METRICS.inc('finelame_map_stale_entries_total', n_removed, map=name)
+            log_debug('Removed {} of {} {} entries of exited threads'.format(n_removed, len(tids), name))
+        METRICS.observe('finelame_phase_duration_seconds', time.time() - sweep_start, phase='sweep')
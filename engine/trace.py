@@ -0,0 +1,126 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Raw probe traces. With the trace section, every resource event a probe accounts to a
+request, and every thread mapped to or unmapped from a request, is pushed as a
+struct fl_trace_rec and appended to trace_[label].fltr. The file is a 16-byte header
+(TRACE_MAGIC, format version, record size) followed by the records, in the order the
+agent received them; read_trace memory-maps it. See engine/trace_replay.
+'''
+
+import ctypes as ct
+import os
+import struct
+import numpy as np
+
+from logger import *
+from .harvest import ctypes_dtype
+from .notification import ringbuf_supported
+
+# Must match FL_TR_* in the eBPF program
+TR_CPU = 1
+TR_PGFAULT = 2
+TR_MALLOC = 3
+TR_TCP_SENT = 4
+TR_TCP_RCVD = 5
+TR_CACHE_MISS = 6
+TR_CACHE_REF = 7
+TR_MAP = 8
+TR_UNMAP = 9
+
+TRACE_TYPES = {TR_CPU: 'cpu', TR_PGFAULT: 'pgfault', TR_MALLOC: 'malloc', TR_TCP_SENT: 'tcp_sent',
+               TR_TCP_RCVD: 'tcp_rcvd', TR_CACHE_MISS: 'cache_miss', TR_CACHE_REF: 'cache_ref',
+               TR_MAP: 'map', TR_UNMAP: 'unmap'}
+
+# Datapoint field each resource record adds its value to
+TRACE_FIELDS = {TR_CPU: 'cputime', TR_PGFAULT: 'pgfaults', TR_MALLOC: 'mem_malloc',
+                TR_TCP_SENT: 'tcp_sent', TR_TCP_RCVD: 'tcp_rcvd', TR_CACHE_MISS: 'cache_misses',
+                TR_CACHE_REF: 'cache_refs'}
+
+class FLTraceRecord(ct.Structure):
+    _fields_ = [("ts", ct.c_uint64),
+                ("req_id", ct.c_uint64),
+                ("value", ct.c_uint64),
+                ("tid", ct.c_uint32),
+                ("type", ct.c_uint16),
+                ("cpu", ct.c_uint16)]
+
+TRACE_DTYPE = ctypes_dtype(FLTraceRecord)
+
+TRACE_MAGIC = b'FLTRACE\0'
+TRACE_FORMAT = 1
+HEADER = struct.Struct('<8sII')
+
+DEFAULT_PAGES = 1024
+
+def trace_config(cfg, outdir, run_label):
+    ''' Resolve the 'trace' configuration object '''
+    if cfg is None:
+        return None
+    trace = dict(cfg)
+    trace.setdefault('pages', DEFAULT_PAGES)
+    trace.setdefault('path', os.path.join(outdir, 'trace_{}.fltr'.format(run_label)))
+    buffer = trace.get('buffer', 'auto')
+    if buffer == 'auto':
+        buffer = 'ringbuf' if ringbuf_supported() else 'perf'
+    trace['buffer'] = buffer
+    log_info('Recording probe events to %s through a %s buffer', trace['path'], buffer)
+    return trace
+
+class TraceFileSink():
+    '''
+    Appends batches of trace records to a trace file, created (or truncated) with its
+    header when the sink is.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.n_records = 0
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.f = open(path, 'wb')
+        self.f.write(HEADER.pack(TRACE_MAGIC, TRACE_FORMAT, TRACE_DTYPE.itemsize))
+
+    def __call__(self, records):
+        self.f.write(records.tobytes())
+        self.n_records += len(records)
+
+    def close(self):
+        self.f.close()
+        log_info('Wrote {} trace records to {}'.format(self.n_records, self.path))
+
+def read_trace(path):
+    ''' The records of a trace file, as a read-only memory-mapped array of TRACE_DTYPE '''
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise Exception('{} is not a trace file'.format(path))
+    magic, version, record_size = HEADER.unpack(header)
+    if magic != TRACE_MAGIC:
+        raise Exception('{} is not a trace file'.format(path))
+    if version != TRACE_FORMAT or record_size != TRACE_DTYPE.itemsize:
+        raise Exception('{}: unsupported trace format {} ({} bytes records)'.format(
+                        path, version, record_size))
+    n_records = (os.path.getsize(path) - HEADER.size) // record_size
+    if n_records == 0:
+        return np.zeros(0, dtype=TRACE_DTYPE)
+    # A record cut short by a crash is left out
+    return np.memmap(path, dtype=TRACE_DTYPE, mode='r', offset=HEADER.size, shape=(n_records,))
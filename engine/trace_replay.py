@@ -0,0 +1,280 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+Offline replay of a probe trace (see engine/trace) through the per-request accounting
+and the update_outlier_score() logic of the eBPF program, so that features, k,
+thresholds and scale settings can be tried without rerunning the application.
+
+Usage (from the repository root):
+    python3 -m engine.trace_replay nodejs/trace_test.fltr --out nodejs --label test
+    python3 -m engine.trace_replay nodejs/trace_test.fltr --out nodejs --label test --threshold-factor 1.5
+    python3 -m engine.trace_replay trace.fltr --cfg fl_cfg.yml --model models/model_node.json
+    python3 -m engine.trace_replay trace.fltr --cfg fl_cfg.yml --features REQ_CPUTIME,REQ_TCP_RCVD --k 4 --train-until 60
+
+Every request is scored as if the model had been loaded before it started.
+'''
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from logger import *
+from .trace import read_trace, TRACE_FIELDS, TR_TCP_RCVD, TR_MAP, TR_UNMAP
+from .harvest import split_keys
+from .fixed_point import kernel_normalize, kernel_decide
+from .replay_scorer import ReplayModel, compare_scores, _load_cfg, _scale_from_cfg, _app_id_from_cfg
+from .output import read_output
+
+# Fields the replay accounts, in the order of their field index
+REPLAY_FIELDS = [TRACE_FIELDS[t] for t in sorted(TRACE_FIELDS)] + ['tcp_idle_time']
+IDLE_FIELD = len(REPLAY_FIELDS) - 1
+# Above a second of idle time, the program adds a fixed delta instead of the normalized one
+IDLE_TIME_CAP = 1000000000
+IDLE_TIME_DELTA = 1000000000000000
+
+DECIDE_CHUNK = 1 << 20
+
+def feature_fields(features, cfg=None):
+    ''' Datapoint field of each model feature: features are request_stats names '''
+    request_stats = (cfg or {}).get('request_stats', {})
+    return [request_stats[f]['datapoint'] if f in request_stats else f for f in features]
+
+def _updates(records, idle_time):
+    '''
+    The score updates the probes make, sorted per request as the program applies them:
+    (req_id, ts, field index, value). With idle_time, every tcp_rcvd record after the
+    first of its request is preceded by the idle time since the previous one.
+    '''
+    resource = np.isin(records['type'], list(TRACE_FIELDS))
+    res = records[resource]
+    field_of_type = np.zeros(max(TRACE_FIELDS) + 1, dtype=np.int64)
+    for t in TRACE_FIELDS:
+        field_of_type[t] = REPLAY_FIELDS.index(TRACE_FIELDS[t])
+
+    req_id = res['req_id']
+    ts = res['ts']
+    field = field_of_type[res['type']]
+    value = res['value'].astype(np.int64)
+    pos = np.arange(len(res))
+    prio = np.ones(len(res), dtype=np.int64)
+
+    if idle_time:
+        rcvd = np.flatnonzero(res['type'] == TR_TCP_RCVD)
+        rcvd = rcvd[np.lexsort((rcvd, ts[rcvd], req_id[rcvd]))]
+        same = req_id[rcvd[1:]] == req_id[rcvd[:-1]]
+        idle = ts[rcvd[1:]].astype(np.int64) - ts[rcvd[:-1]].astype(np.int64)
+        after = rcvd[1:][same & (idle > 0)]
+        idle = idle[same & (idle > 0)]
+        req_id = np.concatenate([req_id, req_id[after]])
+        ts = np.concatenate([ts, ts[after]])
+        field = np.concatenate([field, np.full(len(after), IDLE_FIELD)])
+        value = np.concatenate([value, idle])
+        pos = np.concatenate([pos, after])
+        prio = np.concatenate([prio, np.zeros(len(after), dtype=np.int64)])
+
+    order = np.lexsort((prio, pos, ts, req_id))
+    return req_id[order], ts[order], field[order], value[order]
+
+def _group_cumsum(values, starts, group):
+    ''' Cumulative sums restarting at every group start '''
+    total = np.cumsum(values)
+    return total - (total - values)[starts][group]
+
+def replay(records, model, fields, idle_time=None):
+    '''
+    Replay trace records through a ReplayModel whose features are computed from the
+    datapoint fields fields. idle_time tells whether the program tracks tcp idle time
+    (by default, when it is a feature).
+    Returns the per-request scores, as the program would have left them, and datapoints.
+    '''
+    if idle_time is None:
+        idle_time = 'tcp_idle_time' in fields
+    params = model.fixed_point()
+    mult = np.zeros(len(REPLAY_FIELDS), dtype=np.uint64)
+    shift = np.zeros(len(REPLAY_FIELDS), dtype=np.uint64)
+    for i, field in enumerate(fields):
+        mult[REPLAY_FIELDS.index(field)] = params['mult'][i]
+        shift[REPLAY_FIELDS.index(field)] = params['shift'][i]
+
+    req_id, ts, field, value = _updates(records, idle_time)
+    delta = kernel_normalize(value, mult[field], shift[field])
+    if idle_time:
+        delta[(field == IDLE_FIELD) & (value > IDLE_TIME_CAP)] = IDLE_TIME_DELTA
+
+    starts = np.ones(len(req_id), dtype=bool)
+    starts[1:] = req_id[1:] != req_id[:-1]
+    group = np.cumsum(starts) - 1
+    ends = np.append(np.flatnonzero(starts)[1:] - 1, len(req_id) - 1) if len(req_id) else np.zeros(0, dtype=int)
+    totals = _group_cumsum(delta, starts, group)
+    cputime = _group_cumsum(np.where(field == REPLAY_FIELDS.index('cputime'), value, 0), starts, group)
+
+    # Decide after every update, as update_outlier_score() does
+    is_outlier = np.zeros(len(req_id), dtype=bool)
+    for begin in range(0, len(req_id), DECIDE_CHUNK):
+        chunk = totals[begin:begin + DECIDE_CHUNK]
+        distances = chunk[:, None] - params['centroid_l1s'][None, :] - params['centroid_offset']
+        is_outlier[begin:begin + DECIDE_CHUNK] = kernel_decide(distances, params['thresholds'])[1]
+
+    distances = totals[ends][:, None] - params['centroid_l1s'][None, :] - params['centroid_offset']
+    min_dist, _ = kernel_decide(distances, params['thresholds'])
+    detected = np.flatnonzero(is_outlier)
+    detected_groups, first = np.unique(group[detected], return_index=True)
+    detection_ts = np.zeros(len(ends), dtype=np.uint64)
+    detection_ts[detected_groups] = ts[detected[first]]
+    detection_cputime = np.zeros(len(ends), dtype=np.int64)
+    detection_cputime[detected_groups] = cputime[detected[first]]
+
+    apps, rids = split_keys(req_id[ends])
+    columns = dict(app = apps,
+                   req_id = rids,
+                   score = min_dist,
+                   is_outlier = is_outlier[ends].astype(np.uint8))
+    for i in range(distances.shape[1]):
+        columns['score_%d' % i] = distances[:, i]
+    columns.update(detection_ts = detection_ts,
+                   detection_cputime = detection_cputime,
+                   updates = np.diff(np.append(np.flatnonzero(starts), len(req_id))))
+    scores = pd.DataFrame(columns)
+    return scores, datapoints(records, req_id, field, value)
+
+def datapoints(records, req_id, field, value):
+    ''' Per-request totals of every replayed field, with the mapping timestamps '''
+    updates = pd.DataFrame(dict(key = req_id, field = field, value = value))
+    dps = updates.groupby(['key', 'field']).value.sum().unstack(fill_value=0)
+    dps.columns = [REPLAY_FIELDS[f] for f in dps.columns]
+
+    maps = records[np.isin(records['type'], [TR_MAP, TR_UNMAP])]
+    mapping = pd.DataFrame(dict(key = maps['req_id'], ts = maps['ts'], type = maps['type']))
+    dps['first_ts'] = mapping[mapping.type == TR_MAP].groupby('key').ts.min()
+    dps['last_unmap_ts'] = mapping[mapping.type == TR_UNMAP].groupby('key').ts.max()
+    dps = dps.fillna(0).astype(np.uint64).reset_index()
+    apps, rids = split_keys(dps.key.to_numpy(dtype=np.uint64))
+    dps.insert(0, 'app', apps)
+    dps.insert(1, 'req_id', rids)
+    return dps.drop(columns='key')
+
+def fit_model(dps, features, fields, model_params):
+    ''' Train a model on trace datapoints, as the agent would have at the end of training '''
+    from .finelame import FinelameDetector
+    FD = FinelameDetector(dict(model_params, features = features))
+    train = dps[fields].copy()
+    train.columns = features
+    FD.set_train_data(train)
+    params = FD.fit()
+    return ReplayModel.from_params(features, params, FD.scale_method, FD.m_scaler, FD.s_scaler)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a probe trace through the in-kernel scoring')
+    parser.add_argument('trace_file', help='trace file recorded by the agent')
+    parser.add_argument('--out', default='.', help='Output directory of the run, and of the replay')
+    parser.add_argument('--label', default=None, help='Label of the run, to use its configuration and model')
+    parser.add_argument('--cfg', default=None, help='Configuration of the run, if not left in the output directory')
+    parser.add_argument('--model', default=None, help='Saved model (model_[app].json) to replay with')
+    parser.add_argument('--app', default=None,
+                        help='Application to replay, for runs monitoring several applications')
+    parser.add_argument('--features', default=None, help='Comma-separated features of a model to train')
+    parser.add_argument('--k', default=None, type=int, help='Clusters of a model to train')
+    parser.add_argument('--train-until', default=None, type=float,
+                        help='Train a model on the requests of the first seconds of the trace')
+    parser.add_argument('--scale-method', default=None, help='Re-quantize with this scale method')
+    parser.add_argument('--m-scale', default=None, type=int, help='Re-quantize with this m_scale')
+    parser.add_argument('--s-scale', default=None, type=int, help='Re-quantize with this s_scale')
+    parser.add_argument('--threshold-factor', default=None, type=float,
+                        help='Multiply every cluster threshold by this factor')
+    parser.add_argument('--tolerance', default=0, type=int, help='Allowed distance difference')
+    args = parser.parse_args()
+
+    cfg = dict()
+    if args.cfg is not None:
+        import yaml
+        with open(args.cfg) as f:
+            cfg = yaml.safe_load(f)
+    elif args.label is not None:
+        cfg = _load_cfg(args.out, args.label)
+    scale_method, m_scaler, s_scaler = _scale_from_cfg(cfg)
+    label = args.label or os.path.splitext(os.path.basename(args.trace_file))[0]
+    model_label = label if args.app is None else '{}_{}'.format(label, args.app)
+
+    records = read_trace(args.trace_file)
+    log_info('Read %d records from %s', len(records), args.trace_file)
+    app_id = None
+    if args.app is not None:
+        app_id = _app_id_from_cfg(cfg, args.app)
+        records = records[split_keys(records['req_id'])[0] == app_id]
+    idle_time = any(stat['datapoint'] == 'tcp_idle_time' for stat in cfg.get('request_stats', {}).values()) \
+                if 'request_stats' in cfg else None
+
+    fitted = args.train_until is not None
+    if fitted:
+        model_params = dict(cfg.get('model_params', {}))
+        if args.k is not None:
+            model_params['k'] = args.k
+        features = args.features.split(',') if args.features else model_params['features']
+        fields = feature_fields(features, cfg)
+        start_ts = int(records['ts'].min())
+        train_records = records[records['ts'] < start_ts + int(args.train_until * 1e9)]
+        req_id, _, field, value = _updates(train_records, 'tcp_idle_time' in fields if idle_time is None
+                                                          else idle_time)
+        train_dps = datapoints(train_records, req_id, field, value)
+        log_info('Training on the %d requests of the first %.1f seconds', len(train_dps), args.train_until)
+        model = fit_model(train_dps, features, fields, model_params)
+    elif args.model is not None:
+        model = ReplayModel.from_artifact(args.model)
+    else:
+        model = ReplayModel.from_output(args.out, model_label, scale_method, m_scaler, s_scaler)
+    fields = feature_fields(model.features, cfg)
+
+    rescaled = args.scale_method or args.m_scale is not None or args.s_scale is not None
+    requantized = rescaled or args.threshold_factor is not None
+    if args.threshold_factor is not None:
+        model.thresholds *= args.threshold_factor
+    if rescaled:
+        model.set_scale(args.scale_method or model.scale_method,
+                        args.m_scale if args.m_scale is not None else model.m_scaler,
+                        args.s_scale if args.s_scale is not None else model.s_scaler)
+
+    replay_start = time.time()
+    scores, dps = replay(records, model, fields, idle_time)
+    elapsed = time.time() - replay_start
+    log_info('Replayed %d records of %d requests in %.3f seconds (%.0f records/s), %d outliers',
+             len(records), len(scores), elapsed, len(records) / elapsed if elapsed > 0 else 0,
+             int(scores.is_outlier.sum()))
+
+    for name, df in (('scores', scores), ('datapoints', dps)):
+        fname = os.path.join(args.out, 'replay_trace_{}_{}.csv'.format(name, model_label))
+        df.to_csv(fname, index=False)
+        log_info('Replayed {} written to {}'.format(name, fname))
+
+    # The run's kernel scores are comparable when replaying its own model
+    if fitted or requantized or args.model is not None or args.label is None:
+        sys.exit(0)
+    try:
+        recorded = read_output(args.out, 'scores', args.label)
+    except FileNotFoundError:
+        sys.exit(0)
+    if app_id is not None:
+        recorded = recorded[recorded.app == app_id]
+    report, mismatches = compare_scores(scores.drop(columns=['detection_ts', 'detection_cputime', 'updates']),
+                                        recorded, args.tolerance)
+    log_info('Comparison with kernel scores: {}'.format(report))
@@ -0,0 +1,73 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+'''
+A packet filter enforcing the agent's blocklist: drops IPv4 packets from blocked sources
+on an interface, at the XDP hook. The agent must run with the blocklist mitigation
+action, which pins the map this filter opens.
+
+Usage (as root, from the repository root, while the agent runs):
+    python3 -m engine.xdp_blocklist eth0
+'''
+
+import argparse
+import os
+import time
+
+from bcc import BPF
+
+from logger import *
+from .mitigation import DEFAULT_PIN_PATH
+
+PROG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ebpf_progs', 'xdp_blocklist.c')
+
+def main():
+    parser = argparse.ArgumentParser(description='Drop packets from the sources FineLame blocks')
+    parser.add_argument('iface', help='Network interface to filter')
+    parser.add_argument('--pin-path', default=DEFAULT_PIN_PATH,
+                        help='Where the agent pinned the blocklist map')
+    parser.add_argument('--skb', action='store_true',
+                        help='Use generic XDP, for drivers without native support')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.pin_path):
+        log_error('No blocklist map pinned at {}: is the agent running with the blocklist action?'
+                  .format(args.pin_path))
+        return
+
+    with open(PROG) as f:
+        text = f.read().replace('$PIN_PATH', args.pin_path)
+    bpf = BPF(text=text)
+    flags = BPF.XDP_FLAGS_SKB_MODE if args.skb else 0
+    bpf.attach_xdp(args.iface, bpf.load_func('xdp_blocklist', BPF.XDP), flags)
+    log_info('Filtering {} with the blocklist at {}'.format(args.iface, args.pin_path))
+
+    try:
+        while True:
+            time.sleep(5)
+            log_info('Dropped {} packets, {} sources blocked'.format(
+                     bpf['dropped'].sum(0).value, len(bpf['blocklist'])))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bpf.remove_xdp(args.iface, flags)
+
+if __name__ == '__main__':
+    main()
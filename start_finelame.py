@@ -31,9 +31,19 @@ if __name__ == '__main__':
     parser.add_argument('--train-time', default=None, type=float, help='Number of seconds to train')
     parser.add_argument('--debug', action="store_true",  default=False, help='Turn on /sys/kernel/debug/tracing/trace_pipe debugging')
     parser.add_argument('--ano-detect', action="store_true",  default=False, help='Perform anomaly detection')
+    parser.add_argument('--collector', action="store_true",  default=False,
+                        help='Train models for the agents that stream requests to this process')
     args = parser.parse_args()
 
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if args.collector:
+        from engine.collector import Collector
+        Collector(cfg_file=args.config_file,
+                  run_label=args.run_label,
+                  outdir=args.out,
+                  train_time=args.train_time).start()
+        sys.exit()
+
     from engine.finelame import Finelame
 
     FL = Finelame(cfg_file=args.config_file,
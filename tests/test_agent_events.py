@@ -0,0 +1,75 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+
+import numpy as np
+
+from engine.finelame import Finelame
+from engine.notification import EventChannel, EVENT_DTYPE
+from engine.trace import TRACE_DTYPE
+
+class SharedPerfBPF():
+    ''' Like bcc, consuming perf buffers copies the records of every table '''
+    def __init__(self):
+        self.waiting = dict(fl_events=list(), fl_trace_records=list())
+        self.channels = list()
+
+    def perf_buffer_consume(self):
+        for channel in self.channels:
+            for record in self.waiting[channel.table]:
+                channel.pending += record.tobytes()
+            self.waiting[channel.table] = list()
+
+class Recorder():
+    def __init__(self):
+        self.events = list()
+
+    def on_events(self, events):
+        self.events.append(events)
+
+def agent(bpf):
+    ''' An agent holding only what the event loop callbacks use; jobs run inline '''
+    fl = Finelame.__new__(Finelame)
+    fl.events = EventChannel(bpf, 'perf')
+    fl.trace = EventChannel(bpf, 'perf', table='fl_trace_records', dtype=TRACE_DTYPE, drops='trace_drops')
+    bpf.channels = [fl.events, fl.trace]
+    fl.cascade = None
+    fl.mitigator = Recorder()
+    fl._submit = lambda fn, *args: fn(*args)
+    return fl
+
+def test_trace_readable_routes_events():
+    bpf = SharedPerfBPF()
+    fl = agent(bpf)
+    dispatched, traced = list(), list()
+    fl.events.add_sink(dispatched.append)
+    fl.trace.add_sink(traced.append)
+
+    events = np.zeros(2, dtype=EVENT_DTYPE)
+    events['req_id'] = [7, 8]
+    bpf.waiting['fl_events'] = [events]
+    bpf.waiting['fl_trace_records'] = [np.zeros(3, dtype=TRACE_DTYPE)]
+
+    # Only the trace buffer's fd woke the loop up, but the events were copied too
+    fl._on_trace()
+    assert [list(e['req_id']) for e in fl.mitigator.events] == [[7, 8]]
+    assert [list(e['req_id']) for e in dispatched] == [[7, 8]]
+    assert sum(len(t) for t in traced) == 3
+    assert fl.events.pending == bytearray() and fl.trace.pending == bytearray()
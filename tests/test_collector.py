@@ -0,0 +1,125 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+
+import asyncio
+import numpy as np
+import yaml
+
+from engine.collector import Collector
+from engine.fleet import CollectorClient, read_msg, write_msg
+
+FEATURES = ['REQ_CPUTIME', 'REQ_PGFLT']
+
+class Detector():
+    ''' What the client tells the collector about an application's model '''
+    def __init__(self, features, k):
+        self.features = features
+        self.k = k
+
+def make_collector(tmp_path):
+    cfg = dict(model_params=dict(k=2, features=FEATURES),
+               request_stats=dict(REQ_CPUTIME=dict(datapoint='cputime'),
+                                  REQ_PGFLT=dict(datapoint='pgfaults')),
+               applications=[dict(name='web', exec_path='/usr/sbin/web', monitors=[])],
+               collector=dict(path=str(tmp_path / 'collector.sock'), train=dict(min_samples=100)))
+    cfg_file = tmp_path / 'fl_cfg.yml'
+    cfg_file.write_text(yaml.safe_dump(cfg))
+    return Collector(str(cfg_file), 'test', str(tmp_path / 'out'))
+
+def requests(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.lognormal(12, 1, n), rng.poisson(20, n)]).astype(np.float64)
+
+async def until(condition, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+def test_frames_round_trip():
+    async def run():
+        reader = asyncio.StreamReader()
+        class Writer():
+            def write(self, data):
+                reader.feed_data(data)
+        payload = np.arange(6, dtype=np.float64).tobytes()
+        write_msg(Writer(), dict(type='batch', app='web', rows=3), payload)
+        write_msg(Writer(), dict(type='hello'))
+        reader.feed_eof()
+        return [await read_msg(reader) for _ in range(3)]
+    first, second, end = asyncio.run(run())
+    assert first == (dict(type='batch', app='web', rows=3), np.arange(6, dtype=np.float64).tobytes())
+    assert second == (dict(type='hello'), b'')
+    assert end == (None, None)
+
+def test_agent_gets_fleet_model(tmp_path):
+    collector = make_collector(tmp_path)
+    models = list()
+
+    async def run():
+        collector.loop = asyncio.get_running_loop()
+        server = await asyncio.start_unix_server(collector._handle, collector.path)
+        client = CollectorClient(['web'], [Detector(FEATURES, 2)],
+                                 lambda app_id, params: models.append((app_id, params)),
+                                 path=collector.path, sample_rate=1, interval=0.01, seed=0)
+        task = asyncio.ensure_future(client.run())
+        client.submit(0, requests(500))
+        await until(lambda: len(collector.FDs['web'].reservoir) == 500)
+
+        await collector._train_round()
+        await until(lambda: models)
+        # A round without enough new requests keeps the model
+        await collector._train_round()
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        server.close()
+        await server.wait_closed()
+        return client
+
+    client = asyncio.run(run())
+    collector.worker.shutdown()
+    assert client.stats['sent'] == 500 and client.stats['connections'] == 1
+    assert collector.models['web'][0] == 1
+    app_id, params = models[0]
+    assert app_id == 0
+    assert params == collector.models['web'][1]
+    assert len(params['centroid_l1s']) == 2
+
+def test_mismatched_agent_is_refused(tmp_path):
+    collector = make_collector(tmp_path)
+
+    async def run():
+        server = await asyncio.start_unix_server(collector._handle, collector.path)
+        reader, writer = await asyncio.open_unix_connection(collector.path)
+        write_msg(writer, dict(type='hello', host='h', pid=1,
+                               apps=dict(web=dict(features=['REQ_CPUTIME'], k=2))))
+        header, _ = await read_msg(reader)
+        closed = await read_msg(reader)
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return header, closed
+
+    header, closed = asyncio.run(run())
+    collector.worker.shutdown()
+    assert header['type'] == 'error' and 'features of web differ' in header['message']
+    assert closed == (None, None)
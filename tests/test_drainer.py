@@ -0,0 +1,75 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+
+import ctypes as ct
+import time
+import numpy as np
+
+from bench.fake_bpf import FakeBPF
+from engine.bcc_monitor import BCCMonitor
+from engine.drainer import RequestDrainer
+from engine.harvest import split_keys
+
+REQUEST_STATS = dict(REQ_CPUTIME=dict(datapoint='cputime'))
+NS_PER_S = 1000 * 1000 * 1000
+
+def monitor(n, idle_s):
+    ''' n requests, unmapped from a thread and idle for idle_s seconds '''
+    ebpf = FakeBPF(2)
+    ebpf.fill_requests(n)
+    values = ebpf['datapoints'].values
+    values['latest_ts_update'] = time.monotonic_ns() - int(idle_s * NS_PER_S)
+    values['last_unmap_ts'] = values['latest_ts_update']
+    return ebpf, BCCMonitor(None, REQUEST_STATS, ebpf=ebpf)
+
+def drained_rids(drainer):
+    datapoints, _ = drainer.drain()
+    return sorted(datapoints['req_id'])
+
+def test_completed_requests_are_drained():
+    ebpf, bm = monitor(4, idle_s=2)
+    drainer = RequestDrainer(bm, complete_age=1, idle_age=60)
+    assert drained_rids(drainer) == [1, 2, 3, 4]
+    assert len(ebpf['datapoints']) == 0
+
+def test_recent_requests_stay():
+    ebpf, bm = monitor(4, idle_s=0)
+    assert drained_rids(RequestDrainer(bm, complete_age=1, idle_age=60)) == []
+    assert len(ebpf['datapoints']) == 4
+
+def test_mapped_requests_stay():
+    # Request 2 was unmapped from one thread, but another one still serves it
+    ebpf, bm = monitor(4, idle_s=120)
+    key = ebpf['datapoints'].keys[1]
+    ebpf['tid_to_rid'][ct.c_uint32(1234)] = ct.c_uint64(int(key))
+    drainer = RequestDrainer(bm, complete_age=1, idle_age=60)
+    assert drained_rids(drainer) == [1, 3, 4]
+    assert split_keys(np.array([key], dtype=np.uint64))[1][0] == 2
+    assert len(ebpf['datapoints']) == 1
+
+    del ebpf['tid_to_rid'][ct.c_uint32(1234)]
+    assert drained_rids(drainer) == [2]
+
+def test_force_drains_mapped_requests():
+    ebpf, bm = monitor(3, idle_s=0)
+    ebpf['tid_to_rid'][ct.c_uint32(1234)] = ct.c_uint64(int(ebpf['datapoints'].keys[0]))
+    datapoints, scores = RequestDrainer(bm).drain(force=True)
+    assert len(datapoints) == 3 and len(scores) == 3
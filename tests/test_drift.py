@@ -0,0 +1,59 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+
+import numpy as np
+
+from engine.drift import psi, log2_buckets, log2_histograms, HIST_BUCKETS
+
+def test_log2_buckets_match_the_kernel():
+    # Bucket 0 holds zeros, bucket b the values in [2^(b-1), 2^b)
+    values = np.array([0, 1, 2, 3, 4, 7, 8, 1023, 1024, 2 ** 63])
+    assert log2_buckets(values).tolist() == [0, 1, 2, 2, 3, 3, 4, 10, 11, 64]
+
+def test_log2_histograms_shape():
+    X = np.array([[0, 5], [1, 5], [-3, 6]])
+    hist = log2_histograms(X)
+    assert hist.shape == (2, HIST_BUCKETS)
+    # Negative values are clipped to 0
+    assert hist[0, 0] == 2 and hist[0, 1] == 1
+    assert hist[1, 3] == 3
+
+def test_psi_of_same_distribution_is_zero():
+    hist = np.array([10, 40, 30, 20])
+    assert psi(hist, hist) == 0
+    # Only shares count, not totals
+    assert abs(psi(hist, hist * 7)) < 1e-12
+
+def test_psi_grows_with_the_shift():
+    rng = np.random.default_rng(0)
+    reference = log2_histograms(rng.lognormal(10, 1, (100000, 1)))[0]
+    same = log2_histograms(rng.lognormal(10, 1, (100000, 1)))[0]
+    shifted = log2_histograms(rng.lognormal(10.5, 1, (100000, 1)))[0]
+    far = log2_histograms(rng.lognormal(13, 1, (100000, 1)))[0]
+    assert psi(reference, same) < 0.01
+    assert 0.1 < psi(reference, shifted) < psi(reference, far)
+    assert psi(reference, far) > 0.2
+
+def test_psi_of_empty_histograms():
+    # Empty buckets are floored rather than dividing by zero
+    empty = np.zeros(4)
+    assert np.isfinite(psi(empty, np.array([1, 0, 0, 0])))
+    assert psi(empty, empty) == 0
@@ -0,0 +1,88 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+
+import os
+import shutil
+import pytest
+
+from engine import ebpf_rewriter
+from engine.ebpf_rewriter import cache_key, rewrite_ebpf, datapoint_layout
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EBPF_PROG = os.path.join(REPO, 'engine', 'ebpf_progs', 'finelame_ebpf.c')
+
+APP = dict(exec_path='/usr/sbin/app', rid_type='u64',
+           monitors=[dict(event='do_work', in_fn_name='dmtr_map_tid_to_iter',
+                          ret_fn_name='dmtr_unmap_tid_to_iter', rid_position=1)])
+
+class Detector():
+    def __init__(self, k):
+        self.k = k
+
+def key(**kwargs):
+    args = dict(src='int x;', applications=[APP], debug=False, detectors=None, events=None)
+    args.update(kwargs)
+    return cache_key(**args)
+
+def test_same_inputs_same_key():
+    assert key() == key()
+
+@pytest.mark.parametrize('change', [
+    dict(src='int y;'),
+    dict(debug=True),
+    dict(detectors=[Detector(4)]),
+    dict(percpu=True),
+    dict(sampling=True),
+    dict(cascade=True),
+    dict(applications=[dict(APP, rid_type='u32')]),
+    dict(layout=datapoint_layout({}, ['cputime'])),
+    dict(proc_filter=dict(slots=8)),
+])
+def test_inputs_change_key(change):
+    assert key(**change) != key()
+
+def test_rewriter_changes_key(monkeypatch):
+    before = key()
+    monkeypatch.setattr(ebpf_rewriter, 'REWRITER_HASH', 'edited')
+    assert key() != before
+
+def test_format_changes_key(monkeypatch):
+    before = key()
+    monkeypatch.setattr(ebpf_rewriter, 'CACHE_FORMAT', ebpf_rewriter.CACHE_FORMAT + 1)
+    assert key() != before
+
+def test_kernel_changes_key(monkeypatch):
+    before = key()
+    monkeypatch.setattr(ebpf_rewriter, 'kernel_id', lambda: ['another kernel'])
+    assert key() != before
+
+def test_rewrite_is_reused(tmp_path):
+    src = tmp_path / 'finelame_ebpf.c'
+    shutil.copy(EBPF_PROG, src)
+    cache_dir = str(tmp_path / 'cache')
+    first, cached = rewrite_ebpf(str(src), [APP], False, cache_dir=cache_dir)
+    assert not cached
+    assert rewrite_ebpf(str(src), [APP], False, cache_dir=cache_dir) == (first, True)
+
+    with open(src, 'a') as f:
+        f.write('\n// edited\n')
+    edited, cached = rewrite_ebpf(str(src), [APP], False, cache_dir=cache_dir)
+    assert not cached and edited != first
@@ -0,0 +1,83 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+
+import numpy as np
+import pytest
+
+from engine.fixed_point import (reciprocal, reciprocals, kernel_normalize, kernel_decide,
+                                norm_factors, scale_factors, RECIPROCAL_BITS)
+
+@pytest.mark.parametrize('factor', [1e-9, 3.7e-4, 0.5, 1.0, 3.0, 1000.25, 2.0 ** 31 - 1])
+def test_reciprocal_approximates_factor(factor):
+    mult, shift = reciprocal(factor)
+    assert 0 < mult < 1 << RECIPROCAL_BITS
+    assert 0 <= shift <= 63
+    assert abs(mult / 2 ** shift - factor) <= factor * 2.0 ** -(RECIPROCAL_BITS - 2)
+
+def test_reciprocal_of_huge_factor_saturates():
+    mult, shift = reciprocal(2.0 ** 40)
+    assert shift == 0 and mult == (1 << RECIPROCAL_BITS) - 1
+
+def test_reciprocal_of_null_factor():
+    assert reciprocal(0) == (0, 0)
+    assert reciprocal(-1.5) == (0, 0)
+
+def test_reciprocals_match_scalar():
+    factors = [0.001, 2.5, 0]
+    mults, shifts = reciprocals(factors)
+    assert [(int(m), int(s)) for m, s in zip(mults, shifts)] == [reciprocal(f) for f in factors]
+
+def test_kernel_normalize_matches_float():
+    rng = np.random.default_rng(0)
+    m_scale, s_scale = scale_factors('exponent', 10, 6)
+    std = np.array([1e3, 2.5e5, 40., 1e9])
+    factors = norm_factors(std, m_scale, s_scale)
+    mult, shift = reciprocals(factors)
+    # Values up to 2^40, of both signs, exercise the 32-bit split of the product
+    values = rng.integers(-2 ** 40, 2 ** 40, (1000, len(std)))
+    exact = values * factors
+    approx = kernel_normalize(values, mult, shift)
+    assert np.all((np.sign(approx) == np.sign(np.trunc(exact))) | (np.abs(exact) < 2))
+    assert np.all(np.abs(approx - exact) <= 2 + np.abs(exact) * 2.0 ** -(RECIPROCAL_BITS - 2))
+
+def test_kernel_normalize_null_multiplier():
+    # Features dropped from a model are normalized with a null multiplier
+    values = np.array([[5, 7], [-3, 11]])
+    out = kernel_normalize(values, [1 << 31, 0], [31, 0])
+    assert out.tolist() == [[5, 0], [-3, 0]]
+
+def test_kernel_decide_closest_cluster():
+    distances = np.array([[10, -3, 50],    # closest is cluster 1, negative: inside
+                          [40, 25, -25],   # tie between clusters 1 and 2: the first wins
+                          [90, 80, 70]])   # closest is cluster 2, past its threshold
+    min_dist, is_outlier = kernel_decide(distances, [5, 20, 60])
+    assert min_dist.tolist() == [-3, 25, 70]
+    assert is_outlier.tolist() == [False, True, True]
+
+def test_kernel_decide_skips_unset_thresholds():
+    distances = np.array([[1, 100], [100, 1]])
+    min_dist, is_outlier = kernel_decide(distances, [0, 50])
+    assert min_dist.tolist() == [100, 1]
+    assert is_outlier.tolist() == [True, False]
+
+def test_kernel_decide_without_thresholds():
+    min_dist, is_outlier = kernel_decide(np.array([[5, 9]]), [0, 0])
+    assert not is_outlier.any()
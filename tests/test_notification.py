@@ -0,0 +1,60 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+
+import numpy as np
+
+from engine import notification
+from engine.notification import EventChannel, EVENT_DTYPE
+
+class Table():
+    map_fd = 42
+
+class PerfBPF():
+    ''' Two tables with perf buffers on two CPUs, whose reader fds are not the CPU indexes '''
+    def __init__(self):
+        self.tables = dict(fl_events=Table(), fl_trace_records=Table())
+        self.perf_buffers = dict()
+        for name, base in (('fl_events', 100), ('fl_trace_records', 200)):
+            for cpu in range(2):
+                self.perf_buffers[(id(self.tables[name]), cpu)] = ('reader', base + cpu)
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+def test_perf_fds_are_reader_fds(monkeypatch):
+    monkeypatch.setattr(notification, 'perf_reader_fd', lambda reader: reader[1])
+    bpf = PerfBPF()
+    assert sorted(EventChannel(bpf, 'perf').fds()) == [100, 101]
+    assert sorted(EventChannel(bpf, 'perf', table='fl_trace_records').fds()) == [200, 201]
+
+def test_ringbuf_fd_is_map_fd():
+    assert EventChannel(PerfBPF(), 'ringbuf').fds() == [42]
+
+def test_take_and_dispatch():
+    channel = EventChannel(PerfBPF(), 'perf')
+    received = list()
+    channel.add_sink(received.append)
+    events = np.zeros(3, dtype=EVENT_DTYPE)
+    events['req_id'] = [1, 2, 3]
+    channel.pending += events.tobytes()
+    assert channel.flush() == 3
+    assert list(received[0]['req_id']) == [1, 2, 3]
+    assert channel.take() == b''
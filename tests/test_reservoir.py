@@ -0,0 +1,71 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+
+import numpy as np
+import pandas as pd
+
+from engine.reservoir import Reservoir
+
+def batches(n, size):
+    for start in range(0, n, size):
+        stop = min(start + size, n)
+        yield pd.DataFrame(dict(rid=np.arange(start, stop, dtype=np.uint64),
+                                cputime=np.arange(start, stop, dtype=np.float64) * 2))
+
+def test_keeps_everything_below_capacity():
+    reservoir = Reservoir(100, seed=0)
+    for df in batches(60, 7):
+        reservoir.add(df)
+    assert len(reservoir) == 60
+    frame = reservoir.frame()
+    assert list(frame.rid) == list(range(60))
+    assert frame.rid.dtype == np.uint64 and frame.cputime.dtype == np.float64
+
+def test_bounded_by_capacity():
+    reservoir = Reservoir(100, seed=0)
+    for df in batches(10000, 333):
+        reservoir.add(df)
+    frame = reservoir.frame()
+    assert len(reservoir) == 100 and len(frame) == 100
+    assert reservoir.n_seen == 10000
+    # Rows stay whole: columns are sampled together
+    assert (frame.cputime == frame.rid * 2).all()
+    assert frame.rid.is_unique
+
+def test_sample_is_uniform():
+    # Every row of the stream is kept with probability capacity / n, whatever its batch
+    n, capacity, runs = 2000, 200, 200
+    kept = np.zeros(n)
+    for seed in range(runs):
+        reservoir = Reservoir(capacity, seed=seed)
+        for df in batches(n, 150):
+            reservoir.add(df)
+        kept[reservoir.frame().rid.to_numpy().astype(np.int64)] += 1
+    share = kept.reshape(10, -1).sum(axis=1) / (runs * capacity)
+    assert np.allclose(share, 0.1, atol=0.01)
+
+def test_empty_and_clear():
+    reservoir = Reservoir(10)
+    reservoir.add(pd.DataFrame())
+    assert len(reservoir) == 0 and reservoir.frame().empty
+    reservoir.add(next(batches(5, 5)))
+    reservoir.clear()
+    assert len(reservoir) == 0 and reservoir.frame().empty
@@ -0,0 +1,108 @@
+'''
+START OF LICENSE STUB
+    FineLame: Detecting Application-Layer Denial-of-Service Attacks
+    Copyright (C) 2019 University of Pennsylvania
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+END OF LICENSE STUB
+'''
+
+
+import numpy as np
+import pytest
+
+from engine.harvest import APP_SHIFT
+from engine.trace import (TraceFileSink, read_trace, HEADER, TRACE_DTYPE, TR_CPU, TR_PGFAULT,
+                          TR_MAP, TR_UNMAP)
+from engine.trace_replay import replay, datapoints, fit_model, _updates
+
+def synthetic_trace(n_requests, app=1, seed=0):
+    ''' A map, a few cputime and page fault records, and an unmap per request '''
+    rng = np.random.default_rng(seed)
+    records = list()
+    ts = 1000
+    for rid in range(1, n_requests + 1):
+        key = (app << APP_SHIFT) | rid
+        n_events = int(rng.integers(1, 6))
+        events = [(TR_MAP, 0)] + [(t, int(rng.integers(1, 10 ** 6)))
+                                  for t in rng.choice([TR_CPU, TR_PGFAULT], n_events)] + [(TR_UNMAP, 0)]
+        for type_, value in events:
+            ts += int(rng.integers(1, 1000))
+            records.append((ts, key, value, rid % 7, type_, rid % 4))
+    return np.array(records, dtype=TRACE_DTYPE)
+
+def trace_datapoints(records):
+    req_id, _, field, value = _updates(records, idle_time=False)
+    return datapoints(records, req_id, field, value)
+
+def test_file_round_trip(tmp_path):
+    records = synthetic_trace(50)
+    path = str(tmp_path / 'trace' / 'trace_test.fltr')
+    sink = TraceFileSink(path)
+    for batch in np.array_split(records, 4):
+        sink(batch)
+    sink.close()
+    assert sink.n_records == len(records)
+    assert np.array_equal(read_trace(path), records)
+
+def test_cut_record_is_left_out(tmp_path):
+    records = synthetic_trace(5)
+    path = str(tmp_path / 'trace.fltr')
+    sink = TraceFileSink(path)
+    sink(records)
+    sink.close()
+    with open(path, 'ab') as f:
+        f.write(b'\1' * (TRACE_DTYPE.itemsize // 2))
+    assert np.array_equal(read_trace(path), records)
+
+def test_empty_and_foreign_files(tmp_path):
+    path = str(tmp_path / 'empty.fltr')
+    TraceFileSink(path).close()
+    assert len(read_trace(path)) == 0
+    other = tmp_path / 'other.fltr'
+    other.write_bytes(b'\0' * (HEADER.size + TRACE_DTYPE.itemsize))
+    with pytest.raises(Exception):
+        read_trace(str(other))
+
+def test_replayed_datapoints_sum_records():
+    records = synthetic_trace(100)
+    dps = trace_datapoints(records)
+    for type_, field in ((TR_CPU, 'cputime'), (TR_PGFAULT, 'pgfaults')):
+        res = records[records['type'] == type_]
+        expected = {int(k) & ((1 << APP_SHIFT) - 1): 0 for k in np.unique(records['req_id'])}
+        for key, value in zip(res['req_id'], res['value']):
+            expected[int(key) & ((1 << APP_SHIFT) - 1)] += int(value)
+        got = dict(zip(dps.req_id.tolist(), dps[field].tolist() if field in dps else [0] * len(dps)))
+        assert got == expected
+    maps = records[records['type'] == TR_MAP]
+    assert dps.first_ts.tolist() == maps['ts'].tolist()
+    assert (dps.app == 1).all()
+
+def test_replay_scores_every_request(tmp_path):
+    records = synthetic_trace(300)
+    path = str(tmp_path / 'trace.fltr')
+    sink = TraceFileSink(path)
+    sink(records)
+    sink.close()
+    records = read_trace(path)
+
+    fields = ['cputime', 'pgfaults']
+    dps = trace_datapoints(records)
+    model = fit_model(dps, ['REQ_CPUTIME', 'REQ_PGFLT'], fields, dict(k=2))
+    scores, replayed = replay(records, model, fields)
+    assert sorted(scores.req_id) == list(range(1, 301))
+    assert replayed.equals(dps)
+    # One update per resource record
+    resource = np.isin(records['type'], [TR_CPU, TR_PGFAULT])
+    assert scores.updates.sum() == resource.sum()